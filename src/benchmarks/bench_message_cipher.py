@@ -0,0 +1,67 @@
+"""Microbenchmark of the message cipher against the original byte wise XOR.
+Run from the `src` directory:
+
+    python -m benchmarks.bench_message_cipher
+"""
+import argparse
+import os
+import time
+
+from util.message_cipher import XorMessageCipher, numpy
+
+SIZES = [1024, 64 * 1024, 1024 * 1024, 10 * 1024 * 1024, 100 * 1024 * 1024]
+SECRET_SIZE = 32
+
+
+def legacy_xor(msg: bytes, secret: bytes) -> bytes:
+    """Former OQSClient._xor_msg_with_shared_secret
+    """
+    origin_secret = secret
+    while len(msg) > len(secret):
+        secret = secret + origin_secret
+    return bytes([_a ^ _b for _a, _b in zip(msg, secret)])
+
+
+def measure(function, size: int, min_time: float) -> float:
+    """Run function until min_time passed, return throughput in MB/s
+    """
+    runs = 0
+    start = time.perf_counter()
+    elapsed = 0.0
+    while elapsed < min_time or runs == 0:
+        function()
+        runs += 1
+        elapsed = time.perf_counter() - start
+    return size * runs / elapsed / 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--legacy-max', type=int, default=256 * 1024,
+                        help="Biggest input for the legacy function, it is very slow on big inputs")
+    parser.add_argument('--min-time', type=float, default=0.5, help="Seconds per measurement")
+    args = parser.parse_args()
+
+    secret = os.urandom(SECRET_SIZE)
+    ciphers = {'bigint': XorMessageCipher(secret, use_numpy=False)}
+    if numpy is not None:
+        ciphers['numpy'] = XorMessageCipher(secret, use_numpy=True)
+
+    columns = ['legacy'] + list(ciphers) + ['bigint-stream']
+    print(f"{'size':>10} " + " ".join(f"{column + ' MB/s':>18}" for column in columns))
+    for size in SIZES:
+        msg = os.urandom(size)
+        results = []
+        if size <= args.legacy_max:
+            results.append(measure(lambda: legacy_xor(msg, secret), size, args.min_time))
+        else:
+            results.append(None)
+        for cipher in ciphers.values():
+            results.append(measure(lambda: cipher.apply(msg), size, args.min_time))
+        chunks = [msg[i:i + 64 * 1024] for i in range(0, size, 64 * 1024)]
+        results.append(measure(lambda: b"".join(ciphers['bigint'].stream(chunks)), size, args.min_time))
+        print(f"{size:>10} " + " ".join(f"{'-' if r is None else f'{r:.1f}':>18}" for r in results))
+
+
+if __name__ == '__main__':
+    main()
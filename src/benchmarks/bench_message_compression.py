@@ -0,0 +1,84 @@
+"""Benchmark of the message compression: bytes saved and CPU time per message size,
+with the chat dictionary, without a dictionary, and of `compress_message`, which skips
+messages that don't get smaller. Messages are generated from typical chat sentences,
+which are not part of the dictionary.
+Run from the `src` directory:
+
+    python -m benchmarks.bench_message_compression
+"""
+import argparse
+import random
+import time
+import zlib
+
+from util.message_compression import CHAT_DICTIONARY, WINDOW_BITS, MEMORY_LEVEL, compress_message, \
+    decompress_message
+
+SIZES = [16, 32, 64, 128, 256, 512, 1024, 4096]
+# Held out from the chat dictionary. Sentences, the dictionary was built from, would overstate its gain
+SENTENCES = [
+    "Hi! Long time no see, what have you been up to?", "Just got home, give me five minutes.",
+    "That works for me.", "Did you get the slides from the workshop?", "Cheers, you saved my evening.",
+    "Apologies, my phone died on the train.", "When should we leave for the airport?",
+    "lmao I can't believe he actually said that", "I'll ask my sister and get back to you.",
+    "Have you reserved the table for Saturday yet?", "All good, it happens to everyone.",
+    "Maybe we push the release to the end of the month?", "Wishing you all the best on your big day!",
+    "We're sitting in the back, near the window.", "k", "Sleep well!",
+    "The tests are red on main, can you have a look at the pipeline?",
+]
+
+
+def chat_text(size: int, rng: random.Random) -> bytes:
+    """Chat like text of about the given size
+    """
+    text = ""
+    while len(text) < size:
+        text += rng.choice(SENTENCES) + " "
+    return text[:size].encode()
+
+
+def deflate(data: bytes, zdict: bytes = None) -> bytes:
+    compressor = zlib.compressobj(zlib.Z_BEST_COMPRESSION, zlib.DEFLATED, -WINDOW_BITS, MEMORY_LEVEL,
+                                  **({'zdict': zdict} if zdict else {}))
+    return compressor.compress(data) + compressor.flush()
+
+
+def measure(function, messages: list, min_time: float) -> float:
+    """Run function over all messages until min_time passed, return µs per message
+    """
+    runs = 0
+    start = time.perf_counter()
+    elapsed = 0.0
+    while elapsed < min_time or runs == 0:
+        for message in messages:
+            function(message)
+        runs += 1
+        elapsed = time.perf_counter() - start
+    return elapsed / (runs * len(messages)) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--messages', type=int, default=200, help="Messages per size")
+    parser.add_argument('--min-time', type=float, default=0.5, help="Seconds per measurement")
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    print(f"{'size':>6} {'no dict':>9} {'dict':>9} {'sent':>9} {'saved':>7} {'skipped':>8} "
+          f"{'compress µs':>12} {'decompress µs':>14}")
+    for size in SIZES:
+        messages = [chat_text(size, rng) for _ in range(args.messages)]
+        plain = sum(len(message) for message in messages)
+        without_dict = sum(len(deflate(message)) for message in messages)
+        with_dict = sum(len(deflate(message, CHAT_DICTIONARY)) for message in messages)
+        compressed = [compress_message(message) for message in messages]
+        sent = sum(len(message) for message in compressed)
+        skipped = sum(1 for message, result in zip(messages, compressed) if message is result)
+        compress_time = measure(compress_message, messages, args.min_time)
+        decompress_time = measure(decompress_message, compressed, args.min_time)
+        print(f"{size:>6} {without_dict / plain:>9.1%} {with_dict / plain:>9.1%} {sent / plain:>9.1%} "
+              f"{plain - sent:>7} {skipped / len(messages):>8.0%} {compress_time:>12.1f} {decompress_time:>14.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,149 @@
+"""Benchmark of the server cold start and of account provisioning. Reports the import time of
+the server, the setup of a new and of an existing database, seed phrases per second with a
+generator per phrase, with the cached generator and from the pool, and accounts per second
+for a burst of NEW_ACCOUNT_REQUEST, with and without the seed phrase pool.
+Run from the `src` directory:
+
+    python -m benchmarks.bench_provisioning
+"""
+import argparse
+import base64
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from threading import Event
+
+from util.oqs_utils import RequestType
+from util.wire_format import WIRE_FORMAT_JSON
+from util.security_util import generate_random_seed_phrase
+from server.oqs_server import OQSServer
+from server.seed_phrase_pool import SeedPhrasePool, SEED_PHRASE_POOL_SIZE
+
+SRC_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Size of a Kyber512 public key
+PUBLIC_KEY_SIZE = 800
+# Runs in a fresh interpreter, so nothing is imported yet. Prints the phases in seconds
+COLD_START_SCRIPT = """
+import json, sys, time
+start = time.perf_counter()
+from server.oqs_server import OQSServer
+imported = time.perf_counter()
+server = OQSServer(db_path=sys.argv[1], seed_phrase_pool_size=0)
+created = time.perf_counter()
+server.stop_server()
+print(json.dumps({"import": imported - start, "setup": created - imported}))
+"""
+
+
+def cold_start(db_path: str) -> dict:
+    output = subprocess.run([sys.executable, "-c", COLD_START_SCRIPT, db_path], cwd=SRC_DIR, check=True,
+                            capture_output=True, text=True).stdout
+    return json.loads(output.splitlines()[-1])
+
+
+def per_second(function, min_time: float) -> float:
+    """Call function until min_time passed, return the calls per second
+    """
+    calls = 0
+    start = time.perf_counter()
+    elapsed = 0.0
+    while elapsed < min_time or calls == 0:
+        function()
+        calls += 1
+        elapsed = time.perf_counter() - start
+    return calls / elapsed
+
+
+def uncached_seed_phrase():
+    """Seed phrase with a new generator, as every account was created before the generator was cached
+    """
+    from bip_utils import Bip39MnemonicGenerator, Bip39WordsNum
+    return str(Bip39MnemonicGenerator().FromWordsNumber(Bip39WordsNum.WORDS_NUM_12))
+
+
+def pool_takes_per_second(size: int) -> float:
+    """Empty a full pool, without misses
+    """
+    pool = SeedPhrasePool(size)
+    pool.start()
+    while pool.available < size:
+        time.sleep(0.01)
+    pool.stop()
+    start = time.perf_counter()
+    for _ in range(size):
+        pool.take()
+    return size / (time.perf_counter() - start)
+
+
+class _CountingConnection():
+    """Connection, that only counts the frames sent to it
+    """
+
+    def __init__(self, expected: int):
+        self.wire_format = WIRE_FORMAT_JSON
+        self.peer_node = None
+        self.__expected = expected
+        self.sent = 0
+        self.done = Event()
+
+    def sendall(self, data: bytes):
+        self.sent += 1
+        if self.sent == self.__expected:
+            self.done.set()
+
+
+def accounts_per_second(db_path: str, accounts: int, pool_size: int) -> dict:
+    """Handle a burst of NEW_ACCOUNT_REQUEST, once the pool is full. Counts until every account is committed
+    """
+    server = OQSServer(db_path=db_path, seed_phrase_pool_size=pool_size)
+    server.seed_phrases.start()
+    while server.seed_phrases.available < pool_size:
+        time.sleep(0.01)
+    connection = _CountingConnection(accounts)
+    public_key = base64.b64encode(os.urandom(PUBLIC_KEY_SIZE)).decode('ascii')
+    start = time.perf_counter()
+    for index in range(accounts):
+        request = {'requestType': RequestType.NEW_ACCOUNT_REQUEST, 'publicKey': public_key, 'name': f"user{index}"}
+        server._handle_request(request, connection, None)
+    connection.done.wait()
+    elapsed = time.perf_counter() - start
+    misses = server.seed_phrases.misses
+    server.stop_server()
+    return {'accountsPerSecond': accounts / elapsed, 'poolMisses': misses}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=5, help="Cold starts per measurement, the median is reported")
+    parser.add_argument('--accounts', type=int, default=SEED_PHRASE_POOL_SIZE, help="Accounts per burst")
+    parser.add_argument('--min-time', type=float, default=1.0, help="Seconds per seed phrase measurement")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        print("Cold start, median of", args.runs, "runs")
+        fresh = [cold_start(os.path.join(directory, f"fresh-{run}.db")) for run in range(args.runs)]
+        existing = [cold_start(os.path.join(directory, "fresh-0.db")) for _ in range(args.runs)]
+        print(f"  import server        {statistics.median(r['import'] for r in fresh) * 1000:8.1f} ms")
+        print(f"  setup new database   {statistics.median(r['setup'] for r in fresh) * 1000:8.1f} ms")
+        print(f"  setup existing       {statistics.median(r['setup'] for r in existing) * 1000:8.1f} ms")
+
+        print("Seed phrases per second")
+        generate_random_seed_phrase()
+        print(f"  generator per phrase {per_second(uncached_seed_phrase, args.min_time):10.0f}")
+        print(f"  cached generator     {per_second(generate_random_seed_phrase, args.min_time):10.0f}")
+        print(f"  from a full pool     {pool_takes_per_second(SEED_PHRASE_POOL_SIZE):10.0f}")
+
+        print(f"Bursts of {args.accounts} NEW_ACCOUNT_REQUEST")
+        for pool_size in (0, SEED_PHRASE_POOL_SIZE):
+            result = accounts_per_second(os.path.join(directory, f"accounts-{pool_size}.db"), args.accounts,
+                                         pool_size)
+            print(f"  pool of {pool_size:<4}         {result['accountsPerSecond']:10.0f}  "
+                  f"({result['poolMisses']} generated on the request thread)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,350 @@
+"""Load test of the server with thousands of simulated headless clients.
+Starts a local server, creates an account per client, connects the clients in pairs
+and lets every client send a storm of messages to its partner. Simulated clients speak
+the wire protocol directly on asyncio, so no Eel, KEM or client database is involved.
+Messages carry random session ids and no SESSION_INIT_REQUEST is sent, so only the relaying
+of the server is measured, not the session setup of real clients.
+Run from the `src` directory:
+
+    python -m benchmarks.load_test --clients 2000 --messages 50 --output load_test.json
+
+Reports connect/handshake rate, account and contact rates, messages/s, end-to-end
+latency percentiles and the RSS of the server. Results are written as JSON, to be
+compared across commits.
+"""
+import argparse
+import asyncio
+import base64
+import json
+import os
+import platform
+import shutil
+import ssl
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+
+from util.oqs_utils import RequestType
+from util.frame_codec import FrameDecoder, encode_frame
+from util.wire_format import WIRE_FORMAT_BINARY, WIRE_FORMAT_JSON, FrameKind, is_binary_frame, frame_kind, \
+    pack_send_message, unpack_deliver_message, SESSION_ID_SIZE, CAPABILITY_SESSIONS
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
+# Messages start with the send time, so the recipient can measure the end-to-end latency
+TIMESTAMP = struct.Struct("!Q")
+# Size of a Kyber512 public key
+PUBLIC_KEY_SIZE = 800
+SRC_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# File descriptors on top of one per simulated client, e.g. for the server process, which inherits the limit
+FILE_LIMIT_HEADROOM = 1024
+
+
+def percentiles(values: list) -> dict:
+    """p50, p95, p99 and max of the values, in milliseconds
+    """
+    if not values:
+        return {}
+    values = sorted(values)
+
+    def at(fraction):
+        return round(values[min(len(values) - 1, int(fraction * len(values)))] * 1000, 3)
+    return {'p50': at(0.50), 'p95': at(0.95), 'p99': at(0.99), 'max': round(values[-1] * 1000, 3)}
+
+
+def rss_kb(pid: int) -> int:
+    """Resident set size of the process and all its children, e.g. workers. Linux only
+    """
+    total = 0
+    try:
+        with open(f"/proc/{pid}/status") as status_file:
+            for line in status_file:
+                if line.startswith("VmRSS:"):
+                    total += int(line.split()[1])
+        with open(f"/proc/{pid}/task/{pid}/children") as children_file:
+            for child in children_file.read().split():
+                total += rss_kb(int(child))
+    except OSError:
+        pass
+    return total
+
+
+def raise_file_limit(wanted: int):
+    """Raise the soft limit of open files to `wanted`, but never above the hard limit.
+    Keeps the current limit, if the platform refuses it
+    """
+    if resource is None:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard != resource.RLIM_INFINITY:
+        wanted = min(wanted, hard)
+    if soft == resource.RLIM_INFINITY or soft >= wanted:
+        return
+    try:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (wanted, hard))
+    except (ValueError, OSError) as e:
+        print(f"Open file limit stays at {soft}: {e}")
+
+
+class SimulatedClient():
+    """Headless client, that speaks the wire protocol of OQSClient
+    """
+
+    def __init__(self, index: int, context: ssl.SSLContext, stats):
+        self.index = index
+        self.uuid = None
+        self._context = context
+        self._stats = stats
+        self._reader = None
+        self._writer = None
+        self._responses = {}
+        self._session_id = os.urandom(SESSION_ID_SIZE).hex()
+
+    def _expect(self, request_type: RequestType) -> asyncio.Future:
+        future = asyncio.get_running_loop().create_future()
+        self._responses[request_type] = future
+        return future
+
+    def _send(self, payload: dict):
+        self._writer.write(encode_frame(json.dumps(payload).encode()))
+
+    async def connect(self, host: str, port: int):
+        """Open the TLS connection and negotiate the binary wire format
+        """
+        hello_response = self._expect(RequestType.HELLO_RESPONSE)
+        self._reader, self._writer = await asyncio.open_connection(host, port, ssl=self._context)
+        asyncio.get_running_loop().create_task(self._read_loop())
+        payload = {}
+        payload['requestType'] = RequestType.HELLO_REQUEST
+        payload['wireFormats'] = [WIRE_FORMAT_BINARY, WIRE_FORMAT_JSON]
+        payload['capabilities'] = [CAPABILITY_SESSIONS]
+        self._send(payload)
+        await hello_response
+
+    async def create_account(self):
+        assigned = self._expect(RequestType.ASSIGN_UUID_AND_SEED)
+        payload = {}
+        payload['requestType'] = RequestType.NEW_ACCOUNT_REQUEST
+        payload['publicKey'] = base64.b64encode(os.urandom(PUBLIC_KEY_SIZE)).decode('ascii')
+        payload['name'] = f"load-{self.index}"
+        self._send(payload)
+        self.uuid = (await assigned)['UUID']
+
+    async def connect_with_contact(self, contact_uuid: str):
+        response = self._expect(RequestType.CONNECT_WITH_CONTACT_RESPONSE)
+        payload = {}
+        payload['requestType'] = RequestType.CONNECT_WITH_CONTACT_REQUEST
+        payload['contactUUID'] = contact_uuid
+        self._send(payload)
+        if not (await response)['contactExists']:
+            raise RuntimeError(f"Contact {contact_uuid} not found")
+
+    async def send_messages(self, contact_uuid: str, count: int, size: int, interval: float):
+        padding = os.urandom(max(0, size - TIMESTAMP.size))
+        for _ in range(count):
+            message = TIMESTAMP.pack(time.perf_counter_ns()) + padding
+            self._writer.write(encode_frame(pack_send_message(contact_uuid, self._session_id, message)))
+            self._stats['sent'] += 1
+            await self._writer.drain()
+            if interval:
+                await asyncio.sleep(interval)
+
+    def _received(self, message):
+        (sent_ns,) = TIMESTAMP.unpack_from(message)
+        self._stats['latencies'].append((time.perf_counter_ns() - sent_ns) / 1e9)
+        self._stats['received'] += 1
+        if self._stats['received'] >= self._stats['expected']:
+            self._stats['done'].set()
+
+    async def _read_loop(self):
+        decoder = FrameDecoder()
+        try:
+            while True:
+                data = await self._reader.read(65536)
+                if not data:
+                    return
+                for frame in decoder.feed(data):
+                    if is_binary_frame(frame):
+                        if frame_kind(frame) == FrameKind.DELIVER_MESSAGE:
+                            self._received(unpack_deliver_message(frame).message)
+                        continue
+                    request_json = json.loads(frame.decode())
+                    request_type = RequestType[request_json['requestType']]
+                    if request_type == RequestType.SEND_MESSAGE_REQUEST:
+                        self._received(base64.b64decode(request_json['message']))
+                    future = self._responses.pop(request_type, None)
+                    if future is not None and not future.done():
+                        future.set_result(request_json)
+        except (ConnectionError, ssl.SSLError) as e:
+            self._stats['errors'].append(repr(e))
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+
+
+async def run_phase(name: str, clients: list, action, concurrency: int, results: dict):
+    """Run the action for every client, with at most `concurrency` in flight, and record rate and latencies
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    async def run(sim_client):
+        async with semaphore:
+            start = time.perf_counter()
+            await action(sim_client)
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(run(sim_client) for sim_client in clients))
+    elapsed = time.perf_counter() - start
+    results[name] = {
+        'count': len(clients),
+        'seconds': round(elapsed, 3),
+        'rate': round(len(clients) / elapsed, 1),
+        'latency_ms': percentiles(latencies)
+    }
+    print(f"{name:>10}: {len(clients)} in {elapsed:.2f}s, {len(clients) / elapsed:.1f}/s")
+
+
+async def sample_rss(pid: int, samples: list):
+    while True:
+        samples.append(rss_kb(pid))
+        await asyncio.sleep(0.2)
+
+
+def create_client_context() -> ssl.SSLContext:
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+    context.check_hostname = False
+    context.verify_mode = ssl.CERT_REQUIRED
+    context.load_verify_locations(os.path.join(SRC_DIR, 'pqca/ca/falcon512_CA.crt'))
+    return context
+
+
+async def wait_for_server(host: str, port: int, timeout: float = 30.0):
+    # Probe with a full TLS handshake, the threaded server does not expect plain TCP connections
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            _, writer = await asyncio.open_connection(host, port, ssl=create_client_context())
+            writer.close()
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            await asyncio.sleep(0.2)
+
+
+async def run_load_test(args, server_pid: int) -> dict:
+    context = create_client_context()
+    stats = {'sent': 0, 'received': 0, 'expected': args.clients * args.messages, 'latencies': [],
+             'errors': [], 'done': asyncio.Event()}
+    results = {}
+    rss_samples = []
+    sampler = None
+    if server_pid is not None:
+        results['server_rss_kb'] = {'idle': rss_kb(server_pid)}
+        sampler = asyncio.get_running_loop().create_task(sample_rss(server_pid, rss_samples))
+
+    clients = [SimulatedClient(index, context, stats) for index in range(args.clients)]
+    await run_phase('connect', clients, lambda c: c.connect(args.host, args.port), args.concurrency, results)
+    if server_pid is not None:
+        results['server_rss_kb']['connected'] = rss_kb(server_pid)
+    await run_phase('accounts', clients, lambda c: c.create_account(), args.concurrency, results)
+
+    # Clients 2n and 2n + 1 are partners
+    partners = {c.index: clients[c.index ^ 1] for c in clients}
+    await run_phase('contacts', clients, lambda c: c.connect_with_contact(partners[c.index].uuid),
+                    args.concurrency, results)
+
+    interval = 1 / args.rate if args.rate else 0
+    start = time.perf_counter()
+    await asyncio.gather(*(c.send_messages(partners[c.index].uuid, args.messages, args.size, interval)
+                           for c in clients))
+    try:
+        await asyncio.wait_for(stats['done'].wait(), args.timeout)
+    except asyncio.TimeoutError:
+        print(f"Timeout: {stats['received']} of {stats['expected']} messages received")
+    elapsed = time.perf_counter() - start
+    results['messages'] = {
+        'sent': stats['sent'],
+        'received': stats['received'],
+        'seconds': round(elapsed, 3),
+        'rate': round(stats['received'] / elapsed, 1),
+        'latency_ms': percentiles(stats['latencies'])
+    }
+    print(f"  messages: {stats['received']} of {stats['sent']} in {elapsed:.2f}s, "
+          f"{stats['received'] / elapsed:.1f}/s, latency {results['messages']['latency_ms']}")
+
+    if sampler is not None:
+        sampler.cancel()
+        results['server_rss_kb']['peak'] = max(rss_samples, default=0)
+        print(f"server rss: {results['server_rss_kb']}")
+    results['errors'] = stats['errors'][:20]
+    for c in clients:
+        c.close()
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=SRC_DIR,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--clients', type=int, default=1000, help="Simulated clients, rounded up to an even number")
+    parser.add_argument('--messages', type=int, default=20, help="Messages per client")
+    parser.add_argument('--size', type=int, default=256, help="Message size in bytes")
+    parser.add_argument('--rate', type=float, default=0, help="Messages per second per client, 0 for unthrottled")
+    parser.add_argument('--concurrency', type=int, default=200, help="Parallel connects and requests")
+    parser.add_argument('--timeout', type=float, default=120, help="Seconds to wait for all messages")
+    parser.add_argument('--engine', choices=['threaded', 'async'], default='async')
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=34500)
+    parser.add_argument('--external', action='store_true', help="Use an already running server at --host/--port")
+    parser.add_argument('--output', default='load_test.json', help="JSON file for the results")
+    args = parser.parse_args()
+    args.clients += args.clients % 2
+
+    raise_file_limit(args.clients + FILE_LIMIT_HEADROOM)
+
+    server = None
+    db_dir = tempfile.mkdtemp(prefix="oqs-load-test-")
+    if not args.external:
+        server = subprocess.Popen([
+            sys.executable, 'start_server.py', '--engine', args.engine, '--port', str(args.port),
+            '--workers', str(args.workers), '--backlog', '4096', '--db', os.path.join(db_dir, 'server.db')
+        ], cwd=SRC_DIR, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        asyncio.run(wait_for_server(args.host, args.port))
+        results = asyncio.run(run_load_test(args, server.pid if server is not None else None))
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+        shutil.rmtree(db_dir, ignore_errors=True)
+
+    report = {
+        'commit': git_commit(),
+        'timestamp': int(time.time()),
+        'python': platform.python_version(),
+        'config': {key: value for key, value in vars(args).items() if key != 'output'},
+        'results': results
+    }
+    with open(args.output, 'w') as output_file:
+        json.dump(report, output_file, indent=2)
+    print(f"Results written to {args.output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,188 @@
+from threading import Thread, Condition
+import logging
+import mmap
+import os
+
+from util.wire_format import pack_attachment_chunk
+
+# Plaintext bytes per chunk. Chunks are interleaved with chat traffic on the same connection,
+# so a chunk never blocks other frames for long
+ATTACHMENT_CHUNK_SIZE = 64 * 1024
+# Chunks a sender sends ahead of the last acknowledged offset
+ATTACHMENT_WINDOW = 16
+# Seconds without acknowledgement, before the unacknowledged chunks are sent again
+ATTACHMENT_ACK_TIMEOUT = 10.0
+
+
+class OutgoingTransfer():
+    """File sent to a contact in chunks, each encrypted at its offset in the file.
+    The file is memory-mapped, so chunks are read from the page cache without loading the
+    whole file. At most `window` chunks are sent ahead of the acknowledged offset. Nothing is
+    sent, before the receiver answered the offer with the offset to start from. An answer with
+    an older offset, or an acknowledgement timeout, sends the chunks after it again.
+    """
+
+    def __init__(self, transfer_id: str, contact_uuid: str, session_id: str, path: str, size: int, cipher, send,
+                 acknowledged: int = 0, chunk_size: int = ATTACHMENT_CHUNK_SIZE, window: int = ATTACHMENT_WINDOW,
+                 ack_timeout: float = ATTACHMENT_ACK_TIMEOUT):
+        self.__logger = logging.getLogger(__name__)
+        self.transfer_id = transfer_id
+        self.contact_uuid = contact_uuid
+        self.session_id = session_id
+        self.path = path
+        self.size = size
+        self.__cipher = cipher
+        self.__send = send
+        self.__chunk_size = chunk_size
+        self.__window_size = window * chunk_size
+        self.__ack_timeout = ack_timeout
+        self.__condition = Condition()
+        self.__acknowledged = acknowledged
+        # Offset of the next chunk. None until the receiver answered the offer
+        self.__next_offset = None
+        self.__closed = False
+        self.__thread = Thread(target=self.__run, name=f"Attachment-{transfer_id[:8]}", daemon=True)
+
+    @property
+    def acknowledged(self) -> int:
+        return self.__acknowledged
+
+    @property
+    def done(self) -> bool:
+        return self.__acknowledged >= self.size
+
+    def start(self):
+        self.__thread.start()
+
+    def acknowledge(self, offset: int):
+        """Called with every ATTACHMENT_ACK of the receiver. Acknowledgements of chunks always
+        advance the offset, so an offset, that does not, answers an offer and sending restarts there.
+
+        Parameters
+        ----------
+        offset : int
+            Bytes the receiver has written, from the start of the file
+        """
+        with self.__condition:
+            if self.__next_offset is None or offset <= self.__acknowledged:
+                self.__next_offset = offset
+            self.__acknowledged = offset
+            self.__next_offset = max(self.__next_offset, offset)
+            self.__condition.notify_all()
+
+    def close(self):
+        with self.__condition:
+            self.__closed = True
+            self.__condition.notify_all()
+
+    def __next_chunk_offset(self):
+        """Block until the window allows the next chunk. None once the transfer is done or closed
+        """
+        with self.__condition:
+            while True:
+                if self.__closed or self.done:
+                    return None
+                if self.__next_offset is not None and \
+                        self.__next_offset < min(self.size, self.__acknowledged + self.__window_size):
+                    offset = self.__next_offset
+                    self.__next_offset = min(offset + self.__chunk_size, self.size)
+                    return offset
+                if not self.__condition.wait(self.__ack_timeout) and self.__next_offset is not None:
+                    # Chunks or acknowledgements got lost, e.g. while the contact was offline
+                    self.__next_offset = self.__acknowledged
+
+    def __run(self):
+        try:
+            with open(self.path, 'rb') as file:
+                if self.size == 0:
+                    self.__next_chunk_offset()
+                    return
+                with mmap.mmap(file.fileno(), self.size, access=mmap.ACCESS_READ) as mapped, \
+                        memoryview(mapped) as view:
+                    while True:
+                        offset = self.__next_chunk_offset()
+                        if offset is None:
+                            return
+                        end = min(offset + self.__chunk_size, self.size)
+                        chunk = self.__cipher.apply(view[offset:end], offset)
+                        self.__send(pack_attachment_chunk(self.contact_uuid, self.transfer_id, self.session_id,
+                                                          offset, chunk))
+        except (OSError, ValueError) as e:
+            self.__logger.error(f"Transfer {self.transfer_id} of {self.path} stopped: {e}")
+
+
+class IncomingTransfer():
+    """File received from a contact. Chunks are only written in order, so `received` is
+    always the length of the complete prefix, which is what gets acknowledged. The file is
+    written to a `.part` file, which is renamed once it is complete.
+    """
+    # Result of `write`
+    WRITTEN = 1
+    IGNORED = 0
+    # The chunk follows a gap, the sender has to go back to `received`
+    GAP = -1
+
+    def __init__(self, transfer_id: str, contact_uuid: str, session_id: str, name: str, path: str, size: int,
+                 cipher, received: int = 0):
+        self.transfer_id = transfer_id
+        self.contact_uuid = contact_uuid
+        self.session_id = session_id
+        self.name = name
+        self.path = path
+        self.size = size
+        self.received = received
+        self.__cipher = cipher
+        self.__part_path = path + ".part"
+        self.__file = None
+        # Offset, the sender was last asked to go back to. Asked once per gap
+        self.__gap_reported = None
+        if self.done:
+            return
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.__file = os.fdopen(os.open(self.__part_path, os.O_RDWR | os.O_CREAT, 0o600), 'r+b')
+        if size == 0:
+            self.__complete()
+
+    @property
+    def done(self) -> bool:
+        return self.received >= self.size and self.__file is None
+
+    def write(self, offset: int, data) -> int:
+        """Decrypt and write a chunk. Chunks before the received prefix are duplicates and ignored.
+        Chunks after it follow a lost chunk, the first one of them is reported as GAP.
+
+        Parameters
+        ----------
+        offset : int
+            Position of the chunk in the file
+        data : bytes-like
+            Encrypted chunk
+
+        Returns
+        -------
+        int
+            WRITTEN, IGNORED or GAP
+        """
+        if self.__file is None or offset < self.received or offset + len(data) > self.size:
+            return self.IGNORED
+        if offset > self.received:
+            if self.__gap_reported == self.received:
+                return self.IGNORED
+            self.__gap_reported = self.received
+            return self.GAP
+        self.__file.seek(offset)
+        self.__file.write(self.__cipher.apply(data, offset))
+        self.received += len(data)
+        if self.received == self.size:
+            self.__complete()
+        return self.WRITTEN
+
+    def __complete(self):
+        self.__file.close()
+        self.__file = None
+        os.replace(self.__part_path, self.path)
+
+    def close(self):
+        if self.__file is not None:
+            self.__file.close()
+            self.__file = None
@@ -0,0 +1,150 @@
+from collections import OrderedDict
+from threading import Lock
+
+# Contacts, and sessions and ciphers derived from their secrets, kept in memory
+CONTACT_CACHE_SIZE = 1024
+
+
+class LRUCache():
+    """Bounded mapping, that evicts the least recently used entry. Thread safe.
+    Used for everything kept per contact or session, so secrets of contacts, that
+    are not in use, don't stay in memory.
+    """
+
+    def __init__(self, capacity: int = CONTACT_CACHE_SIZE):
+        self.__capacity = capacity
+        self.__entries = OrderedDict()
+        self.__lock = Lock()
+
+    def __len__(self) -> int:
+        return len(self.__entries)
+
+    def get(self, key, default=None):
+        with self.__lock:
+            if key not in self.__entries:
+                return default
+            self.__entries.move_to_end(key)
+            return self.__entries[key]
+
+    def put(self, key, value):
+        with self.__lock:
+            self.__entries[key] = value
+            self.__entries.move_to_end(key)
+            if len(self.__entries) > self.__capacity:
+                self.__entries.popitem(last=False)
+
+
+class Contact():
+    """Contact with the shared secret of its current KEM encapsulation.
+    Uses `__slots__`, as bots and bridges may keep many contacts in memory.
+    """
+    __slots__ = ('contact_name', 'contact_uuid', 'contact_pub_key', 'shared_ciphertext', 'shared_secret')
+
+    def __init__(self, contact_name: str, contact_uuid: str, contact_pub_key: bytes,
+                 shared_ciphertext: bytes, shared_secret: bytes):
+        self.contact_name = contact_name
+        self.contact_uuid = str(contact_uuid)
+        self.contact_pub_key = contact_pub_key
+        self.shared_ciphertext = shared_ciphertext
+        self.shared_secret = shared_secret
+
+    @classmethod
+    def from_row(cls, row) -> 'Contact':
+        """Create a contact from a row of the `contacts` table
+        """
+        return cls(
+            contact_name=row['name'],
+            contact_uuid=row['uuid'],
+            contact_pub_key=row['public_key'],
+            shared_ciphertext=row['shared_ciphertext'],
+            shared_secret=row['shared_secret']
+        )
+
+    def __repr__(self):
+        return f"Contact(contact_name={self.contact_name!r}, contact_uuid={self.contact_uuid!r})"
+
+
+class ContactStore():
+    """Contacts keyed by UUID. Contacts are loaded lazily from the `contacts` table
+    and the most recently used ones are kept in a bounded LRU cache.
+    """
+
+    def __init__(self, connection, capacity: int = CONTACT_CACHE_SIZE, lock=None):
+        self.__connection = connection
+        self.__capacity = capacity
+        self.__contacts = OrderedDict()
+        # Can be shared with other writers of the connection
+        self.__lock = lock or Lock()
+
+    def __cache(self, contact: Contact):
+        self.__contacts[contact.contact_uuid] = contact
+        self.__contacts.move_to_end(contact.contact_uuid)
+        if len(self.__contacts) > self.__capacity:
+            self.__contacts.popitem(last=False)
+
+    def get(self, contact_uuid: str):
+        """Contact with specified UUID, or None if it is unknown
+        """
+        contact_uuid = str(contact_uuid)
+        with self.__lock:
+            contact = self.__contacts.get(contact_uuid)
+            if contact is not None:
+                self.__contacts.move_to_end(contact_uuid)
+                return contact
+            row = self.__connection.execute("SELECT * FROM contacts WHERE uuid = :uuid",
+                                            {"uuid": contact_uuid}).fetchone()
+            if row is None:
+                return None
+            contact = Contact.from_row(row)
+            self.__cache(contact)
+            return contact
+
+    def add_many(self, contacts: list):
+        """Add new contacts to the database, in a single transaction
+        """
+        with self.__lock:
+            with self.__connection:
+                self.__connection.executemany("""
+                    INSERT INTO contacts
+                    VALUES (
+                        :uuid,
+                        :name,
+                        :publicKey,
+                        :sharedSecret,
+                        :sharedCiphertext
+                    )
+                """, [{
+                    "uuid": contact.contact_uuid,
+                    "name": contact.contact_name,
+                    "publicKey": contact.contact_pub_key,
+                    "sharedSecret": contact.shared_secret,
+                    "sharedCiphertext": contact.shared_ciphertext
+                } for contact in contacts])
+            for contact in contacts:
+                self.__cache(contact)
+
+    def update_secret(self, contact: Contact, shared_ciphertext: bytes, shared_secret: bytes) -> Contact:
+        """Replace the shared secret of a contact, e.g. after a rotation
+
+        Returns
+        -------
+        Contact
+            Updated contact
+        """
+        updated_contact = Contact(
+            contact_name=contact.contact_name,
+            contact_uuid=contact.contact_uuid,
+            contact_pub_key=contact.contact_pub_key,
+            shared_ciphertext=shared_ciphertext,
+            shared_secret=shared_secret
+        )
+        with self.__lock:
+            with self.__connection:
+                self.__connection.execute("""
+                    UPDATE contacts SET public_key = :publicKey, shared_secret = :sharedSecret,
+                        shared_ciphertext = :sharedCiphertext
+                    WHERE uuid = :uuid
+                """, {"publicKey": contact.contact_pub_key, "sharedSecret": shared_secret,
+                      "sharedCiphertext": shared_ciphertext, "uuid": contact.contact_uuid})
+            self.__cache(updated_contact)
+        return updated_contact
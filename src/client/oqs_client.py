@@ -1,15 +1,29 @@
 import oqs
-from threading import Thread
-from socket import AF_INET, socket, SOCK_STREAM
+from threading import Thread, Lock, RLock
+from socket import AF_INET, socket, SOCK_STREAM, SHUT_RDWR
 import ssl
 import logging
 from util.oqs_utils import RequestType
+from util.frame_codec import FrameDecoder, ConnectionClosedError, send_frame
+from util.wire_format import WIRE_FORMAT_JSON, WIRE_FORMAT_BINARY, FrameKind, is_binary_frame, frame_kind, \
+    pack_send_message, unpack_deliver_message, SESSION_ID_SIZE, MAX_GROUP_MEMBERS, GroupMember, pack_group_send, \
+    unpack_group_deliver, unpack_attachment_chunk, pack_attachment_ack, unpack_attachment_ack, CAPABILITY_SESSIONS, \
+    MALFORMED_FRAME_ERRORS
+from util.message_cipher import create_cipher
+from util.message_compression import SUPPORTED_COMPRESSIONS, compress_message, decompress_message
+from client.contact_store import Contact, ContactStore, LRUCache
+from client.receive_pipeline import KeyedWorkerPool, BatchWorker
+from client.attachment_transfer import OutgoingTransfer, IncomingTransfer, ATTACHMENT_CHUNK_SIZE
 from dataclasses import dataclass
 import base64
 import sqlite3
 import json
 import time
+import random
+import uuid
 import os
+import hashlib
+from collections import Counter, deque
 
 logging.basicConfig(
     format="[%(asctime)s] %(levelname)s: %(message)s",
@@ -22,49 +36,128 @@ client = oqs.KeyEncapsulation(kemalg)
 
 
 @dataclass(eq=True, frozen=True)
-class Contact:
-    contact_name: str
+class Session:
+    session_id: str
     contact_uuid: str
-    contact_pub_key: bytes
-    shared_ciphertext: bytes
     shared_secret: bytes
 
 DB_PATH = "client/pq-chat-client.db"
 TEST_DB_PATH = "test/pq-chat-client.db"
+# Received attachments are saved here
+ATTACHMENT_DIR = "client/attachments"
+TEST_ATTACHMENT_DIR = "test/attachments"
+# Messages per page of `load_chat_history`
+HISTORY_PAGE_SIZE = 50
+# Bytes of frames, that are kept while the client reconnects. Sends beyond that fail.
+# A single bigger frame is kept, if nothing else is waiting
+PENDING_FRAMES_SIZE = 4 * 1024 * 1024
+# Reconnect backoff in seconds. Every attempt waits a random time up to the doubled delay
+RECONNECT_BASE_DELAY = 0.5
+RECONNECT_MAX_DELAY = 30.0
+# Threads for the KEM operations and decryption of incoming messages
+CRYPTO_WORKERS = 4
+# Incoming messages are pushed to the frontend at most every UI_PUSH_INTERVAL seconds,
+# or once UI_PUSH_SIZE messages are waiting
+UI_PUSH_INTERVAL = 0.016
+UI_PUSH_SIZE = 100
+# Maximum messages of one `load_history_since` response
+HISTORY_SYNC_LIMIT = 500
+# Size of the random key, a group message body is encrypted with
+GROUP_MESSAGE_KEY_SIZE = 32
+# Heartbeat intervals without anything received, before the connection is considered dead.
+# The server answers every heartbeat, so this allows one lost heartbeat
+HEARTBEAT_MISSES = 2
+# Refusals of an offline batch in a row, before its messages, that can not be persisted, are given up
+OFFLINE_BATCH_ATTEMPTS = 3
+# Received messages, whose outcome is checked at the end of an offline batch. Bigger than the batches of the server
+OFFLINE_BATCH_WINDOW = 4096
+# Cached lookups, that found nothing, are cached as None
+_NOT_CACHED = object()
+
 
 class OQSClient():
     """OQS client class. Use in combination with the OQSServer and at least one other client,
     to establish a communication.
     """
 
-    def __init__(self, eel, name: str, port: int = 33000, hostname='localhost', bufsize: int = 100000, test=False, other_db_path = None):
+    def __init__(self, eel, name: str, port: int = 33000, hostname='localhost', bufsize: int = 100000, test=False, other_db_path = None,
+                 reconnect: bool = True):
         self._eel = eel
         self._logger = logging.getLogger(__name__)
         self._logger.setLevel(logging.DEBUG)
         self._name = name
         self._receive_thread = Thread(target=self._receive_msg)
+        self._heartbeat_thread = Thread(target=self._send_heartbeats, name="ClientHeartbeat", daemon=True)
         self._other_db_path = other_db_path
 
-        _context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
-        _context.verify_mode = ssl.CERT_REQUIRED
+        self._context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+        self._context.verify_mode = ssl.CERT_REQUIRED
         dirname = os.path.dirname(__file__)
-        _context.load_verify_locations(os.path.join(dirname, '../pqca/ca/falcon512_CA.crt'))
-
-        _socket_temp = socket(AF_INET, SOCK_STREAM, 0)
-        self._socket = _context.wrap_socket(_socket_temp, server_hostname=hostname, server_side=False)
+        self._context.load_verify_locations(os.path.join(dirname, '../pqca/ca/falcon512_CA.crt'))
+        # TLS session of the last connection. Reconnects resume it, instead of a full handshake
+        self._tls_session = None
+        self._socket = None
+        # Guards the socket, while the receive thread reconnects
+        self._send_lock = Lock()
+        self._connected = False
+        # Frames sent while reconnecting, up to PENDING_FRAMES_SIZE bytes. Sent after the login
+        self._pending_frames = []
+        self._pending_bytes = 0
+        # Announced by the server in the HELLO_RESPONSE. None, if it has no idle timeout
+        self._heartbeat_interval = None
+        # Monotonic time of the last frame sent to, and the last data received from the server
+        self._last_sent = time.monotonic()
+        self._last_received = time.monotonic()
+        self._reconnect = reconnect
+        self._closed = False
+        self.__uuid = None
+        self.__pub_key = None
         self._host = hostname
         self._port = port
         self._bufsize = bufsize
         self._address = (hostname, port)
         self._connecte_with_second_client = False
-        self._contacts = []
+        # Message cipher per shared secret, reused for every message. Like the contacts, the caches
+        # per secret, session and contact are bounded, evicted entries are loaded from the database again
+        self._ciphers = LRUCache()
+        # Session id -> Session, and contact UUID -> id of the newest session
+        self._sessions = LRUCache()
+        self._outgoing_sessions = LRUCache()
+        # Session id -> compression, the contact can decompress, or None
+        self._session_compressions = LRUCache()
+        # Contact UUID -> True, if the client of the contact establishes sessions
+        self._contact_sessions = LRUCache()
+        # Group id -> name, of the groups known so far
+        self._group_names = {}
+        # Transfer id -> OutgoingTransfer or IncomingTransfer, while the transfer runs
+        self._outgoing_transfers = {}
+        self._incoming_transfers = {}
         self._test = test
+        # JSON until the server accepted the binary format
+        self._wire_format = WIRE_FORMAT_JSON
 
         # DB Preparation
         self._setup_db()
-        self._load_contacts()
+        # The receive thread and the frontend write through the same connection. Without the
+        # lock, both can try to start the implicit transaction at the same time
+        self._db_lock = RLock()
+        # Contacts are loaded on first use
+        self._contacts = ContactStore(self._connection, lock=self._db_lock)
         self._client_has_acccount = self._check_if_client_has_account()
 
+        # Receive pipeline: the receive thread only reads and decodes frames. KEM operations and
+        # decryption run on the crypto workers, keyed by sender to keep its messages in order.
+        # Decrypted messages are written in batches, then passed on to the frontend
+        self._crypto_workers = KeyedWorkerPool(CRYPTO_WORKERS, name="ClientCrypto")
+        self._persist_stage = BatchWorker(self._persist_batch, name="ClientPersist")
+        # (Digest, task) of the messages, received since the last offline batch ended. Only used by the receive thread
+        self._batch_outcomes = deque(maxlen=OFFLINE_BATCH_WINDOW)
+        # Digests of the messages of a refused offline batch, that were persisted. Skipped, when it is sent again
+        self._persisted_digests = Counter()
+        self._batch_refusals = 0
+        self._ui_stage = BatchWorker(self._dispatch_to_frontend, max_batch_size=UI_PUSH_SIZE,
+                                     batch_window=UI_PUSH_INTERVAL, name="ClientFrontend")
+
     def _setup_db(self):
         """Ran at every initialization. Sets up SQLLite DB with the `setup-client.sql` file
         """
@@ -89,137 +182,535 @@ class OQSClient():
         bool
             True if it is not the first time for the client, logging in.
         """
-        rows = self._cursor.execute("SELECT * FROM personal_information").fetchall()
+        rows = self._connection.execute("SELECT * FROM personal_information").fetchall()
         return len(rows) >= 1
 
-    def _load_contacts(self):
-        """Load contacts from the database in the cache, for quicker access
-        """
-        contacts = self._cursor.execute("SELECT * FROM contacts").fetchall()
-        for db_contact in contacts:
-            contact = Contact(
-                contact_name=db_contact['name'],
-                contact_uuid=db_contact['uuid'],
-                contact_pub_key=db_contact['public_key'],
-                shared_ciphertext=db_contact['shared_ciphertext'],
-                shared_secret=db_contact['shared_secret']
-            )
-            self._contacts.append(contact)
+    def _create_socket(self):
+        """Create a TLS socket and connect it with the server. The handshake resumes the
+        TLS session of the previous connection, if there is one and the server still accepts it.
+        """
+        sock = self._context.wrap_socket(socket(AF_INET, SOCK_STREAM, 0), server_hostname=self._host,
+                                         server_side=False, session=self._tls_session)
+        try:
+            sock.connect(self._address)
+        except OSError:
+            sock.close()
+            raise
+        return sock
 
     def connect(self):
         """Connect with OQSServer. If the client is new, a NEW_ACCOUNT_REQUEST
         is sent to retrieve a UUID and Seed Phrase from the server.
         Otherwise a LOGIN_REQUEST is sent.
+        If the connection is lost later, the client reconnects in the background.
         """
         try:
-            self._socket.connect(self._address)
+            self._socket = self._create_socket()
         except ConnectionRefusedError:
             self._logger.error(f"Unable to connect with server. Address: {self._address}")
             raise
 
         self._logger.info(f"Connected with host {self._host} on port {self._port}")
+        json_data = self._greet_server()
+        self._receive_thread.start()
+        self._heartbeat_thread.start()
+        return json_data
 
-        # If client is new, the server needs to generate a UUID
-        if not self._client_has_acccount:
-            self._logger.info(f"No Account found!")
-            self.__pub_key = client.generate_keypair()
-            self.__private_key = client.export_secret_key()
-            payload = {}
-            payload['requestType'] = RequestType.NEW_ACCOUNT_REQUEST
-            payload['publicKey'] = base64.b64encode(self.__pub_key).decode('ascii')
-            payload['name'] = self._name
-            json_data = json.dumps(payload)
-            self._socket.send(json_data.encode())
-        else:
-            # Logging in
-            self._logger.info("Logging in")
-            self._cursor.execute('select * from personal_information')
-            personal_information = self._cursor.fetchone()
-            self.__uuid = personal_information['uuid']
+    def _greet_server(self):
+        """Negotiate the wire format and log in, or create the account. Frames, that were
+        sent while disconnected, follow the login.
+
+        Returns
+        -------
+        str
+            JSON of the login or new account request
+        """
+        global client
+        with self._send_lock:
+            # Offer the binary wire format. Answered with a HELLO_RESPONSE
             payload = {}
-            payload['requestType'] = RequestType.LOGIN_REQUEST
-            payload['UUID'] = self.__uuid
-            payload['seedHash'] = base64.b64encode(personal_information['seed_hash']).decode('ascii')
-            json_data = json.dumps(payload)
-            self._socket.send(json_data.encode())
-        self._receive_thread.start()
+            payload['requestType'] = RequestType.HELLO_REQUEST
+            payload['wireFormats'] = [WIRE_FORMAT_BINARY, WIRE_FORMAT_JSON]
+            payload['capabilities'] = [CAPABILITY_SESSIONS]
+            send_frame(self._socket, json.dumps(payload).encode())
+
+            # If client is new, the server needs to generate a UUID
+            if not self._client_has_acccount:
+                self._logger.info(f"No Account found!")
+                if self.__pub_key is None:
+                    self.__pub_key = client.generate_keypair()
+                    self.__private_key = client.export_secret_key()
+                payload = {}
+                payload['requestType'] = RequestType.NEW_ACCOUNT_REQUEST
+                payload['publicKey'] = base64.b64encode(self.__pub_key).decode('ascii')
+                payload['name'] = self._name
+                json_data = json.dumps(payload)
+                send_frame(self._socket, json_data.encode())
+            else:
+                # Logging in
+                self._logger.info("Logging in")
+                if self.__uuid is None:
+                    personal_information = self._connection.execute('select * from personal_information').fetchone()
+                    self.__uuid = personal_information['uuid']
+                    self.__seed_hash = personal_information['seed_hash']
+                    # Restore the KEM secret key, to be able to decapsulate ciphertexts of new contacts
+                    client = oqs.KeyEncapsulation(kemalg, personal_information['private_key'])
+                payload = {}
+                payload['requestType'] = RequestType.LOGIN_REQUEST
+                payload['UUID'] = self.__uuid
+                payload['seedHash'] = base64.b64encode(self.__seed_hash).decode('ascii')
+                json_data = json.dumps(payload)
+                send_frame(self._socket, json_data.encode())
+
+            for frame in self._pending_frames:
+                send_frame(self._socket, frame)
+            self._pending_frames = []
+            self._pending_bytes = 0
+            self._connected = True
+            self._last_sent = self._last_received = time.monotonic()
+
+        if self._client_has_acccount:
+            self._resend_unacknowledged_sessions()
+            self._resume_attachments()
         return json_data
 
-    def _xor_msg_with_shared_secret(self, msg: bytes, secret: bytes) -> bytes:
-        """Used for the encryption of messages with the shared secret
+    def _send(self, data: bytes, buffer: bool = True):
+        """Send a frame to the server. While the client reconnects, frames are kept and sent after the login
 
         Parameters
         ----------
-        msg : bytes
-            String message as byte
-        secret : bytes
-            Shared secret with second client
+        data : bytes
+            Frame payload
+        buffer : bool, optional
+            Keep the frame while the client reconnects, by default True. Attachment frames are dropped
+            instead, as the transfers are resumed from the acknowledged offset after the login
+
+        Raises
+        ------
+        ConnectionError
+            If the client is not connected and does not reconnect, or PENDING_FRAMES_SIZE bytes are already waiting
+        """
+        with self._send_lock:
+            if self._connected:
+                try:
+                    send_frame(self._socket, data)
+                    self._last_sent = time.monotonic()
+                    return
+                except OSError as e:
+                    self._logger.warning(f"Sending to server failed: {e}")
+                    self._connected = False
+            if not self._reconnect or self._closed:
+                raise ConnectionError("Not connected with server")
+            if not buffer:
+                return
+            if self._pending_frames and self._pending_bytes + len(data) > PENDING_FRAMES_SIZE:
+                raise ConnectionError(f"Not connected with server and {self._pending_bytes} bytes are waiting")
+            self._pending_frames.append(data)
+            self._pending_bytes += len(data)
+
+    def _reconnect_with_backoff(self):
+        """Reconnect, until it succeeds or the client is closed. Attempts are spread with exponential
+        backoff and full jitter, so clients, that lost the connection at the same time, don't all
+        come back at once. Contacts, sessions and ciphers stay in memory, only the TLS handshake
+        and the login are repeated.
+        """
+        self._socket.close()
+        attempt = 0
+        while not self._closed:
+            time.sleep(random.uniform(0, min(RECONNECT_MAX_DELAY, RECONNECT_BASE_DELAY * 2 ** min(attempt, 16))))
+            try:
+                self._socket = self._create_socket()
+                self._greet_server()
+            except OSError as e:
+                attempt += 1
+                self._logger.warning(f"Reconnect attempt {attempt} failed: {e}")
+                continue
+            self._logger.info(f"Reconnected with host {self._host}. TLS session resumed: {self._socket.session_reused}")
+            return
+
+    def _send_heartbeats(self):
+        """Send a HEARTBEAT_REQUEST, once nothing was sent or received for the heartbeat interval,
+        so the server doesn't close the connection as idle. Its answer keeps the connection alive
+        in this direction. A connection, that received nothing for HEARTBEAT_MISSES intervals,
+        is shut down, so the receive thread reconnects
+        """
+        while not self._closed:
+            interval = self._heartbeat_interval
+            if interval is None:
+                # Not announced yet, or the server never closes idle connections
+                time.sleep(1.0)
+                continue
+            time.sleep(interval / 2)
+            if not self._connected or self._closed:
+                continue
+            now = time.monotonic()
+            if now - self._last_received > HEARTBEAT_MISSES * interval:
+                self._logger.warning(f"Nothing received from the server for {now - self._last_received:.0f}s")
+                try:
+                    self._socket.shutdown(SHUT_RDWR)
+                except OSError:
+                    pass
+            elif now - min(self._last_sent, self._last_received) >= interval:
+                payload = {}
+                payload['requestType'] = RequestType.HEARTBEAT_REQUEST
+                try:
+                    self._send(json.dumps(payload).encode())
+                except ConnectionError:
+                    pass
+
+    def close(self):
+        """Close the connection with the server, without reconnecting
+        """
+        self._closed = True
+        with self._send_lock:
+            self._connected = False
+        for transfer in list(self._outgoing_transfers.values()) + list(self._incoming_transfers.values()):
+            transfer.close()
+        self._crypto_workers.close()
+        self._persist_stage.close()
+        self._ui_stage.close()
+        if self._socket is not None:
+            try:
+                # Wakes up the receive thread
+                self._socket.shutdown(SHUT_RDWR)
+            except OSError:
+                pass
+            self._socket.close()
+
+    def _cipher_for(self, shared_secret: bytes):
+        """Used for the en- and decryption of messages with a shared secret.
+        The cipher and its keystream are cached per secret, so per contact session.
+
+        Parameters
+        ----------
+        shared_secret : bytes
+            Shared secret with the contact
 
         Returns
         -------
-        bytes
-            Encrypted message
+        MessageCipher
+            Cipher for the shared secret
         """
-        origin_secret = secret
-        while len(msg) > len(secret):
-            secret = secret + origin_secret
-        return bytes([_a ^ _b for _a, _b in zip(msg, secret)])
+        cipher = self._ciphers.get(shared_secret)
+        if cipher is None:
+            cipher = create_cipher(shared_secret)
+            self._ciphers.put(shared_secret, cipher)
+        return cipher
+
+    def _contact_with_uuid(self, contact_uuid: str):
+        """Search for a known contact with specified UUID
+        """
+        return self._contacts.get(contact_uuid)
+
+    def _add_contact(self, contact: Contact):
+        """Add a new contact to the cache and the database
+        """
+        self._add_contacts([contact])
+
+    def _add_contacts(self, contacts: list):
+        """Add new contacts to the cache and the database, in a single transaction
+        """
+        self._contacts.add_many(contacts)
+
+    def _session_with_id(self, session_id: str):
+        """Search for a session with specified id, in the cache or the database
+        """
+        session = self._sessions.get(session_id)
+        if session is None:
+            with self._db_lock:
+                row = self._connection.execute("SELECT * FROM sessions WHERE session_id = :sessionId",
+                                               {"sessionId": session_id}).fetchone()
+            if row is not None:
+                session = Session(
+                    session_id=row['session_id'],
+                    contact_uuid=row['contact'],
+                    shared_secret=row['shared_secret']
+                )
+                self._sessions.put(session_id, session)
+        return session
+
+    def _save_session(self, session: Session, shared_ciphertext: bytes, initiated_by: str):
+        """Persist a new session. Sessions initiated by the contact are acknowledged right away
+        """
+        self._sessions.put(session.session_id, session)
+        self._outgoing_sessions.put(session.contact_uuid, session.session_id)
+        with self._db_lock:
+            self._connection.execute("""
+                INSERT INTO sessions 
+                VALUES (
+                    :sessionId, 
+                    :contact, 
+                    :sharedSecret,
+                    :sharedCiphertext,
+                    :initiatedBy,
+                    :acknowledged,
+                    :date
+                ) 
+            """, {
+                "sessionId": session.session_id,
+                "contact": session.contact_uuid,
+                "sharedSecret": session.shared_secret,
+                "sharedCiphertext": shared_ciphertext,
+                "initiatedBy": initiated_by,
+                "acknowledged": 1 if initiated_by == "CONTACT" else 0,
+                "date": int(time.time())
+            })
+            self._connection.commit()
+
+    def _compression_for(self, session_id: str):
+        """Compression, the contact announced for the session, or None. Messages to contacts
+        with older clients are never compressed.
+        """
+        compression = self._session_compressions.get(session_id, _NOT_CACHED)
+        if compression is _NOT_CACHED:
+            with self._db_lock:
+                row = self._connection.execute("""
+                    SELECT compression FROM session_compressions WHERE session_id = :sessionId
+                """, {"sessionId": session_id}).fetchone()
+            compression = row['compression'] if row is not None else None
+            self._session_compressions.put(session_id, compression)
+        return compression
+
+    def _save_compression(self, session_id: str, compressions):
+        """Remember the first compression, that both sides support, of the ones the contact announced.
+        The cache is updated right away, the database with the next batch of the persist stage
+        """
+        compression = next((name for name in compressions or [] if name in SUPPORTED_COMPRESSIONS), None)
+        if compression is None:
+            return
+        self._session_compressions.put(session_id, compression)
+        self._persist_stage.put(("""
+            INSERT OR REPLACE INTO session_compressions VALUES (:sessionId, :compression)
+        """, {"sessionId": session_id, "compression": compression}, None))
+
+    def _supports_sessions(self, contact_uuid: str) -> bool:
+        """Check if the client of the contact establishes sessions. Contacts, the server never
+        reported otherwise, are assumed to
+        """
+        sessions = self._contact_sessions.get(contact_uuid)
+        if sessions is None:
+            with self._db_lock:
+                row = self._connection.execute("""
+                    SELECT sessions FROM contact_capabilities WHERE contact = :contact
+                """, {"contact": contact_uuid}).fetchone()
+            sessions = bool(row['sessions']) if row is not None else True
+            self._contact_sessions.put(contact_uuid, sessions)
+        return sessions
+
+    def _save_sessions_support(self, contact_uuid: str, sessions: bool):
+        """Remember, if the client of the contact establishes sessions. The cache is updated
+        right away, the database with the next batch of the persist stage
+        """
+        if self._supports_sessions(contact_uuid) == sessions:
+            return
+        self._contact_sessions.put(contact_uuid, sessions)
+        self._persist_stage.put(("""
+            INSERT OR REPLACE INTO contact_capabilities VALUES (:contact, :sessions)
+        """, {"contact": contact_uuid, "sessions": int(sessions)}, None))
+
+    def _outgoing_session(self, contact: Contact):
+        """Newest session with the contact. If there is none yet, it is established
+        with the shared secret of the contact.
+        """
+        session_id = self._outgoing_sessions.get(contact.contact_uuid)
+        if session_id is None:
+            row = self._connection.execute("""
+                SELECT session_id FROM sessions WHERE contact = :contact ORDER BY date DESC, rowid DESC LIMIT 1
+            """, {"contact": contact.contact_uuid}).fetchone()
+            if row is None:
+                return self._establish_session(contact)
+            session_id = row['session_id']
+            self._outgoing_sessions.put(contact.contact_uuid, session_id)
+        return self._session_with_id(session_id)
+
+    def _establish_session(self, contact: Contact):
+        """Start a new session with the contact. The KEM ciphertext is sent once
+        with a SESSION_INIT_REQUEST, messages afterwards only carry the session id.
+        """
+        session = Session(
+            session_id=os.urandom(SESSION_ID_SIZE).hex(),
+            contact_uuid=contact.contact_uuid,
+            shared_secret=contact.shared_secret
+        )
+        self._logger.info(f"Establishing session {session.session_id} with {contact.contact_uuid}")
+        self._save_session(session, contact.shared_ciphertext, initiated_by="ME")
+        self._send_session_init(session.session_id, contact.contact_uuid, contact.shared_ciphertext)
+        return session
+
+    def _send_session_init(self, session_id: str, contact_uuid: str, shared_ciphertext: bytes):
+        payload = {}
+        payload['requestType'] = RequestType.SESSION_INIT_REQUEST
+        payload['contactUUID'] = contact_uuid
+        payload['sessionId'] = session_id
+        payload['ciphertext'] = base64.b64encode(shared_ciphertext).decode('ascii')
+        # Older clients ignore it and are never sent compressed messages
+        payload['compressions'] = SUPPORTED_COMPRESSIONS
+        json_data = json.dumps(payload)
+        self._send(json_data.encode())
+
+    def _resend_unacknowledged_sessions(self):
+        """Sessions, that were never acknowledged, may not have reached the contact. Send them again
+        """
+        rows = self._connection.execute("""
+            SELECT session_id, contact, shared_ciphertext FROM sessions WHERE initiated_by = 'ME' AND acknowledged = 0
+        """).fetchall()
+        for row in rows:
+            self._send_session_init(row['session_id'], row['contact'], row['shared_ciphertext'])
+
+    def rotate_session(self, contact_uuid: str):
+        """Encapsulate a fresh shared secret with the contact and establish a new session with it.
+        Sessions are never rotated automatically.
+
+        Parameters
+        ----------
+        contact_uuid : str
+            UUID of the contact
+        """
+        contact = self._contact_with_uuid(contact_uuid)
+        contact_pub_key = contact.contact_pub_key
+        if isinstance(contact_pub_key, str):
+            # Contacts added by older versions stored the Base64 encoded key
+            contact_pub_key = base64.b64decode(contact_pub_key)
+        ciphertext, shared_secret = client.encap_secret(contact_pub_key)
+        contact = Contact(
+            contact_name=contact.contact_name,
+            contact_uuid=contact.contact_uuid,
+            contact_pub_key=contact_pub_key,
+            shared_ciphertext=contact.shared_ciphertext,
+            shared_secret=contact.shared_secret
+        )
+        rotated_contact = self._contacts.update_secret(contact, ciphertext, shared_secret)
+        self._establish_session(rotated_contact)
+
+    def _handle_session_init(self, request_json):
+        """Called when a contact established a session. If the sender is unknown,
+        a new contact is created. The shared secret is extracted from the ciphertext.
+        """
+        sender_uuid = request_json['senderUUID']
+        session_id = request_json['sessionId']
+        if self._session_with_id(session_id) is None:
+            ciphertext = base64.b64decode(request_json['ciphertext'])
+            self._logger.info("Generating Shared secret...")
+            shared_secret = client.decap_secret(ciphertext)
+            if self._contact_with_uuid(sender_uuid) is None:
+                self._logger.info("NEW CONTACT")
+                self._add_contact(Contact(
+                    contact_name=request_json['senderName'],
+                    contact_uuid=sender_uuid,
+                    contact_pub_key=base64.b64decode(request_json['senderPublicKey']),
+                    shared_ciphertext=ciphertext,
+                    shared_secret=shared_secret
+                ))
+            session = Session(session_id=session_id, contact_uuid=sender_uuid, shared_secret=shared_secret)
+            self._save_session(session, ciphertext, initiated_by="CONTACT")
+        self._save_compression(session_id, request_json.get('compressions'))
+        self._save_sessions_support(sender_uuid, True)
+
+        payload = {}
+        payload['requestType'] = RequestType.SESSION_ACK_REQUEST
+        payload['contactUUID'] = sender_uuid
+        payload['sessionId'] = session_id
+        payload['compressions'] = SUPPORTED_COMPRESSIONS
+        json_data = json.dumps(payload)
+        self._send(json_data.encode())
+
+    def _handle_session_ack(self, request_json):
+        """Called when a contact confirmed a session. Written with the next batch of the persist stage
+        """
+        self._logger.info(f"Session {request_json['sessionId']} acknowledged")
+        # Before the first message of the session is sent with it
+        session = self._session_with_id(request_json['sessionId'])
+        if session is not None and session.contact_uuid == request_json['senderUUID']:
+            self._save_compression(session.session_id, request_json.get('compressions'))
+        self._persist_stage.put(("""
+            UPDATE sessions SET acknowledged = 1 WHERE session_id = :sessionId AND contact = :contact
+        """, {"sessionId": request_json['sessionId'], "contact": request_json['senderUUID']}, None))
+
+    def _handle_incoming_json_message(self, request_json):
+        """Called when a JSON message from a different client is received.
 
-    def _handle_incoming_message(self, request_json):
-        """Called when a message from a different client is received.
-        If the sender is unknown, a new contact is created and the shared key extracted from the ciphertext.
-        
         Parameters
         ----------
             request_json : dict
                 JSON containing all important parameters
         """
-        # Check if client is known or new
         self._logger.info(f"REQUEST JSON : {request_json}")
+        if 'sessionId' in request_json:
+            return self._handle_incoming_message(
+                sender_uuid=request_json['senderUUID'],
+                session_id=request_json['sessionId'],
+                message=base64.b64decode(request_json['message'])
+            )
+        return self._handle_incoming_legacy_message(request_json)
+
+    def _handle_incoming_message(self, sender_uuid: str, session_id: str, message: bytes):
+        """Called on a crypto worker, when a message from a different client is received.
+        The message is decrypted with the secret of the referenced session.
+
+        Parameters
+        ----------
+            sender_uuid : str
+                UUID of the sender
+            session_id : str
+                Id of the session, the message was encrypted for
+            message : bytes
+                Encrypted message
+
+        Returns
+        -------
+        list
+            Futures of the writes, the message was queued with for the persist stage. Empty, if it was dropped
+        """
+        session = self._session_with_id(session_id)
+        if session is None or session.contact_uuid != sender_uuid:
+            self._logger.warning(f"Unknown session {session_id} of {sender_uuid}. Message dropped")
+            return []
+        sender = self._contact_with_uuid(sender_uuid)
+        decrypted_msg = self._cipher_for(session.shared_secret).apply(message)
+        try:
+            decrypted_msg = decompress_message(decrypted_msg)
+        except ValueError as e:
+            self._logger.warning(f"Message of {sender_uuid} dropped: {e}")
+            return []
+        return [self._save_incoming_message(sender, decrypted_msg.decode())]
+
+    def _handle_incoming_legacy_message(self, request_json):
+        """Called when a message of an older client is received, which carries the KEM ciphertext
+        with every message. If the sender is unknown, a new contact is created and the shared key
+        extracted from the ciphertext.
+        """
+        # Check if client is known or new
         sender_uuid = request_json['senderUUID']
-        sender = next((contact for contact in self._contacts if str(contact.contact_uuid) == sender_uuid), None)
+        sender = self._contact_with_uuid(sender_uuid)
         if sender is None:
             self._logger.info("NEW CONTACT")
             self._logger.info("Generating Shared secret...")
-            self._logger.info(f"REQUEST JSON: {request_json}")
-            shared_secret = client.decap_secret(base64.b64decode(request_json['ciphertext']))
+            ciphertext = base64.b64decode(request_json['ciphertext'])
             sender = Contact(
                 contact_name=request_json['senderName'],
                 contact_uuid=sender_uuid,
                 contact_pub_key=base64.b64decode(request_json['senderPublicKey']),
-                shared_ciphertext=base64.b64decode(request_json['ciphertext']),
-                shared_secret=shared_secret
+                shared_ciphertext=ciphertext,
+                shared_secret=client.decap_secret(ciphertext)
             )
-            self._contacts.append(sender)
-            self._cursor.execute("""
-            INSERT INTO contacts 
-            VALUES (
-                :uuid, 
-                :name, 
-                :publicKey, 
-                :sharedSecret,
-                :sharedCiphertext
-            ) 
-            """, {
-                "uuid": sender_uuid,
-                "name": request_json['senderName'],
-                "publicKey": base64.b64decode(request_json['senderPublicKey']),
-                "sharedSecret": shared_secret,
-                "sharedCiphertext": base64.b64decode(request_json['ciphertext'])
-            })
-            self._connection.commit()
+            self._add_contact(sender)
+            # Answers go the same way, the server never reported the contact
+            self._save_sessions_support(sender_uuid, False)
         else:
             self._logger.info("NO NEW CONTACT")
-        base64_decoded_msg = base64.b64decode(request_json['message'])
-        decrypted_msg = self._xor_msg_with_shared_secret(base64_decoded_msg, secret=sender.shared_secret)
-        msg = decrypted_msg.decode()
+        decrypted_msg = self._cipher_for(sender.shared_secret).apply(base64.b64decode(request_json['message']))
+        return [self._save_incoming_message(sender, decrypted_msg.decode())]
 
+    def _save_incoming_message(self, sender: Contact, msg: str):
+        """Queue a decrypted message for the persist stage, which saves it in the chat history
+        and passes it on to the frontend. Returns the future of the write
+        """
         payload = {}
         payload['message'] = msg
         payload['senderName'] = sender.contact_name
         payload['senderUUID'] = sender.contact_uuid
 
-        self._cursor.execute("""
+        return self._persist_stage.put(("""
             INSERT INTO chat_history 
             VALUES (
                 :message, 
@@ -232,11 +723,253 @@ class OQSClient():
             "contact": sender.contact_uuid,
             "sentBy": "CONTACT",
             "date": int(time.time())
-        })
-        self._connection.commit()
+        }, payload))
 
-        if not self._test:
-            self._eel.handleIncomingMessage(json.dumps(payload))
+    def _handle_group_message(self, sender_uuid: str, group_id: str, session_id: str, wrapped_key: bytes, body: bytes):
+        """Called on a crypto worker, when a group message is received. The message key is
+        unwrapped with the session of the sender, then the body is decrypted with it.
+        The body either creates the group, or is a message to it.
+
+        Parameters
+        ----------
+            sender_uuid : str
+                UUID of the sender
+            group_id : str
+                UUID of the group
+            session_id : str
+                Id of the session, the message key was wrapped for
+            wrapped_key : bytes
+                Encrypted message key
+            body : bytes
+                Body, encrypted with the message key
+
+        Returns
+        -------
+        list
+            Futures of the writes, the message was queued with for the persist stage. Empty, if it was dropped
+        """
+        session = self._session_with_id(session_id)
+        if session is None or session.contact_uuid != sender_uuid:
+            self._logger.warning(f"Unknown session {session_id} of {sender_uuid}. Group message dropped")
+            return []
+        message_key = self._cipher_for(session.shared_secret).apply(wrapped_key)
+        body_json = json.loads(create_cipher(message_key).apply(body).decode())
+        if body_json['type'] == 'create':
+            return self._save_group(group_id, body_json['name'], sender_uuid, body_json['members'])
+        if body_json['type'] == 'message':
+            return [self._save_incoming_group_message(self._contact_with_uuid(sender_uuid), group_id,
+                                                      body_json['message'])]
+        return []
+
+    def _save_group(self, group_id: str, name: str, created_by: str, member_uuids: list):
+        """Queue a group and its members for the persist stage. Members, that are no contacts yet,
+        are requested from the server, so messages to the group can be sent to them too.
+        Returns the futures of the writes
+        """
+        self._group_names[group_id] = name
+        date = int(time.time())
+        writes = [self._persist_stage.put(("""
+            INSERT OR IGNORE INTO chat_groups 
+            VALUES (
+                :groupId, 
+                :name, 
+                :createdBy,
+                :date
+            ) 
+        """, {"groupId": group_id, "name": name, "createdBy": created_by, "date": date}, None))]
+        for member_uuid in member_uuids:
+            writes.append(self._persist_stage.put(("""
+                INSERT OR IGNORE INTO group_members VALUES (:groupId, :contact)
+            """, {"groupId": group_id, "contact": member_uuid}, None)))
+
+        unknown = [member_uuid for member_uuid in member_uuids
+                   if member_uuid != self.__uuid and self._contact_with_uuid(member_uuid) is None]
+        if unknown:
+            self.contacts_connection_request(unknown)
+        return writes
+
+    def _save_incoming_group_message(self, sender: Contact, group_id: str, msg: str):
+        """Queue a decrypted group message for the persist stage, like `_save_incoming_message`.
+        Returns the future of the write
+        """
+        payload = {}
+        payload['message'] = msg
+        payload['senderName'] = sender.contact_name
+        payload['senderUUID'] = sender.contact_uuid
+        payload['groupId'] = group_id
+        payload['groupName'] = self._group_name(group_id)
+
+        return self._persist_stage.put(("""
+            INSERT INTO group_history 
+            VALUES (
+                :message, 
+                :groupId, 
+                :sender,
+                :sentBy,
+                :date
+            ) 
+        """, {
+            "message": msg,
+            "groupId": group_id,
+            "sender": sender.contact_uuid,
+            "sentBy": "CONTACT",
+            "date": int(time.time())
+        }, payload))
+
+    def _group_name(self, group_id: str):
+        """Name of a known group, from the cache or the database. None for unknown groups
+        """
+        name = self._group_names.get(group_id)
+        if name is None:
+            with self._db_lock:
+                row = self._connection.execute("SELECT name FROM chat_groups WHERE group_id = :groupId",
+                                               {"groupId": group_id}).fetchone()
+            if row is not None:
+                name = self._group_names[group_id] = row['name']
+        return name
+
+    def _handle_attachment_offer(self, request_json):
+        """Called on a crypto worker, when a contact offers an attachment, or resumes one.
+        Answered with an ATTACHMENT_ACK of the bytes, that were already received.
+        """
+        sender_uuid = request_json['senderUUID']
+        transfer_id = request_json['transferId']
+        transfer = self._incoming_transfers.get(transfer_id)
+        if transfer is None:
+            session = self._session_with_id(request_json['sessionId'])
+            if session is None or session.contact_uuid != sender_uuid:
+                self._logger.warning(f"Unknown session {request_json['sessionId']} of {sender_uuid}. Offer dropped")
+                return
+            with self._db_lock:
+                row = self._connection.execute("""
+                    SELECT * FROM attachments WHERE transfer_id = :transferId AND contact = :contact
+                """, {"transferId": transfer_id, "contact": sender_uuid}).fetchone()
+            offered = row is None
+            if offered:
+                name = self._cipher_for(session.shared_secret).apply(base64.b64decode(request_json['name'])).decode()
+                name = os.path.basename(name) or "attachment"
+                attachment_dir = ATTACHMENT_DIR if not self._test else TEST_ATTACHMENT_DIR
+                row = {
+                    "transfer_id": transfer_id,
+                    "contact": sender_uuid,
+                    "session_id": session.session_id,
+                    "name": name,
+                    "path": os.path.join(attachment_dir, f"{transfer_id}-{name}"),
+                    "size": int(request_json['size']),
+                    "transferred": 0
+                }
+                self._save_attachment(row, "IN")
+            transfer = self._load_incoming_transfer(row)
+            if transfer.done and offered:
+                # Empty files are complete right away
+                self._finish_incoming_transfer(transfer)
+        self._send(pack_attachment_ack(sender_uuid, transfer_id, transfer.received), buffer=False)
+
+    def _load_incoming_transfer(self, row) -> IncomingTransfer:
+        """Open the file of an incoming attachment, to continue at the received offset
+        """
+        session = self._session_with_id(row['session_id'])
+        transfer = IncomingTransfer(
+            transfer_id=row['transfer_id'],
+            contact_uuid=row['contact'],
+            session_id=row['session_id'],
+            name=row['name'],
+            path=row['path'],
+            size=row['size'],
+            cipher=self._cipher_for(session.shared_secret),
+            received=row['transferred']
+        )
+        if not transfer.done:
+            self._incoming_transfers[transfer.transfer_id] = transfer
+        return transfer
+
+    def _handle_attachment_chunk(self, chunk):
+        """Called on a crypto worker with every chunk of an incoming attachment.
+        Written chunks are acknowledged right away, which opens the window of the sender.
+        """
+        transfer = self._incoming_transfers.get(chunk.transfer_id)
+        if transfer is None or transfer.contact_uuid != chunk.peer_uuid or transfer.session_id != chunk.session_id:
+            return
+        result = transfer.write(chunk.offset, chunk.data)
+        if result == IncomingTransfer.GAP:
+            # Ask the sender to go back to the received offset
+            self._send(pack_attachment_ack(chunk.peer_uuid, chunk.transfer_id, transfer.received), buffer=False)
+        if result != IncomingTransfer.WRITTEN:
+            return
+        self._send(pack_attachment_ack(chunk.peer_uuid, chunk.transfer_id, transfer.received), buffer=False)
+        self._persist_stage.put(("""
+            UPDATE attachments SET transferred = :transferred WHERE transfer_id = :transferId
+        """, {"transferred": transfer.received, "transferId": transfer.transfer_id}, None))
+        if transfer.done:
+            self._finish_incoming_transfer(transfer)
+
+    def _finish_incoming_transfer(self, transfer: IncomingTransfer):
+        """Announce a complete attachment in the chat history, like a message of the sender
+        """
+        self._incoming_transfers.pop(transfer.transfer_id, None)
+        self._logger.info(f"Attachment {transfer.name} of {transfer.contact_uuid} saved to {transfer.path}")
+        self._save_incoming_message(self._contact_with_uuid(transfer.contact_uuid), f"[Attachment] {transfer.name}")
+
+    def _handle_attachment_ack(self, ack):
+        """Called on the receive thread, when the receiver of an attachment wrote more of it,
+        or answered an offer
+        """
+        transfer = self._outgoing_transfers.get(ack.transfer_id)
+        if transfer is None or transfer.contact_uuid != ack.peer_uuid:
+            return
+        transfer.acknowledge(ack.offset)
+        self._persist_stage.put(("""
+            UPDATE attachments SET transferred = :transferred WHERE transfer_id = :transferId
+        """, {"transferred": ack.offset, "transferId": ack.transfer_id}, None))
+        if transfer.done:
+            self._logger.info(f"Attachment {transfer.path} sent to {transfer.contact_uuid}")
+            self._outgoing_transfers.pop(ack.transfer_id, None)
+
+    def _save_attachment(self, row: dict, direction: str):
+        with self._db_lock:
+            self._connection.execute("""
+                INSERT INTO attachments 
+                VALUES (
+                    :transfer_id, 
+                    :contact, 
+                    :session_id,
+                    :name,
+                    :path,
+                    :size,
+                    :transferred,
+                    :direction,
+                    :date
+                ) 
+            """, dict(row, direction=direction, date=int(time.time())))
+            self._connection.commit()
+
+    def _persist_batch(self, items: list):
+        """Persist stage. Executes a batch of writes in a single transaction, then passes
+        the messages of the batch on to the frontend
+
+        Parameters
+        ----------
+        items : list
+            Tuples of SQL, parameters and the frontend payload, or None
+        """
+        with self._db_lock:
+            with self._connection:
+                for sql, params, payload in items:
+                    cursor = self._connection.execute(sql, params)
+                    if payload is not None:
+                        # Lets the frontend advance its `load_history_since` cursor
+                        payload['id'] = cursor.lastrowid
+                        payload['date'] = params['date']
+        if self._test:
+            return
+        for _, _, payload in items:
+            if payload is not None:
+                self._ui_stage.put(payload)
+
+    def _dispatch_to_frontend(self, payloads: list):
+        """Frontend stage. Messages, that arrived within UI_PUSH_INTERVAL, are pushed with a single Eel call
+        """
+        self._eel.handleIncomingMessages(json.dumps(payloads))
 
     def _handle_connect_with_contact_response(self, request_json):
         """Called after a connect with contact response is executed. 
@@ -245,79 +978,240 @@ class OQSClient():
         if request_json['contactExists']:
             contact_pub_key: bytes = base64.b64decode(request_json['contactPublicKey'])
             ciphertext, shared_secret = client.encap_secret(contact_pub_key)
-            contact = Contact(
+            self._add_contact(Contact(
                 contact_name=request_json['contactName'],
                 contact_uuid=request_json['contactUUID'],
-                contact_pub_key=request_json['contactPublicKey'],
+                contact_pub_key=contact_pub_key,
                 shared_ciphertext=ciphertext,
                 shared_secret=shared_secret
-            )
-            self._contacts.append(contact)
-
-            self._cursor.execute("""
-                INSERT INTO contacts 
-                VALUES (
-                    :uuid, 
-                    :name, 
-                    :publicKey, 
-                    :sharedSecret,
-                    :sharedCiphertext
-                ) 
-            """, {
-                "uuid": request_json['contactUUID'],
-                "name": request_json['contactName'],
-                "publicKey": request_json['contactPublicKey'],
-                "sharedSecret": shared_secret,
-                "sharedCiphertext": ciphertext
-            })
-            self._connection.commit()
+            ))
+            # Older servers don't report it
+            self._save_sessions_support(request_json['contactUUID'], request_json.get('contactSessions', True))
         if not self._test:
             self._eel.handleAddContactResponse(json.dumps(request_json))
 
+    def _handle_connect_with_contacts_response(self, request_json):
+        """Called after a batched connect with contacts request. A shared secret is
+        encapsulated for every found contact, that is not known yet, and all of them
+        are added at once.
+        """
+        found = []
+        for contact_json in request_json['contacts']:
+            if self._contact_with_uuid(contact_json['contactUUID']) is None:
+                found.append((contact_json, base64.b64decode(contact_json['contactPublicKey'])))
+        encapsulated = [client.encap_secret(contact_pub_key) for _, contact_pub_key in found]
+
+        contacts = [Contact(
+            contact_name=contact_json['contactName'],
+            contact_uuid=contact_json['contactUUID'],
+            contact_pub_key=contact_pub_key,
+            shared_ciphertext=ciphertext,
+            shared_secret=shared_secret
+        ) for (contact_json, contact_pub_key), (ciphertext, shared_secret) in zip(found, encapsulated)]
+        if contacts:
+            self._add_contacts(contacts)
+        for contact_json in request_json['contacts']:
+            self._save_sessions_support(contact_json['contactUUID'], contact_json.get('contactSessions', True))
+        self._logger.info(f"Added {len(contacts)} contacts, {len(request_json['missingUUIDs'])} not found")
+        if not self._test:
+            self._eel.handleAddContactsResponse(json.dumps(request_json))
+
     def _save_personal_information(self, request_json):
         """Save personal information after first login
         """
         self._logger.info(f"Saving personal data with UUID: {request_json['UUID']}")
-        self._cursor.execute("""
-            INSERT INTO personal_information 
-            VALUES (
-                :uuid, 
-                :name, 
-                :privateKey, 
-                :publicKey,
-                :seedHash
-            ) 
-        """, {
-            "uuid": request_json['UUID'],
-            "name": self._name,
-            "privateKey": self.__private_key,
-            "publicKey": self.__pub_key,
-            "seedHash": base64.b64decode(request_json['seedHash'])
-        }
-                             )
-        self._connection.commit()
+        with self._db_lock:
+            self._connection.execute("""
+                INSERT INTO personal_information 
+                VALUES (
+                    :uuid, 
+                    :name, 
+                    :privateKey, 
+                    :publicKey,
+                    :seedHash
+                ) 
+            """, {
+                "uuid": request_json['UUID'],
+                "name": self._name,
+                "privateKey": self.__private_key,
+                "publicKey": self.__pub_key,
+                "seedHash": base64.b64decode(request_json['seedHash'])
+            }
+                                 )
+            self._connection.commit()
         self.__uuid = request_json['UUID']
+        self.__seed_hash = base64.b64decode(request_json['seedHash'])
+        # Reconnects log in with the new account
+        self._client_has_acccount = True
 
     def _receive_msg(self):
-        """Permanent loop, that listens for messages from the server
+        """Permanent loop, that listens for messages from the server. Reconnects, if the connection is lost
         """
         while True:
-            msg = self._socket.recv(self._bufsize)
+            decoder = FrameDecoder(self._bufsize)
+            # A batch, that was cut off with the connection, is sent again from its start
+            self._batch_outcomes.clear()
+            try:
+                while True:
+                    frames = decoder.recv_frames(self._socket)
+                    self._last_received = time.monotonic()
+                    for frame in frames:
+                        self._handle_frame(frame)
+            except (ConnectionClosedError, OSError) as e:
+                if not self._closed:
+                    self._logger.error(f"Connection to server lost: {e}")
+            with self._send_lock:
+                self._connected = False
+            if self._closed or not self._reconnect:
+                break
+            self._reconnect_with_backoff()
+
+    def _handle_frame(self, frame: bytes):
+        """Dispatch a single frame from the server
+        """
+        if is_binary_frame(frame):
+            try:
+                self._handle_binary_frame(frame)
+            except MALFORMED_FRAME_ERRORS as e:
+                # Only the frame is dropped, the connection stays usable
+                self._logger.warning(f"Malformed binary frame of kind {frame_kind(frame)} dropped: {e}")
+            return
+
+        request_json = json.loads(frame.decode())
+        request_type_str = request_json["requestType"]
+        request_type = RequestType[request_type_str]
+
+        if request_type == RequestType.SEND_MESSAGE_REQUEST:
+            self._submit_message(frame, request_json['senderUUID'], self._handle_incoming_json_message, request_json)
+
+        elif request_type == RequestType.GROUP_MESSAGE_REQUEST:
+            self._submit_message(frame, request_json['senderUUID'], self._handle_group_message,
+                                        request_json['senderUUID'], request_json['groupId'], request_json['sessionId'],
+                                        base64.b64decode(request_json['wrappedKey']),
+                                        base64.b64decode(request_json['body']))
 
-            request_json = json.loads(msg.decode())
-            request_type_str = request_json["requestType"]
-            request_type = RequestType[request_type_str]
+        elif request_type == RequestType.ATTACHMENT_OFFER:
+            self._crypto_workers.submit(request_json['senderUUID'], self._handle_attachment_offer, request_json)
 
-            if request_type == RequestType.SEND_MESSAGE_REQUEST:
-                self._handle_incoming_message(request_json)
+        elif request_type == RequestType.SESSION_INIT_REQUEST:
+            # Same worker as the messages of the sender, so the session exists before they are decrypted
+            self._crypto_workers.submit(request_json['senderUUID'], self._handle_session_init, request_json)
 
-            elif request_type == RequestType.ASSIGN_UUID_AND_SEED:
-                self._logger.info("ASSIGN UUID AND SEED")
-                self._save_personal_information(request_json)
+        elif request_type == RequestType.SESSION_ACK_REQUEST:
+            self._handle_session_ack(request_json)
 
-            elif request_type == RequestType.CONNECT_WITH_CONTACT_RESPONSE:
-                self._logger.info("RECEIVED CONNECT WITH CONTACT")
-                self._handle_connect_with_contact_response(request_json)
+        elif request_type == RequestType.HELLO_RESPONSE:
+            self._wire_format = request_json['wireFormat']
+            # Older servers don't announce one
+            self._heartbeat_interval = request_json.get('heartbeatInterval')
+            # Session tickets arrive right after the handshake, so they are there by now
+            self._tls_session = self._socket.session
+            self._logger.info(f"Using wire format {self._wire_format}")
+
+        elif request_type == RequestType.ASSIGN_UUID_AND_SEED:
+            self._logger.info("ASSIGN UUID AND SEED")
+            self._save_personal_information(request_json)
+
+        elif request_type == RequestType.CONNECT_WITH_CONTACT_RESPONSE:
+            self._logger.info("RECEIVED CONNECT WITH CONTACT")
+            self._crypto_workers.submit(request_json.get('contactUUID'), self._handle_connect_with_contact_response,
+                                        request_json)
+
+        elif request_type == RequestType.CONNECT_WITH_CONTACTS_RESPONSE:
+            # Contacts of the batch may have sessions in flight on any worker
+            self._crypto_workers.join()
+            self._handle_connect_with_contacts_response(request_json)
+
+        elif request_type == RequestType.OFFLINE_BATCH_END:
+            self._finish_offline_batch(request_json)
+
+    def _handle_binary_frame(self, frame: bytes):
+        """Dispatch a binary frame from the server. Raises one of MALFORMED_FRAME_ERRORS, if it can not be decoded
+        """
+        kind = frame_kind(frame)
+        if kind == FrameKind.DELIVER_MESSAGE:
+            deliver_message = unpack_deliver_message(frame)
+            self._submit_message(frame, deliver_message.sender_uuid, self._handle_incoming_message,
+                                 deliver_message.sender_uuid, deliver_message.session_id, deliver_message.message)
+        elif kind == FrameKind.GROUP_DELIVER:
+            group_deliver = unpack_group_deliver(frame)
+            self._submit_message(frame, group_deliver.sender_uuid, self._handle_group_message, *group_deliver)
+        elif kind == FrameKind.ATTACHMENT_CHUNK:
+            chunk = unpack_attachment_chunk(frame)
+            self._crypto_workers.submit(chunk.peer_uuid, self._handle_attachment_chunk, chunk)
+        elif kind == FrameKind.ATTACHMENT_ACK:
+            self._handle_attachment_ack(unpack_attachment_ack(frame))
+
+    def _submit_message(self, frame: bytes, sender_uuid: str, handler, *args):
+        """Queue a received message on the crypto worker of its sender. Its outcome is checked at
+        the end of the offline batch, it arrived with. Messages of a refused batch, that were already
+        persisted, are skipped, when the batch is sent again
+        """
+        digest = hashlib.sha256(frame).digest()
+        if self._persisted_digests[digest] > 0:
+            self._persisted_digests[digest] -= 1
+            self._batch_outcomes.append((digest, None))
+            return
+        self._batch_outcomes.append((digest, self._crypto_workers.submit(sender_uuid, handler, *args)))
+
+    @staticmethod
+    def _is_persisted(task) -> bool:
+        """Wait for the task of a received message and the writes it queued. False, if any of them failed
+        """
+        if task is None:
+            return True
+        if task.exception() is not None:
+            return False
+        return all(write.exception() is None for write in task.result() or ())
+
+    def _finish_offline_batch(self, request_json):
+        """Acknowledge an offline batch, once every message of it is persisted. If messages failed, the batch
+        is refused and sent again, up to OFFLINE_BATCH_ATTEMPTS times in a row. Then the failed messages are given up
+        """
+        outcomes = [(digest, self._is_persisted(task)) for digest, task in self._batch_outcomes]
+        self._batch_outcomes.clear()
+        failed = sum(not persisted for _, persisted in outcomes)
+        if not failed:
+            self._batch_refusals = 0
+            self._persisted_digests.clear()
+            self._acknowledge_offline_batch(request_json)
+            return
+
+        self._batch_refusals += 1
+        if self._batch_refusals >= OFFLINE_BATCH_ATTEMPTS:
+            self._logger.error(f"{failed} offline messages up to {request_json['lastId']} could not be persisted "
+                               f"after {self._batch_refusals} attempts. Giving them up")
+            self._batch_refusals = 0
+            self._persisted_digests.clear()
+            self._acknowledge_offline_batch(request_json)
+            return
+        self._persisted_digests.update(digest for digest, persisted in outcomes if persisted)
+        self._refuse_offline_batch(request_json, failed)
+
+    def _refuse_offline_batch(self, request_json, failed: int):
+        """Messages of the batch could not be persisted. The batch is not acknowledged and the
+        connection is shut down, so the server sends it again after the receive thread reconnected
+        """
+        self._logger.error(f"{failed} offline messages up to {request_json['lastId']} were not persisted")
+        if not self._reconnect:
+            # Sent again after the next login
+            return
+        try:
+            self._socket.shutdown(SHUT_RDWR)
+        except OSError:
+            pass
+
+    def _acknowledge_offline_batch(self, request_json):
+        """Confirm a batch of offline messages. Every message of the batch is already
+        persisted, as the receive thread waits for the pipeline first. The server then
+        deletes the batch and sends the next one.
+        """
+        self._logger.info(f"Received offline messages up to {request_json['lastId']}")
+        payload = {}
+        payload['requestType'] = RequestType.OFFLINE_BATCH_ACK
+        payload['lastId'] = request_json['lastId']
+        json_data = json.dumps(payload)
+        self._send(json_data.encode())
 
     def contact_connection_request(self, contact_uuid: str):
         """Request to connect with a certain contact.
@@ -331,7 +1225,22 @@ class OQSClient():
         payload['requestType'] = RequestType.CONNECT_WITH_CONTACT_REQUEST
         payload['contactUUID'] = contact_uuid
         json_data = json.dumps(payload)
-        self._socket.send(json_data.encode())
+        self._send(json_data.encode())
+
+    def contacts_connection_request(self, contact_uuids: list):
+        """Request to connect with several contacts at once, e.g. for an address book import.
+        Answered with a single CONNECT_WITH_CONTACTS_RESPONSE.
+
+        Parameters
+        ----------
+        contact_uuids : list
+            UUIDs of contacts to connect with
+        """
+        payload = {}
+        payload['requestType'] = RequestType.CONNECT_WITH_CONTACTS_REQUEST
+        payload['contactUUIDs'] = list(contact_uuids)
+        json_data = json.dumps(payload)
+        self._send(json_data.encode())
 
     def send_msg(self, contact_uuid: str, msg: str):
         """Send encrypted message to specified contact.
@@ -342,38 +1251,287 @@ class OQSClient():
             UUID of contact to connect with
         msg: str
             Plain text message to sent. Will be encrypted before it is sent out.
+
+        Returns
+        -------
+        int
+            Id of the message in the chat history
         """
         # Get contact by UUID
-        contact = next((contact for contact in self._contacts if str(contact.contact_uuid) == contact_uuid), None)
-        self._cursor.execute("""
-            INSERT INTO chat_history 
-            VALUES (
-                :message, 
-                :contact,
-                :sentBy,
-                :date
-            ) 
-        """, {
-            "message": msg,
-            "contact": contact_uuid,
-            "sentBy": "ME",
-            "date": int(time.time())
-        })
-        self._connection.commit()
+        contact = self._contact_with_uuid(contact_uuid)
+        with self._db_lock:
+            message_id = self._connection.execute("""
+                INSERT INTO chat_history 
+                VALUES (
+                    :message, 
+                    :contact,
+                    :sentBy,
+                    :date
+                ) 
+            """, {
+                "message": msg,
+                "contact": contact_uuid,
+                "sentBy": "ME",
+                "date": int(time.time())
+            }).lastrowid
+            self._connection.commit()
 
-        # Encode message
-        encoded_message = self._xor_msg_with_shared_secret(msg=msg.encode(), secret=contact.shared_secret)
+        if not self._supports_sessions(contact_uuid):
+            self._send_legacy_message(contact, msg.encode())
+            return message_id
+
+        # Encode message. The KEM ciphertext was sent once, when the session was established
+        session = self._outgoing_session(contact)
+        data = msg.encode()
+        if self._compression_for(session.session_id) is not None:
+            data = compress_message(data)
+        encoded_message = self._cipher_for(session.shared_secret).apply(data)
+
+        if self._wire_format == WIRE_FORMAT_BINARY:
+            self._send(pack_send_message(contact_uuid, session.session_id, encoded_message))
+            return message_id
 
         payload = {}
         payload['requestType'] = RequestType.SEND_MESSAGE_REQUEST
         payload['contactUUID'] = contact_uuid
+        payload['sessionId'] = session.session_id
         payload['message'] = base64.b64encode(encoded_message).decode('ascii')
+        json_data = json.dumps(payload)
 
+        self._send(json_data.encode())
+        return message_id
 
+    def _send_legacy_message(self, contact: Contact, data: bytes):
+        """Send a message to a contact with an older client, which has no sessions. Like older
+        clients, the message carries the KEM ciphertext and is never compressed
+        """
+        payload = {}
+        payload['requestType'] = RequestType.SEND_MESSAGE_REQUEST
+        payload['contactUUID'] = contact.contact_uuid
+        payload['message'] = base64.b64encode(self._cipher_for(contact.shared_secret).apply(data)).decode('ascii')
         payload['ciphertext'] = base64.b64encode(contact.shared_ciphertext).decode('ascii')
         json_data = json.dumps(payload)
+        self._send(json_data.encode())
+
+    def create_group(self, name: str, member_uuids: list) -> str:
+        """Create a group with contacts. The members learn about the group with a first group message.
+
+        Parameters
+        ----------
+        name : str
+            Name of the group
+        member_uuids : list
+            UUIDs of the contacts in the group
+
+        Returns
+        -------
+        str
+            UUID of the group
+        """
+        self._check_group_support()
+        member_uuids = [member_uuid for member_uuid in dict.fromkeys(member_uuids) if member_uuid != self.__uuid]
+        if len(member_uuids) > MAX_GROUP_MEMBERS:
+            raise ValueError(f"Groups have at most {MAX_GROUP_MEMBERS} members")
+        group_id = str(uuid.uuid4())
+        with self._db_lock:
+            with self._connection:
+                self._connection.execute("""
+                    INSERT INTO chat_groups 
+                    VALUES (
+                        :groupId, 
+                        :name, 
+                        :createdBy,
+                        :date
+                    ) 
+                """, {"groupId": group_id, "name": name, "createdBy": self.__uuid, "date": int(time.time())})
+                self._connection.executemany("""
+                    INSERT OR IGNORE INTO group_members VALUES (:groupId, :contact)
+                """, [{"groupId": group_id, "contact": member_uuid} for member_uuid in member_uuids + [self.__uuid]])
+        self._group_names[group_id] = name
+
+        body = {"type": "create", "name": name, "members": member_uuids + [self.__uuid]}
+        self._send_group_body(group_id, member_uuids, body)
+        return group_id
+
+    def send_group_msg(self, group_id: str, msg: str) -> int:
+        """Send a message to every member of a group. The message is encrypted and uploaded
+        only once, the server fans it out to the members.
+
+        Parameters
+        ----------
+        group_id : str
+            UUID of the group
+        msg: str
+            Plain text message to sent. Will be encrypted before it is sent out.
+
+        Returns
+        -------
+        int
+            Id of the message in the group history
+        """
+        self._check_group_support()
+        with self._db_lock:
+            member_uuids = [row['contact'] for row in self._connection.execute("""
+                SELECT contact FROM group_members WHERE group_id = :groupId AND contact != :uuid
+            """, {"groupId": group_id, "uuid": self.__uuid}).fetchall()]
+            message_id = self._connection.execute("""
+                INSERT INTO group_history 
+                VALUES (
+                    :message, 
+                    :groupId,
+                    :sender,
+                    :sentBy,
+                    :date
+                ) 
+            """, {
+                "message": msg,
+                "groupId": group_id,
+                "sender": self.__uuid,
+                "sentBy": "ME",
+                "date": int(time.time())
+            }).lastrowid
+            self._connection.commit()
+
+        self._send_group_body(group_id, member_uuids, {"type": "message", "message": msg})
+        return message_id
+
+    def _check_group_support(self):
+        """Group messages are only sent in the binary wire format. Checked before anything is stored,
+        so the history never shows a group message, that was not sent
+        """
+        if self._wire_format != WIRE_FORMAT_BINARY:
+            raise ConnectionError("Server does not support group messages")
+
+    def _send_group_body(self, group_id: str, member_uuids: list, body: dict):
+        """Encrypt the body once with a random message key and send it as a single GROUP_SEND.
+        Every member gets the message key encrypted with its session.
+        """
+        message_key = os.urandom(GROUP_MESSAGE_KEY_SIZE)
+        encrypted_body = create_cipher(message_key).apply(json.dumps(body).encode())
+
+        members = []
+        for member_uuid in member_uuids:
+            contact = self._contact_with_uuid(member_uuid)
+            if contact is None:
+                self._logger.warning(f"Group member {member_uuid} is no contact. Skipped")
+                continue
+            session = self._outgoing_session(contact)
+            wrapped_key = self._cipher_for(session.shared_secret).apply(message_key)
+            members.append(GroupMember(member_uuid, session.session_id, wrapped_key))
+        self._send(pack_group_send(group_id, members, encrypted_body))
+
+    def send_attachment(self, contact_uuid: str, path: str) -> str:
+        """Send a file to specified contact. The file is sent in chunks in the background,
+        next to the chat traffic. If the connection is lost, the transfer resumes after the reconnect,
+        from the last offset, the contact acknowledged. That also works after a restart of either side,
+        as long as the file is still there.
+
+        Parameters
+        ----------
+        contact_uuid : str
+            UUID of the contact
+        path : str
+            Path of the file
+
+        Returns
+        -------
+        str
+            Id of the transfer
+        """
+        contact = self._contact_with_uuid(contact_uuid)
+        session = self._outgoing_session(contact)
+        row = {
+            "transfer_id": str(uuid.uuid4()),
+            "contact": contact_uuid,
+            "session_id": session.session_id,
+            "name": os.path.basename(path),
+            "path": os.path.abspath(path),
+            "size": os.path.getsize(path),
+            "transferred": 0
+        }
+        self._save_attachment(row, "OUT")
+        with self._db_lock:
+            self._connection.execute("""
+                INSERT INTO chat_history VALUES (:message, :contact, :sentBy, :date)
+            """, {"message": f"[Attachment] {row['name']}", "contact": contact_uuid, "sentBy": "ME",
+                  "date": int(time.time())})
+            self._connection.commit()
+        self._start_outgoing_transfer(row)
+        return row['transfer_id']
+
+    def _start_outgoing_transfer(self, row):
+        """Start sending an attachment and offer it to the contact. Chunks follow the answer
+        """
+        session = self._session_with_id(row['session_id'])
+        transfer = OutgoingTransfer(
+            transfer_id=row['transfer_id'],
+            contact_uuid=row['contact'],
+            session_id=row['session_id'],
+            path=row['path'],
+            size=row['size'],
+            cipher=self._cipher_for(session.shared_secret),
+            send=lambda frame: self._send(frame, buffer=False),
+            acknowledged=row['transferred']
+        )
+        self._outgoing_transfers[transfer.transfer_id] = transfer
+        transfer.start()
+        self._send_attachment_offer(transfer, row['name'])
+
+    def _send_attachment_offer(self, transfer: OutgoingTransfer, name: str):
+        payload = {}
+        payload['requestType'] = RequestType.ATTACHMENT_OFFER
+        payload['contactUUID'] = transfer.contact_uuid
+        payload['transferId'] = transfer.transfer_id
+        payload['sessionId'] = transfer.session_id
+        # Only the contact can read the file name
+        session = self._session_with_id(transfer.session_id)
+        payload['name'] = base64.b64encode(self._cipher_for(session.shared_secret).apply(name.encode())).decode('ascii')
+        payload['size'] = transfer.size
+        payload['chunkSize'] = ATTACHMENT_CHUNK_SIZE
+        json_data = json.dumps(payload)
+        self._send(json_data.encode())
+
+    def _resume_attachments(self):
+        """Continue unfinished attachments, after a reconnect or a restart. Outgoing ones are offered again,
+        the answers tell from which offset they continue. For incoming ones, the received offset is sent
+        to the sender, which goes back to it. Whichever side comes back first, is answered by the other.
+        """
+        with self._db_lock:
+            rows = self._connection.execute("""
+                SELECT * FROM attachments WHERE transferred < size
+            """).fetchall()
+        for row in rows:
+            if row['direction'] == 'IN':
+                transfer = self._incoming_transfers.get(row['transfer_id']) or self._load_incoming_transfer(row)
+                self._send(pack_attachment_ack(transfer.contact_uuid, transfer.transfer_id, transfer.received))
+                continue
+            transfer = self._outgoing_transfers.get(row['transfer_id'])
+            if transfer is not None:
+                self._send_attachment_offer(transfer, row['name'])
+            elif os.path.exists(row['path']):
+                self._start_outgoing_transfer(row)
+            else:
+                self._logger.warning(f"Attachment {row['path']} does not exist anymore. Transfer not resumed")
 
-        self._socket.send(json_data.encode())
+    def attachment_progress(self, transfer_id: str):
+        """Helper message for the Eel frontent. Returns the progress of an attachment transfer
+
+        Returns
+        -------
+        str
+            JSON with `name`, `size`, the `transferred` bytes and the `direction`, or null for unknown transfers
+        """
+        with self._db_lock:
+            row = self._connection.execute("""
+                SELECT name, size, transferred, direction FROM attachments WHERE transfer_id = :transferId
+            """, {"transferId": transfer_id}).fetchone()
+        progress = dict(row) if row is not None else None
+        transfer = self._outgoing_transfers.get(transfer_id) or self._incoming_transfers.get(transfer_id)
+        if progress is not None and transfer is not None:
+            # The database is updated in batches
+            progress['transferred'] = transfer.acknowledged if isinstance(transfer, OutgoingTransfer) \
+                else transfer.received
+        return json.dumps(progress)
 
     # Frontend exposed methods:
     def get_uuid(self):
@@ -390,25 +1548,109 @@ class OQSClient():
         """Helper message for the Eel frontent. Returns the chat overview
         """
         overview_list = []
-        rows = self._cursor.execute("SELECT c.uuid, c.name FROM contacts c").fetchall()
+        rows = self._connection.execute("SELECT c.uuid, c.name FROM contacts c").fetchall()
         for row in rows:
             overview_list.append(dict(row))
+        rows = self._connection.execute("SELECT g.group_id AS uuid, g.name FROM chat_groups g").fetchall()
+        for row in rows:
+            overview_list.append(dict(row, isGroup=True))
         return json.dumps(overview_list)
 
-    def load_chat_history(self):
-        """Helper message for the Eel frontent. Returns the chat history
+    def load_chat_history(self, contact: str, before: str = None, limit: int = HISTORY_PAGE_SIZE):
+        """Helper message for the Eel frontent. Returns one page of the chat history with a contact,
+        read backwards from the newest message over the `(contact, date)` index.
+
+        Parameters
+        ----------
+        contact : str
+            UUID of the contact
+        before : str, optional
+            `nextCursor` of the previous page, by default None for the newest messages
+        limit : int, optional
+            Maximum amount of messages, by default HISTORY_PAGE_SIZE
+
+        Returns
+        -------
+        str
+            JSON with the `messages` of the page, sorted from old to new, and the `nextCursor`
+            for the older page, or null if there are no older messages
+        """
+        return self._history_page("chat_history", "contact", contact, before, limit)
+
+    def load_group_history(self, group_id: str, before: str = None, limit: int = HISTORY_PAGE_SIZE):
+        """Helper message for the Eel frontent. Returns one page of the history of a group,
+        like `load_chat_history`. Messages carry the UUID of their `sender`.
         """
-        history_list = []
-        rows = self._cursor.execute("SELECT * FROM chat_history").fetchall()
-        for row in rows:
-            history_list.append(dict(row))
-        return json.dumps(history_list)
+        return self._history_page("group_history", "group_id", group_id, before, limit)
+
+    def _history_page(self, table: str, key_column: str, key: str, before: str, limit: int):
+        """One page of a history table, read backwards over its `(key_column, date)` index
+        """
+        params = {"key": key, "limit": int(limit)}
+        condition = ""
+        if before:
+            before_date, before_id = before.split(":")
+            condition = "AND (date, rowid) < (:beforeDate, :beforeId)"
+            params["beforeDate"] = int(before_date)
+            params["beforeId"] = int(before_id)
+
+        rows = self._connection.execute(f"""
+            SELECT rowid AS id, * FROM {table}
+            WHERE {key_column} = :key {condition}
+            ORDER BY date DESC, rowid DESC
+            LIMIT :limit
+        """, params).fetchall()
+
+        history_list = [dict(row) for row in reversed(rows)]
+        next_cursor = None
+        if len(rows) == params["limit"]:
+            oldest = history_list[0]
+            next_cursor = f"{oldest['date']}:{oldest['id']}"
+        return json.dumps({"messages": history_list, "nextCursor": next_cursor})
+
+    def load_history_since(self, since=None, limit: int = HISTORY_SYNC_LIMIT):
+        """Helper message for the Eel frontent. Returns the messages of all contacts, that were saved
+        after the cursor, so a reopened frontend only fetches what changed.
+
+        Parameters
+        ----------
+        since : str or int, optional
+            `cursor` of the previous response, or a unix timestamp. By default None, which only
+            returns the cursor of the newest message
+        limit : int, optional
+            Maximum amount of messages, by default HISTORY_SYNC_LIMIT
+
+        Returns
+        -------
+        str
+            JSON with the `messages`, sorted from old to new, the `cursor` for the next call,
+            and `hasMore`, if there are more messages than the limit
+        """
+        if since is None:
+            row = self._connection.execute("""
+                SELECT rowid AS id, date FROM chat_history ORDER BY date DESC, rowid DESC LIMIT 1
+            """).fetchone()
+            cursor = f"{row['date']}:{row['id']}" if row is not None else "0:0"
+            return json.dumps({"messages": [], "cursor": cursor, "hasMore": False})
+
+        since_date, since_id = str(since).split(":") if ":" in str(since) else (since, 2 ** 63 - 1)
+        rows = self._connection.execute("""
+            SELECT h.rowid AS id, h.*, c.name AS contactName FROM chat_history h
+            LEFT JOIN contacts c ON c.uuid = h.contact
+            WHERE (h.date, h.rowid) > (:sinceDate, :sinceId)
+            ORDER BY h.date, h.rowid
+            LIMIT :limit
+        """, {"sinceDate": int(since_date), "sinceId": int(since_id), "limit": int(limit) + 1}).fetchall()
+
+        messages = [dict(row) for row in rows[:int(limit)]]
+        cursor = f"{messages[-1]['date']}:{messages[-1]['id']}" if messages else str(since)
+        return json.dumps({"messages": messages, "cursor": cursor, "hasMore": len(rows) > int(limit)})
 
     def load_chat_history_list(self):
         """Helper message for the integration test, for a better assertion
         """
         history_list = []
-        rows = self._cursor.execute("SELECT * FROM chat_history").fetchall()
+        rows = self._connection.execute("SELECT * FROM chat_history").fetchall()
         for row in rows:
             history_list.append(dict(row))
         return history_list
@@ -0,0 +1,150 @@
+from concurrent.futures import Future
+from queue import Queue, Empty
+from threading import Thread
+import logging
+import time
+import zlib
+
+_STOP = object()
+
+
+class KeyedWorkerPool():
+    """Fixed set of worker threads with one bounded queue each. Tasks with the same key
+    always run on the same worker, so tasks of one sender run in order, while different
+    senders are handled in parallel. A full queue blocks the submitter.
+    """
+
+    def __init__(self, num_workers: int = 4, queue_size: int = 1024, name: str = "Worker"):
+        self.__logger = logging.getLogger(__name__)
+        self.__queues = [Queue(queue_size) for _ in range(num_workers)]
+        self.__next = 0
+        self.__threads = [Thread(target=self.__work, args=(task_queue,), name=f"{name}-{index}", daemon=True)
+                          for index, task_queue in enumerate(self.__queues)]
+        for thread in self.__threads:
+            thread.start()
+
+    def __work(self, task_queue: Queue):
+        while True:
+            task = task_queue.get()
+            try:
+                if task is _STOP:
+                    return
+                function, args, future = task
+                try:
+                    future.set_result(function(*args))
+                except Exception as e:  # A failing task must not stop the worker
+                    self.__logger.exception("Task failed")
+                    future.set_exception(e)
+            finally:
+                task_queue.task_done()
+
+    def submit(self, key, function, *args):
+        """Queue a task on the worker of the key
+
+        Parameters
+        ----------
+        key : str
+            E.g. UUID of the sender. Tasks without a key are spread over all workers
+        function : callable
+            Called with args on the worker thread
+
+        Returns
+        -------
+        Future
+            Resolves to the return value of the function, once the task ran
+        """
+        if key is None:
+            index = self.__next = (self.__next + 1) % len(self.__queues)
+        else:
+            index = zlib.crc32(str(key).encode()) % len(self.__queues)
+        future = Future()
+        self.__queues[index].put((function, args, future))
+        return future
+
+    def join(self):
+        """Wait until every task, that was submitted so far, is done
+        """
+        for task_queue in self.__queues:
+            task_queue.join()
+
+    def close(self):
+        for task_queue in self.__queues:
+            task_queue.put(_STOP)
+
+
+class BatchWorker():
+    """Single thread behind a bounded queue, that handles items in batches. Whatever
+    queued up while the previous batch was handled, is handled at once, e.g. in one
+    database transaction. With a `batch_window`, the worker also waits that long after
+    the first item of a batch, to debounce bursts. Items are handled in the order they were put.
+    If a batch fails, its items are handled one by one, so only the items, that fail by themselves, are lost.
+    """
+
+    def __init__(self, handle_batch, queue_size: int = 4096, max_batch_size: int = 256, batch_window: float = 0.0,
+                 name: str = "BatchWorker"):
+        self.__logger = logging.getLogger(__name__)
+        self.__handle_batch = handle_batch
+        self.__max_batch_size = max_batch_size
+        self.__batch_window = batch_window
+        self.__queue = Queue(queue_size)
+        self.__thread = Thread(target=self.__work, name=name, daemon=True)
+        self.__thread.start()
+
+    def __work(self):
+        while True:
+            batch = [self.__queue.get()]
+            deadline = time.monotonic() + self.__batch_window
+            while len(batch) < self.__max_batch_size and batch[-1] is not _STOP:
+                timeout = deadline - time.monotonic()
+                try:
+                    batch.append(self.__queue.get(timeout=timeout) if timeout > 0 else self.__queue.get_nowait())
+                except Empty:
+                    break
+            stop = _STOP in batch
+            entries = [entry for entry in batch if entry is not _STOP]
+            try:
+                if entries:
+                    self.__handle(entries)
+            finally:
+                for _ in batch:
+                    self.__queue.task_done()
+            if stop:
+                return
+
+    def __handle(self, entries: list):
+        """Handle `(item, future)` entries as one batch. If the batch fails, each item is handled
+        on its own. The future of an item, that fails on its own, carries the exception
+        """
+        try:
+            self.__handle_batch([item for item, _ in entries])
+        except Exception as e:  # A failing batch must not stop the worker
+            if len(entries) == 1:
+                self.__logger.exception("Item failed and is lost")
+                entries[0][1].set_exception(e)
+                return
+            self.__logger.warning(f"Batch of {len(entries)} items failed: {e}. Handling them one by one")
+            for entry in entries:
+                self.__handle([entry])
+            return
+        for _, future in entries:
+            future.set_result(None)
+
+    def put(self, item):
+        """Queue an item for the next batch
+
+        Returns
+        -------
+        Future
+            Resolves once the item is handled. Carries the exception, if it failed
+        """
+        future = Future()
+        self.__queue.put((item, future))
+        return future
+
+    def join(self):
+        """Wait until every item, that was put so far, is handled
+        """
+        self.__queue.join()
+
+    def close(self):
+        self.__queue.put(_STOP)
@@ -29,3 +29,92 @@ CREATE TABLE IF NOT EXISTS chat_history
     date INTEGER NOT NULL, -- Represented as unix timestamp
     FOREIGN KEY(contact) REFERENCES contacts(uuid)
 );
+
+CREATE INDEX IF NOT EXISTS chat_history_contact_date_index
+            ON chat_history (contact, date);
+
+-- For the delta sync over all contacts, `load_history_since`
+CREATE INDEX IF NOT EXISTS chat_history_date_index
+            ON chat_history (date);
+
+CREATE TABLE IF NOT EXISTS sessions
+(
+    session_id TEXT NOT NULL -- Hex encoded, sent with every message instead of the KEM ciphertext
+        constraint sessions_pk
+            primary key,
+    contact TEXT NOT NULL,
+    shared_secret BLOB NOT NULL,
+    shared_ciphertext BLOB NOT NULL,
+    initiated_by TEXT NOT NULL, -- "ME" or "CONTACT"
+    acknowledged INTEGER NOT NULL, -- 1 once the contact confirmed the SESSION_INIT_REQUEST
+    date INTEGER NOT NULL, -- Represented as unix timestamp
+    FOREIGN KEY(contact) REFERENCES contacts(uuid)
+);
+
+CREATE INDEX IF NOT EXISTS sessions_contact_date_index
+            ON sessions (contact, date);
+
+CREATE TABLE IF NOT EXISTS session_compressions
+(
+    session_id TEXT NOT NULL -- Sessions of contacts with older clients have no row
+        constraint session_compressions_pk
+            primary key,
+    compression TEXT NOT NULL, -- Compression, the contact can decompress, e.g. "zlib-chat-v1"
+    FOREIGN KEY(session_id) REFERENCES sessions(session_id)
+);
+
+CREATE TABLE IF NOT EXISTS contact_capabilities
+(
+    contact TEXT NOT NULL -- Contacts without a row establish sessions
+        constraint contact_capabilities_pk
+            primary key,
+    sessions INTEGER NOT NULL, -- 0 for contacts with older clients, which need the KEM ciphertext with every message
+    FOREIGN KEY(contact) REFERENCES contacts(uuid)
+);
+
+CREATE TABLE IF NOT EXISTS chat_groups
+(
+    group_id TEXT NOT NULL
+        constraint chat_groups_pk
+            primary key,
+    name TEXT NOT NULL,
+    created_by TEXT NOT NULL,
+    date INTEGER NOT NULL -- Represented as unix timestamp
+);
+
+CREATE TABLE IF NOT EXISTS group_members
+(
+    group_id TEXT NOT NULL,
+    contact TEXT NOT NULL, -- Includes the own UUID
+    PRIMARY KEY (group_id, contact),
+    FOREIGN KEY(group_id) REFERENCES chat_groups(group_id)
+);
+
+CREATE TABLE IF NOT EXISTS group_history
+(
+    message TEXT NOT NULL,
+    group_id TEXT NOT NULL,
+    sender TEXT NOT NULL,
+    sentBy TEXT NOT NULL, -- "ME" or "CONTACT"
+    date INTEGER NOT NULL, -- Represented as unix timestamp
+    FOREIGN KEY(group_id) REFERENCES chat_groups(group_id)
+);
+
+CREATE INDEX IF NOT EXISTS group_history_group_date_index
+            ON group_history (group_id, date);
+
+CREATE TABLE IF NOT EXISTS attachments
+(
+    transfer_id TEXT NOT NULL
+        constraint attachments_pk
+            primary key,
+    contact TEXT NOT NULL,
+    session_id TEXT NOT NULL, -- Chunks are encrypted with the secret of this session
+    name TEXT NOT NULL,
+    path TEXT NOT NULL, -- File that is sent, or written to
+    size INTEGER NOT NULL,
+    transferred INTEGER NOT NULL, -- Bytes, the receiver acknowledged
+    direction TEXT NOT NULL, -- "IN" or "OUT"
+    date INTEGER NOT NULL, -- Represented as unix timestamp
+    FOREIGN KEY(contact) REFERENCES contacts(uuid)
+);
@@ -0,0 +1,237 @@
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import logging
+import ssl
+import time
+from util.frame_codec import FrameDecoder, FrameTooLargeError, UNAUTHENTICATED_FRAME_SIZE
+from server.oqs_server import OQSServer
+from server.outbound_queue import QueuedConnection, OUTBOUND_QUEUE_SIZE
+from server.connection_lifecycle import HANDSHAKE_TIMEOUT
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
+
+class _StreamConnection(QueuedConnection):
+    """Socket like wrapper around an asyncio StreamWriter.
+    Allows the request handlers of OQSServer to be reused unchanged. Frames are written by
+    a writer task per connection, which waits for the transport to drain after every write,
+    so the outbound queue and not the transport buffer grows for a slow receiver.
+    """
+
+    def __init__(self, writer: asyncio.StreamWriter, loop: asyncio.AbstractEventLoop, executor: ThreadPoolExecutor,
+                 max_queued_bytes: int = OUTBOUND_QUEUE_SIZE):
+        super().__init__(max_queued_bytes)
+        self._writer = writer
+        self._loop = loop
+        self._executor = executor
+        self.__wakeup = asyncio.Event()
+        # `on_drained` is running on the executor
+        self.__drain_scheduled = False
+
+    def sendall(self, data: bytes):
+        """Queue data for the writer task. Safe to call from other threads
+        """
+        if self._writer.is_closing():
+            raise ConnectionResetError("Connection is closing")
+        super().sendall(data)
+
+    def _wake_writer(self):
+        try:
+            running_loop = asyncio.get_running_loop()
+        except RuntimeError:
+            running_loop = None
+        if running_loop is self._loop:
+            self.__wakeup.set()
+        else:
+            self._loop.call_soon_threadsafe(self.__wakeup.set)
+
+    async def write_loop(self):
+        """Writer task of the connection. Ends, when the connection is closed
+        """
+        while True:
+            data = self._outbound.take(block=False)
+            if data is None:
+                if self._outbound.closed:
+                    return
+                self.__wakeup.clear()
+                if not self._outbound.queued_bytes:
+                    await self.__wakeup.wait()
+                continue
+            try:
+                self._writer.write(data)
+                await self._writer.drain()
+            except (ConnectionError, ssl.SSLError):
+                self.close()
+                return
+            self._written()
+
+    def _written(self):
+        """`on_drained` reads the next offline batch from the database, so it runs on the executor.
+        It is scheduled once, until it returned
+        """
+        if self.spilling and not self._outbound.queued_bytes and self.on_drained is not None \
+                and not self.__drain_scheduled:
+            self.__drain_scheduled = True
+            self._loop.run_in_executor(self._executor, self.__run_on_drained)
+
+    def __run_on_drained(self):
+        try:
+            self.on_drained()
+        finally:
+            self.__drain_scheduled = False
+
+    def getpeername(self):
+        return self._writer.get_extra_info('peername')
+
+    def close(self):
+        """Close the connection. Frames, that are still queued, are discarded. Safe to call from other threads.
+        The transport is aborted, a graceful TLS shutdown would keep the socket open until the peer answers it
+        """
+        self._outbound.close()
+        self._wake_writer()
+        self._loop.call_soon_threadsafe(self._writer.transport.abort)
+
+
+class AsyncOQSServer(OQSServer):
+    """OQSServer engine running every client on a single asyncio event loop,
+    instead of one OS thread per client. Uses the same TLS context and request handlers.
+    The handlers can read the database, or wait for other nodes, so they run on a thread pool.
+    The frames of a read are handled with a single hand-off, in order.
+    """
+
+    def __init__(self, host: str = 'localhost', port: int = 33000, bufsize: int = 50000,
+                 handler_threads: int = 64, **kwargs):
+        super().__init__(host=host, port=port, bufsize=bufsize, **kwargs)
+        self.__logger = logging.getLogger(__name__)
+        self.__host = host
+        self.__port = port
+        self.__bufsize = bufsize
+        self.__loop = None
+        self.__server = None
+        # A single slow database read on the event loop would stall every connection
+        self.__executor = ThreadPoolExecutor(handler_threads, thread_name_prefix="AsyncHandler")
+
+    async def __handle_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """Coroutine for every client connected. Listens for all requests
+
+        Parameters
+        ----------
+        reader : asyncio.StreamReader
+            Incoming stream of the client
+        writer : asyncio.StreamWriter
+            Outgoing stream of the client
+        """
+        client_address = writer.get_extra_info('peername')
+        # asyncio completes the TLS handshake before this coroutine runs, so connections are admitted
+        # after it. Pending handshakes are bounded by HANDSHAKE_TIMEOUT
+        cap = self.lifecycle.admit(client_address[0])
+        if cap is not None:
+            self.__logger.warning(f"Connection from {client_address[0]} rejected, {cap} connection cap reached")
+            writer.transport.abort()
+            return
+        self.__logger.info(f"Client with address \"{client_address[0]}:{client_address[1]}\" has connected")
+        connection = _StreamConnection(writer, self.__loop, self.__executor, self.outbound_queue_size)
+        writer_task = self.__loop.create_task(connection.write_loop())
+        decoder = FrameDecoder(self.__bufsize, UNAUTHENTICATED_FRAME_SIZE)
+        client_key_pair = None
+        # The TLS handshake is done by asyncio before this coroutine runs, so it is not timed here
+        self.metrics.connection_opened()
+        ssl_object = writer.get_extra_info('ssl_object')
+        if ssl_object is not None and ssl_object.session_reused:
+            self.metrics.count_resumed_handshake()
+        self.lifecycle.track(connection)
+        try:
+            while self.keep_running:
+                data = await reader.read(self.__bufsize)
+                if not data:
+                    self.__logger.info("Client disconnected")
+                    break
+                connection.last_activity = time.monotonic()
+
+                frames = decoder.feed(data)
+                while frames:
+                    client_key_pair = await self.__loop.run_in_executor(
+                        self.__executor, self.__handle_frames, frames, connection, client_key_pair)
+                    decoder.max_frame_size = self._max_frame_size(connection, client_key_pair)
+                    # Frames, that exceeded the limit before the login
+                    frames = decoder.feed(b"")
+        except (ConnectionError, ssl.SSLError) as e:
+            self.__logger.info(f"Client connection lost: {e}")
+        except FrameTooLargeError as e:
+            self.__logger.warning(f"Protocol violation by {client_address[0]}, connection closed: {e}")
+        finally:
+            self.lifecycle.untrack(connection)
+            self.metrics.connection_closed()
+            self._client_disconnected(client_key_pair)
+            connection.close()
+            writer_task.cancel()
+            self.lifecycle.release(client_address[0])
+
+    def __handle_frames(self, frames: list, connection, client_key_pair):
+        """Handle the frames of one read on the executor
+
+        Returns
+        -------
+        ClientKeyPair
+            Key pair of the client after the last frame
+        """
+        for frame in frames:
+            client_key_pair = self._handle_frame(frame, connection, client_key_pair)
+        return client_key_pair
+
+    async def __serve(self, num_connections: int):
+        self.__loop = asyncio.get_running_loop()
+        self.__server = await asyncio.start_server(
+            self.__handle_client,
+            host=self.__host,
+            port=self.__port,
+            ssl=self._context,
+            backlog=num_connections,
+            limit=self.__bufsize,
+            reuse_port=self._reuse_port or None,
+            ssl_handshake_timeout=HANDSHAKE_TIMEOUT
+        )
+        self._start_links()
+        self._start_lifecycle()
+        self._start_metrics_endpoint()
+        self.__logger.info("Waiting for connection...")
+        async with self.__server:
+            await self.__server.serve_forever()
+
+    @staticmethod
+    def __raise_file_limit():
+        """Every connection needs a file descriptor. Raise the soft limit as far as allowed
+        """
+        if resource is None:
+            return
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if soft < hard:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+    def start(self, num_connections: int = 1024):
+        """Start listening for clients on the event loop. Blocks until the server is stopped
+
+        Parameters
+        ----------
+        num_connections : int, optional
+            Backlog of pending connections, by default 1024
+        """
+        self.__logger.info(f"Starting async server. Backlog of {num_connections} connections")
+        try:
+            self.__raise_file_limit()
+        except (ValueError, OSError) as e:
+            self.__logger.warning(f"Unable to raise file descriptor limit: {e}")
+        try:
+            asyncio.run(self.__serve(num_connections))
+        except asyncio.CancelledError:
+            pass
+
+    def stop_server(self):
+        """Stop the event loop
+        """
+        super().stop_server()
+        if self.__loop is not None and self.__server is not None:
+            self.__loop.call_soon_threadsafe(self.__server.close)
@@ -0,0 +1,45 @@
+from socket import SHUT_RDWR
+from threading import Thread
+import logging
+
+from server.outbound_queue import QueuedConnection, OUTBOUND_QUEUE_SIZE
+
+
+class ClientConnection(QueuedConnection):
+    """State of a single client connection of the threaded engine. Frames are written by a
+    writer thread per connection, so a slow receiver never blocks the thread of a sender.
+    """
+
+    def __init__(self, sock, max_queued_bytes: int = OUTBOUND_QUEUE_SIZE):
+        super().__init__(max_queued_bytes)
+        self.__logger = logging.getLogger(__name__)
+        self.sock = sock
+        self.__writer = Thread(target=self.__write_loop, name="ClientWriter", daemon=True)
+        self.__writer.start()
+
+    def __write_loop(self):
+        while True:
+            data = self._outbound.take()
+            if data is None:
+                return
+            try:
+                self.sock.sendall(data)
+            except OSError as e:
+                self.__logger.info(f"Writing to client failed: {e}")
+                self.close()
+                return
+            self._written()
+
+    def getpeername(self):
+        return self.sock.getpeername()
+
+    def close(self):
+        """Close the connection. Frames, that are still queued, are discarded.
+        The read loop of the connection ends with an error
+        """
+        self._outbound.close()
+        try:
+            self.sock.shutdown(SHUT_RDWR)
+        except OSError:  # Already closed
+            pass
+        self.sock.close()
@@ -0,0 +1,289 @@
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from socket import AF_INET, socket, SOCK_STREAM
+from threading import Thread, Lock
+from queue import Queue
+import hmac
+import itertools
+import json
+import logging
+import os
+import ssl
+import time
+import zlib
+
+from util.oqs_utils import RequestType
+from util.frame_codec import FrameDecoder, ConnectionClosedError, send_frame
+from util.wire_format import WIRE_FORMAT_JSON
+from server.hash_ring import HashRing
+
+# Seconds until a node, that could not be connected, is tried again. Doubles with every
+# failed attempt, up to the maximum. Until then, requests to it fail right away
+PEER_RETRY_DELAY = 0.5
+PEER_RETRY_MAX_DELAY = 30.0
+# Seconds until offline messages, that could not be handed off to their home node, are tried again
+HANDOFF_RETRY_DELAY = 5.0
+
+_STOP = object()
+
+
+def create_peer_context() -> ssl.SSLContext:
+    """Client side TLS context for links to other nodes. Nodes use the same
+    Falcon512 certificate chain as for clients.
+    """
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+    context.check_hostname = False
+    context.verify_mode = ssl.CERT_REQUIRED
+    dirname = os.path.dirname(__file__)
+    context.load_verify_locations(os.path.join(dirname, '../pqca/ca/falcon512_CA.crt'))
+    return context
+
+
+def parse_nodes(nodes_str: str) -> dict:
+    """Parse a node list like `a=localhost:33000,b=localhost:33001`
+
+    Returns
+    -------
+    dict
+        Node name -> (host, port)
+    """
+    nodes = {}
+    for node_str in nodes_str.split(','):
+        name, address = node_str.strip().split('=')
+        host, port = address.rsplit(':', 1)
+        nodes[name] = (host, int(port))
+    return nodes
+
+
+class PeerLink():
+    """Persistent TLS connection to another node. Responses are matched to their
+    request by `requestId`, every other request is handed to the server.
+    """
+
+    def __init__(self, peer_node: str, address: tuple, context: ssl.SSLContext, hello: dict, on_request,
+                 connect_timeout: float = 5.0):
+        self.__logger = logging.getLogger(__name__)
+        self.peer_node = peer_node
+        # Peer links never carry client envelopes directly
+        self.wire_format = WIRE_FORMAT_JSON
+        self.closed = False
+        self.__on_request = on_request
+        self.__send_lock = Lock()
+        self.__pending = {}
+
+        self.__socket = context.wrap_socket(socket(AF_INET, SOCK_STREAM, 0), server_hostname=address[0])
+        self.__socket.settimeout(connect_timeout)
+        self.__socket.connect(address)
+        self.__socket.settimeout(None)
+        self.send(hello)
+        Thread(target=self.__read_loop, daemon=True).start()
+
+    def sendall(self, data: bytes):
+        with self.__send_lock:
+            self.__socket.sendall(data)
+
+    def send(self, payload: dict):
+        send_frame(self, json.dumps(payload).encode())
+
+    def request(self, payload: dict, request_id: int, timeout: float) -> dict:
+        """Send a request and wait for the response with the same `requestId`
+        """
+        future = Future()
+        self.__pending[request_id] = future
+        payload['requestId'] = request_id
+        try:
+            self.send(payload)
+            return future.result(timeout)
+        finally:
+            self.__pending.pop(request_id, None)
+
+    def __read_loop(self):
+        decoder = FrameDecoder()
+        try:
+            while True:
+                for frame in decoder.recv_frames(self.__socket):
+                    request_json = json.loads(frame.decode())
+                    future = self.__pending.get(request_json.get('requestId'))
+                    if future is not None:
+                        future.set_result(request_json)
+                    else:
+                        self.__on_request(request_json, self)
+        except (ConnectionClosedError, OSError) as e:
+            self.__logger.warning(f"Link to node {self.peer_node} lost: {e}")
+        finally:
+            self.close()
+
+    def close(self):
+        self.closed = True
+        for future in list(self.__pending.values()):
+            if not future.done():
+                future.set_exception(ConnectionError(f"Link to node {self.peer_node} closed"))
+        self.__socket.close()
+
+
+class Cluster():
+    """Membership of one node in a cluster of OQSServer nodes.
+    Every account UUID has a home node on a consistent hash ring. The home node keeps
+    the directory record and the offline messages of the account, and knows on which
+    nodes it is online. Nodes talk to each other over pools of persistent TLS links.
+
+    The node list is fixed while the cluster runs. Messages for an account, whose home node is
+    not reachable, are queued by the node they arrived on and handed off to the home node later.
+    Restarting the cluster with another node list moves accounts to new home nodes: their offline
+    messages are handed off the same way, their directory records are not moved.
+    """
+
+    def __init__(self, node_name: str, nodes: dict, secret: str, pool_size: int = 2, request_timeout: float = 5.0):
+        if node_name not in nodes:
+            raise ValueError(f"Node {node_name} is not part of the cluster")
+        self.__logger = logging.getLogger(__name__)
+        self.node_name = node_name
+        self.__nodes = nodes
+        self.__secret = secret
+        self.__pool_size = pool_size
+        self.__request_timeout = request_timeout
+        self.__ring = HashRing(nodes)
+        self.__context = create_peer_context()
+        self.__on_request = None
+        self.__request_ids = itertools.count(1)
+
+        # Node name -> list of PeerLink, created on first use. Connecting to one node never waits for another
+        self.__pools = {node: [None] * pool_size for node in nodes if node != node_name}
+        self.__pool_locks = {node: Lock() for node in self.__pools}
+        # Node name -> failed connects in a row, and monotonic time of the next attempt
+        self.__failed_connects = {node: 0 for node in self.__pools}
+        self.__retry_at = {node: 0.0 for node in self.__pools}
+        # Node name -> requests, the sender thread of the node sends in order
+        self.__outboxes = {node: Queue() for node in self.__pools}
+        # UUID string -> frozenset of other nodes, the account is online on. Only kept by the home node
+        self.__presence = {}
+        self.__presence_lock = Lock()
+
+    def start(self, on_request):
+        """Set the handler for requests, that arrive on outgoing links
+
+        Parameters
+        ----------
+        on_request : callable
+            Called with the request JSON and the link for every request, that arrives on an outgoing link
+        """
+        self.__on_request = on_request
+        for node in self.__outboxes:
+            Thread(target=self.__send_loop, args=(node,), name=f"ClusterSender-{node}", daemon=True).start()
+
+    def home_of(self, client_uuid: str) -> str:
+        return self.__ring.node_for(str(client_uuid))
+
+    def is_home(self, client_uuid: str) -> bool:
+        return self.home_of(client_uuid) == self.node_name
+
+    def authenticate(self, request_json) -> bool:
+        """Check the PEER_HELLO of an incoming link
+        """
+        return request_json.get('node') in self.__nodes and \
+            hmac.compare_digest(str(request_json.get('secret', '')), self.__secret)
+
+    def __link(self, node: str, key: str = None) -> PeerLink:
+        """Link of the pool. Requests with the same key always use the same link, so they stay in order
+        """
+        pool = self.__pools[node]
+        index = zlib.crc32(key.encode()) % self.__pool_size if key else next(self.__request_ids) % self.__pool_size
+        with self.__pool_locks[node]:
+            link = pool[index]
+            if link is None or link.closed:
+                retry_in = self.__retry_at[node] - time.monotonic()
+                if retry_in > 0:
+                    raise ConnectionRefusedError(f"Node {node} is down, next attempt in {retry_in:.1f}s")
+                payload = {}
+                payload['requestType'] = RequestType.PEER_HELLO
+                payload['node'] = self.node_name
+                payload['secret'] = self.__secret
+                try:
+                    link = PeerLink(node, self.__nodes[node], self.__context, payload, self.__on_request,
+                                    self.__request_timeout)
+                except OSError:
+                    self.__failed_connects[node] += 1
+                    delay = PEER_RETRY_DELAY * 2 ** min(self.__failed_connects[node] - 1, 16)
+                    self.__retry_at[node] = time.monotonic() + min(delay, PEER_RETRY_MAX_DELAY)
+                    raise
+                self.__failed_connects[node] = 0
+                pool[index] = link
+            return link
+
+    def send(self, node: str, payload: dict, key: str = None) -> bool:
+        """Send a request to another node, without waiting for a response
+
+        Returns
+        -------
+        bool
+            False, if the node is not reachable
+        """
+        try:
+            self.__link(node, key).send(payload)
+            return True
+        except OSError as e:
+            self.__logger.warning(f"Node {node} is not reachable: {e}")
+            return False
+
+    def post(self, node: str, payload: dict, key: str = None):
+        """Queue a request for the sender thread of the node, like `send`. Never blocks, so it can
+        be called while holding a lock. Requests posted to the same node are sent in order
+        """
+        self.__outboxes[node].put((payload, key))
+
+    def __send_loop(self, node: str):
+        while True:
+            item = self.__outboxes[node].get()
+            if item is _STOP:
+                return
+            payload, key = item
+            self.send(node, payload, key)
+
+    def request(self, node: str, payload: dict) -> dict:
+        """Send a request to another node and wait for its response
+        """
+        return self.__link(node).request(payload, next(self.__request_ids), self.__request_timeout)
+
+    def lookup(self, client_uuids) -> list:
+        """Directory records of accounts, that are homed on other nodes. One request per home node
+
+        Returns
+        -------
+        list
+            Dicts with `uuid`, `name` and the Base64 encoded `publicKey` of every found account
+        """
+        by_node = {}
+        for client_uuid in client_uuids:
+            by_node.setdefault(self.home_of(client_uuid), []).append(str(client_uuid))
+
+        clients = []
+        for node, node_uuids in by_node.items():
+            payload = {}
+            payload['requestType'] = RequestType.PEER_LOOKUP_REQUEST
+            payload['uuids'] = node_uuids
+            try:
+                clients.extend(self.request(node, payload)['clients'])
+            except (OSError, FutureTimeoutError) as e:
+                self.__logger.warning(f"Directory lookup on node {node} failed: {e}")
+        return clients
+
+    def set_presence(self, client_uuid: str, node: str, online: bool):
+        with self.__presence_lock:
+            nodes = self.__presence.get(client_uuid, frozenset())
+            nodes = nodes | {node} if online else nodes - {node}
+            if nodes:
+                self.__presence[client_uuid] = nodes
+            else:
+                self.__presence.pop(client_uuid, None)
+
+    def nodes_for(self, client_uuid: str) -> frozenset:
+        """Other nodes, an account homed on this node is online on
+        """
+        return self.__presence.get(str(client_uuid), frozenset())
+
+    def close(self):
+        for node, pool in self.__pools.items():
+            self.__outboxes[node].put(_STOP)
+            with self.__pool_locks[node]:
+                for link in pool:
+                    if link is not None:
+                        link.close()
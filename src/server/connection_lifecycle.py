@@ -0,0 +1,173 @@
+from threading import Lock, Thread, Event
+import logging
+import os
+import time
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
+# Seconds between heartbeats of a client, that has nothing else to send. Announced in HELLO_RESPONSE
+HEARTBEAT_INTERVAL = 30.0
+# Connections, that were told the heartbeat interval and sent nothing for this long,
+# are closed. Allows two lost heartbeats
+IDLE_TIMEOUT = 3 * HEARTBEAT_INTERVAL
+# Seconds a new connection may take for the TLS handshake
+HANDSHAKE_TIMEOUT = 10.0
+# Seconds the accept loop waits after accept failed, e.g. because every file descriptor is in use
+ACCEPT_RETRY_DELAY = 0.1
+# File descriptors kept free for the database, the listening socket, the metrics endpoint and
+# the links between workers and nodes, when the connection cap is derived from the limit
+RESERVED_FILE_DESCRIPTORS = 64
+
+# Caps, that can reject a new connection
+CAP_GLOBAL = 'global'
+CAP_PER_IP = 'per_ip'
+
+
+def open_file_descriptors():
+    """Amount of open file descriptors of this process
+
+    Returns
+    -------
+    int
+        Open file descriptors, or None where they can not be counted
+    """
+    for fd_dir in ('/proc/self/fd', '/dev/fd'):
+        try:
+            # Listing the directory opens a descriptor itself
+            return len(os.listdir(fd_dir)) - 1
+        except OSError:
+            continue
+    return None
+
+
+def file_descriptor_limit():
+    """Soft limit of open file descriptors of this process
+
+    Returns
+    -------
+    int
+        The limit, or None if there is none or it is not available
+    """
+    if resource is None:
+        return None
+    soft, _ = resource.getrlimit(resource.RLIMIT_NOFILE)
+    return None if soft == resource.RLIM_INFINITY else soft
+
+
+class ConnectionLifecycle():
+    """Client connections of a server process, from accept until teardown. New connections are
+    admitted within the global and the per address cap. Connections, that were told the heartbeat
+    interval and sent nothing within the idle timeout, are closed by a reaper thread, so the engine
+    tears them down like every other lost connection. Thread safe.
+    """
+
+    def __init__(self, idle_timeout: float = IDLE_TIMEOUT, max_connections: int = None,
+                 max_connections_per_ip: int = None, metrics=None):
+        self.__logger = logging.getLogger(__name__)
+        # None disables reaping
+        self.idle_timeout = idle_timeout
+        # None derives the cap from the file descriptor limit, once the server starts
+        self.max_connections = max_connections
+        # None disables the cap. Clients behind the same NAT share an address
+        self.max_connections_per_ip = max_connections_per_ip
+        self.__metrics = metrics
+        self.__lock = Lock()
+        self.__admitted = 0
+        # Remote address -> admitted connections
+        self.__per_ip = {}
+        # Connections after the TLS handshake, checked by the reaper
+        self.__tracked = set()
+        self.__stopped = Event()
+
+    @property
+    def admitted(self) -> int:
+        """Open connections, that count against the caps
+        """
+        return self.__admitted
+
+    @property
+    def addresses(self) -> int:
+        """Distinct remote addresses with open connections
+        """
+        return len(self.__per_ip)
+
+    def start(self):
+        """Fix the connection cap and start the reaper. Called by the engines, once the
+        file descriptor limit is set, before clients are accepted
+        """
+        if self.max_connections is None:
+            limit = file_descriptor_limit()
+            if limit is not None:
+                self.max_connections = max(limit - RESERVED_FILE_DESCRIPTORS, 1)
+        self.__logger.info(f"Connection caps: {self.max_connections} in total, "
+                           f"{self.max_connections_per_ip} per address. Idle timeout: {self.idle_timeout}s")
+        if self.idle_timeout is not None:
+            Thread(target=self.__reap_loop, name="ConnectionReaper", daemon=True).start()
+
+    def stop(self):
+        self.__stopped.set()
+
+    def admit(self, address: str):
+        """Count a new connection against the caps. Every admitted connection has to be released
+
+        Parameters
+        ----------
+        address : str
+            Remote IP address of the connection
+
+        Returns
+        -------
+        str
+            None, if the connection is admitted. Otherwise the cap, that is reached, CAP_GLOBAL or CAP_PER_IP
+        """
+        with self.__lock:
+            per_ip = self.__per_ip.get(address, 0)
+            if self.max_connections is not None and self.__admitted >= self.max_connections:
+                cap = CAP_GLOBAL
+            elif self.max_connections_per_ip is not None and per_ip >= self.max_connections_per_ip:
+                cap = CAP_PER_IP
+            else:
+                self.__admitted += 1
+                self.__per_ip[address] = per_ip + 1
+                return None
+        if self.__metrics is not None:
+            self.__metrics.count_rejected_connection(cap)
+        return cap
+
+    def release(self, address: str):
+        """Free the slot of an admitted connection, once it is closed
+        """
+        with self.__lock:
+            self.__admitted -= 1
+            per_ip = self.__per_ip.pop(address, 0) - 1
+            if per_ip > 0:
+                self.__per_ip[address] = per_ip
+
+    def track(self, connection):
+        """Close the connection, once its `last_activity` is older than the idle timeout. Only connections
+        with `heartbeats` set are closed, clients without HELLO_REQUEST don't know they have to send any.
+        Links from other nodes are never closed
+        """
+        with self.__lock:
+            self.__tracked.add(connection)
+
+    def untrack(self, connection):
+        with self.__lock:
+            self.__tracked.discard(connection)
+
+    def __reap_loop(self):
+        # A connection is closed at most a quarter of the timeout late
+        while not self.__stopped.wait(self.idle_timeout / 4):
+            deadline = time.monotonic() - self.idle_timeout
+            with self.__lock:
+                idle = [connection for connection in self.__tracked if connection.peer_node is None
+                        and connection.heartbeats and connection.last_activity < deadline]
+                self.__tracked.difference_update(idle)
+            for connection in idle:
+                self.__logger.info(f"Closing connection idle for more than {self.idle_timeout}s")
+                if self.__metrics is not None:
+                    self.__metrics.count_idle_close()
+                connection.close()
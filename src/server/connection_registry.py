@@ -0,0 +1,81 @@
+from threading import Lock
+
+
+class ConnectionRegistry():
+    """Routing table of all online clients, keyed by UUID.
+    A UUID can have several live connections at the same time, e.g. when the same
+    account is logged in twice. Lookups are a single dict access, independent of the
+    amount of online clients.
+    """
+
+    def __init__(self):
+        self.__lock = Lock()
+        # UUID string -> tuple of ClientKeyPair. Tuples are replaced, never mutated,
+        # so readers don't need the lock
+        self.__connections = {}
+
+    def register(self, client_key_pair):
+        """Add a logged in client
+
+        Parameters
+        ----------
+        client_key_pair : ClientKeyPair
+            Key pair holding the connection of the client
+
+        Returns
+        -------
+        bool
+            True, if this is the first connection of the client
+        """
+        key = str(client_key_pair.client_id)
+        with self.__lock:
+            connections = self.__connections.get(key, ())
+            if not any(c is client_key_pair for c in connections):
+                self.__connections[key] = connections + (client_key_pair,)
+            return not connections
+
+    def unregister(self, client_key_pair):
+        """Remove a client, e.g. after it disconnected
+
+        Parameters
+        ----------
+        client_key_pair : ClientKeyPair
+            Key pair, that was registered before
+
+        Returns
+        -------
+        bool
+            True, if this was the last connection of the client
+        """
+        key = str(client_key_pair.client_id)
+        with self.__lock:
+            previous = self.__connections.get(key, ())
+            connections = tuple(c for c in previous if c is not client_key_pair)
+            if connections:
+                self.__connections[key] = connections
+            else:
+                self.__connections.pop(key, None)
+            return bool(previous) and not connections
+
+    def connections_for(self, uuid: str) -> tuple:
+        """All live connections of the client with specified UUID
+
+        Parameters
+        ----------
+        uuid : str
+            UUID of the client
+
+        Returns
+        -------
+        tuple
+            Tuple of ClientKeyPair, empty if the client is offline
+        """
+        return self.__connections.get(str(uuid), ())
+
+    def is_online(self, uuid: str) -> bool:
+        return str(uuid) in self.__connections
+
+    def online_count(self) -> int:
+        """Amount of distinct online UUIDs
+        """
+        return len(self.__connections)
@@ -0,0 +1,75 @@
+from collections import OrderedDict
+from dataclasses import dataclass
+from threading import Lock
+import base64
+
+
+@dataclass(eq=True, frozen=True)
+class DirectoryRecord:
+    uuid: str
+    name: str
+    public_key: bytes
+    # Base64 form, as sent in CONNECT_WITH_CONTACT_RESPONSE
+    public_key_b64: str
+    # The client establishes sessions. Otherwise contacts send the KEM ciphertext with every message
+    sessions: bool = False
+
+    @classmethod
+    def from_row(cls, row) -> 'DirectoryRecord':
+        """Create a record from a row of the `clients` table
+        """
+        return cls(
+            uuid=row['uuid'],
+            name=row['name'],
+            public_key=row['public_key'],
+            public_key_b64=base64.b64encode(row['public_key']).decode('ascii'),
+            sessions=bool(row['sessions'])
+        )
+
+
+class DirectoryCache():
+    """Bounded, thread safe LRU cache of client directory records, keyed by UUID.
+    Records have no expiry. The server invalidates a record, once the account is committed
+    and whenever a login changes the capabilities of the client, otherwise it stays cached
+    until it is evicted. Lookups of unknown clients are not cached.
+    """
+
+    def __init__(self, capacity: int = 4096):
+        self.__capacity = capacity
+        self.__records = OrderedDict()
+        self.__lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, uuid: str):
+        """Cached record of the client, or None on a miss
+        """
+        uuid = str(uuid)
+        with self.__lock:
+            record = self.__records.get(uuid)
+            if record is None:
+                self.misses += 1
+                return None
+            self.__records.move_to_end(uuid)
+            self.hits += 1
+            return record
+
+    def put(self, record: DirectoryRecord):
+        """Cache a record and evict the least recently used one, if the cache is full
+        """
+        with self.__lock:
+            self.__records[record.uuid] = record
+            self.__records.move_to_end(record.uuid)
+            if len(self.__records) > self.__capacity:
+                self.__records.popitem(last=False)
+
+    def invalidate(self, uuid: str):
+        """Drop the record of a client, after its account was inserted or updated
+        """
+        with self.__lock:
+            self.__records.pop(str(uuid), None)
+
+    def stats(self) -> dict:
+        with self.__lock:
+            return {"size": len(self.__records), "capacity": self.__capacity,
+                    "hits": self.hits, "misses": self.misses}
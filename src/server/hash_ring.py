@@ -0,0 +1,45 @@
+from bisect import bisect
+import hashlib
+
+
+class HashRing():
+    """Consistent hash ring, that maps account UUIDs to their home node.
+    Every node is placed on the ring `replicas` times, so a cluster started with
+    a node more or less only moves the accounts of that node's ring segments.
+    The nodes are fixed for the life of the ring.
+    """
+
+    def __init__(self, nodes, replicas: int = 128):
+        self.__replicas = replicas
+        self.__ring = []
+        self.__points = []
+        for node in nodes:
+            self.__add_node(node)
+
+    @staticmethod
+    def __hash(key: str) -> int:
+        return int.from_bytes(hashlib.sha1(key.encode()).digest()[:8], 'big')
+
+    def __add_node(self, node: str):
+        for replica in range(self.__replicas):
+            self.__ring.append((self.__hash(f"{node}#{replica}"), node))
+        self.__ring.sort()
+        self.__points = [point for point, _ in self.__ring]
+
+    def node_for(self, key: str) -> str:
+        """Home node of the key
+
+        Parameters
+        ----------
+        key : str
+            Account UUID
+
+        Returns
+        -------
+        str
+            Name of the node
+        """
+        if not self.__ring:
+            raise ValueError("Hash ring has no nodes")
+        index = bisect(self.__points, self.__hash(str(key))) % len(self.__ring)
+        return self.__ring[index][1]
@@ -0,0 +1,119 @@
+from concurrent.futures import wait
+from threading import Lock
+import time
+
+
+class OfflineMessageStore():
+    """Store and forward queue for messages to clients, that are not online.
+    Messages are read in batches with keyset pagination over `(recipient, id)`,
+    so the backlog is never loaded into memory as a whole.
+    """
+
+    def __init__(self, storage):
+        self.__storage = storage
+        # Recipient -> Future of the last write for it, until it is committed. The storage commits
+        # in order, so once it is done, every earlier write for the recipient is committed as well
+        self.__pending_writes = {}
+        self.__lock = Lock()
+
+    def __track(self, recipient: str, future):
+        with self.__lock:
+            self.__pending_writes[recipient] = future
+        future.add_done_callback(lambda _: self.__untrack(recipient, future))
+        return future
+
+    def __untrack(self, recipient: str, future):
+        with self.__lock:
+            if self.__pending_writes.get(recipient) is future:
+                del self.__pending_writes[recipient]
+
+    def enqueue(self, recipient: str, envelope: bytes):
+        """Persist an undeliverable envelope
+
+        Parameters
+        ----------
+        recipient : str
+            UUID of the offline client
+        envelope : bytes
+            Frame payload to deliver, once the client logs in
+
+        Returns
+        -------
+        Future
+            Resolves once the envelope is committed
+        """
+        return self.__track(str(recipient), self.__storage.write("""
+            INSERT INTO offline_messages (recipient, envelope, created)
+            VALUES (
+                :recipient,
+                :envelope,
+                :created
+            )
+        """, {
+            "recipient": str(recipient),
+            "envelope": bytes(envelope),
+            "created": int(time.time())
+        }))
+
+    def recipients(self) -> list:
+        """UUIDs of all clients with pending envelopes
+        """
+        return [row[0] for row in self.__storage.read_all("SELECT DISTINCT recipient FROM offline_messages")]
+
+    def pending_batch(self, recipient: str, after_id: int = 0, limit: int = 200, max_bytes: int = None) -> list:
+        """Next batch of pending envelopes, oldest first. Waits until the envelopes, that were
+        enqueued or deleted for the recipient before, are committed, so no envelope is skipped
+
+        Parameters
+        ----------
+        recipient : str
+            UUID of the client
+        after_id : int, optional
+            Only return envelopes with a bigger id, by default 0
+        limit : int, optional
+            Max size of the batch, by default 200
+        max_bytes : int, optional
+            Max size of the envelopes of the batch, by default unlimited. The first envelope is always included
+
+        Returns
+        -------
+        list
+            List of `(id, envelope)` tuples
+        """
+        with self.__lock:
+            pending_write = self.__pending_writes.get(str(recipient))
+        if pending_write is not None:
+            wait([pending_write])
+        rows = self.__storage.read_all("""
+            SELECT id, envelope FROM offline_messages
+            WHERE recipient = :recipient AND id > :afterId
+            ORDER BY id
+            LIMIT :limit
+        """, {"recipient": str(recipient), "afterId": after_id, "limit": limit})
+        batch = []
+        size = 0
+        for row in rows:
+            size += len(row[1])
+            if batch and max_bytes is not None and size > max_bytes:
+                break
+            batch.append((row[0], row[1]))
+        return batch
+
+    def delete_delivered(self, recipient: str, up_to_id: int):
+        """Bulk delete all envelopes up to an id, after the client confirmed the delivery
+
+        Parameters
+        ----------
+        recipient : str
+            UUID of the client
+        up_to_id : int
+            Highest id confirmed by the client
+
+        Returns
+        -------
+        Future
+            Resolves once the deletion is committed
+        """
+        return self.__track(str(recipient), self.__storage.write("""
+            DELETE FROM offline_messages WHERE recipient = :recipient AND id <= :upToId
+        """, {"recipient": str(recipient), "upToId": up_to_id}))
@@ -1,20 +1,40 @@
-from socket import AF_INET, socket, SOCK_STREAM
-from threading import Thread, currentThread
+from socket import AF_INET, socket, SOCK_STREAM, SOL_SOCKET, SO_REUSEPORT
+from threading import Thread, Lock, Event, currentThread
 import ssl
 from dataclasses import dataclass
 import logging
 import json
 import uuid
+import time
+import ipaddress
 from util.oqs_utils import RequestType
+from util.frame_codec import FrameDecoder, ConnectionClosedError, FrameTooLargeError, send_frame, encode_frame, \
+    FRAME_HEADER, MAX_FRAME_SIZE, UNAUTHENTICATED_FRAME_SIZE
+from util.wire_format import WIRE_FORMAT_JSON, WIRE_FORMAT_BINARY, FrameKind, is_binary_frame, frame_kind, \
+    unpack_send_message, pack_deliver_message, unpack_deliver_message, deliver_message_to_json, \
+    unpack_group_send, pack_group_deliver, unpack_group_deliver, group_deliver_to_json, unpack_attachment_chunk, \
+    pack_attachment_chunk, unpack_attachment_ack, pack_attachment_ack, requires_session, CAPABILITY_SESSIONS, \
+    MALFORMED_FRAME_ERRORS
 import base64
-import sqlite3
-from util.security_util import generate_random_seed_phrase
+from server.connection_registry import ConnectionRegistry
+from server.offline_store import OfflineMessageStore
+from server.server_storage import ServerStorage
+from server.directory_cache import DirectoryCache, DirectoryRecord
+from server.client_connection import ClientConnection
+from server.outbound_queue import OutboundQueueFull, OUTBOUND_QUEUE_SIZE, OVERFLOW_POLICIES, OVERFLOW_SPILL, \
+    OVERFLOW_DROP, OVERFLOW_DISCONNECT
+from server.connection_lifecycle import ConnectionLifecycle, HEARTBEAT_INTERVAL, IDLE_TIMEOUT, HANDSHAKE_TIMEOUT, \
+    ACCEPT_RETRY_DELAY, open_file_descriptors, file_descriptor_limit
+from server.seed_phrase_pool import SeedPhrasePool, SEED_PHRASE_POOL_SIZE
+from server.server_metrics import ServerMetrics, start_metrics_endpoint
+from server.sampling_profiler import SamplingProfiler, parse_interval
+from server.cluster import HANDOFF_RETRY_DELAY
 import sys
 import os
 
 @dataclass(eq=True, frozen=True)
 class ClientKeyPair:
-    client: socket
+    client: ClientConnection
     client_public_key: bytes
     client_name: str
     client_id: uuid.UUID
@@ -26,118 +46,591 @@ logging.basicConfig(
 )
 
 
+def create_server_context() -> ssl.SSLContext:
+    """Create the server side TLS context with the Falcon512 certificate chain.
+    Shared by all server engines.
+    """
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+
+    dirname = os.path.dirname(__file__)
+    context.load_cert_chain(
+        certfile=os.path.join(dirname, '../pqca/server/falcon512_srv.crt'),
+        keyfile=os.path.join(dirname, '../pqca/server/falcon512_srv.key')
+    )
+    # Session tickets let reconnecting clients resume their session, without a full handshake
+    # and certificate verification. Ticket keys belong to the context, so to the server process
+    context.options &= ~ssl.OP_NO_TICKET
+    context.num_tickets = 2
+    return context
+
+
 class OQSServer():
     """OQSServer class. Middleman between all clients trying to communicate with each other.
     """
-    def __init__(self, host: str = 'localhost', port: int = 33000, bufsize: int = 50000):
+    def __init__(self, host: str = 'localhost', port: int = 33000, bufsize: int = 50000,
+                 offline_batch_size: int = 200, directory_cache_size: int = 4096,
+                 reuse_port: bool = False, router=None, cluster=None, db_path: str = "server/pq-chat-server.db",
+                 metrics_port: int = None, outbound_queue_size: int = OUTBOUND_QUEUE_SIZE,
+                 overflow_policy: str = OVERFLOW_SPILL, heartbeat_interval: float = HEARTBEAT_INTERVAL,
+                 idle_timeout: float = IDLE_TIMEOUT, max_connections: int = None, max_connections_per_ip: int = None,
+                 seed_phrase_pool_size: int = SEED_PHRASE_POOL_SIZE, log_level=logging.DEBUG):
         self.__logger = logging.getLogger(__name__)
-        self.__logger.setLevel(logging.DEBUG)
+        # Payloads are logged at DEBUG level, which is too expensive for production. start_server.py picks the level
+        self.__logger.setLevel(log_level)
         self.__host = host
         self.__port = port
         self.__address = (host, port)
         self.__bufsize = bufsize
+        self.__offline_batch_size = offline_batch_size
+        if overflow_policy not in OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown overflow policy {overflow_policy}")
+        # Bytes, that may wait per connection, and what happens to envelopes beyond that
+        self.outbound_queue_size = outbound_queue_size
+        # An offline batch is queued as a whole. Half the outbound queue leaves room for the live frames before it
+        self.__offline_batch_max_bytes = outbound_queue_size // 2
+        self.__overflow_policy = overflow_policy
+        if idle_timeout is not None and idle_timeout <= heartbeat_interval:
+            raise ValueError("The idle timeout has to be longer than the heartbeat interval")
+        self.__heartbeat_interval = heartbeat_interval
 
         self.keep_running = True
-
-        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
-
-        dirname = os.path.dirname(__file__)
-        context.load_cert_chain(
-            certfile=os.path.join(dirname, '../pqca/server/falcon512_srv.crt'),
-            keyfile=os.path.join(dirname, '../pqca/server/falcon512_srv.key')
-        )
-
-        self.__server = socket(AF_INET, SOCK_STREAM, 0)
-        self.__server.bind(self.__address)
-        self.__server = context.wrap_socket(self.__server, server_side=True)
-        self.__clients = []
+        self._context = create_server_context()
+        self.__server = None
+        self.__clients = ConnectionRegistry()
+        # Set in supervisor mode: workers share the port and route messages through the WorkerRouter
+        self._reuse_port = reuse_port
+        self._router = router
+        # Set in cluster mode: accounts are homed on the node, their UUID hashes to
+        self._cluster = cluster
+        # Set, once offline messages of clients homed on other nodes have to be handed off to their home node
+        self.__handoff_pending = Event()
+        self.__presence_lock = Lock()
+        self.directory_cache = DirectoryCache(directory_cache_size)
+        # Served over HTTP on localhost, if a metrics port is set. Always available with STATS_REQUEST
+        self.metrics = ServerMetrics()
+        self.profiler = SamplingProfiler()
+        self.__metrics_port = metrics_port
+        self.__metrics_endpoint = None
+        # Connection caps and idle timeout, shared by the engines
+        self.lifecycle = ConnectionLifecycle(idle_timeout, max_connections, max_connections_per_ip,
+                                             metrics=self.metrics)
+        # Seed phrases for new accounts, generated ahead once the server starts
+        self.seed_phrases = SeedPhrasePool(seed_phrase_pool_size)
+        # Binary frame kind -> (name in the metrics, handler)
+        self.__binary_handlers = {
+            FrameKind.SEND_MESSAGE: ('BINARY_SEND_MESSAGE', self.__send_binary_message_to_contact),
+            FrameKind.GROUP_SEND: ('BINARY_GROUP_SEND', self.__send_group_message),
+            FrameKind.ATTACHMENT_CHUNK: ('BINARY_ATTACHMENT_CHUNK', self.__relay_attachment_chunk),
+            FrameKind.ATTACHMENT_ACK: ('BINARY_ATTACHMENT_ACK', self.__relay_attachment_ack)
+        }
 
         # DB
-        self.__setup_db()
+        self.__setup_db(db_path)
+        self.__register_gauges()
 
-    def __setup_db(self):
-        """Ran at every initialization. Sets up SQLLite DB with the `setup-server.sql` file
+    def __setup_db(self, db_path: str):
+        """Ran at every initialization. Sets up SQLLite DB with the `setup-server.sql` file.
+        Writes are group committed by the storage writer thread, so request handlers never wait for an fsync.
         """
         self.__logger.info("Setting up Database...")
-        self.__connection = sqlite3.connect("server/pq-chat-server.db", check_same_thread=False)
-        self.__connection.row_factory = sqlite3.Row
-        self.__cursor = self.__connection.cursor()
+        self.__storage = ServerStorage(db_path, "server/setup-server.sql", metrics=self.metrics)
+        self.__offline_store = OfflineMessageStore(self.__storage)
 
-        setup_file = open("server/setup-server.sql")
-        setup_file_str = setup_file.read()
-        self.__cursor.executescript(setup_file_str)
-        self.__connection.commit()
+    def __register_gauges(self):
+        self.metrics.register_gauge("online_clients", "Distinct logged in clients", self.__clients.online_count)
+        self.metrics.register_gauge("storage_pending_writes", "Writes waiting for the next group commit",
+                                    self.__storage.pending_writes)
+        self.metrics.register_gauge("directory_cache_size", "Cached directory records",
+                                    lambda: self.directory_cache.stats()["size"])
+        self.metrics.register_gauge("directory_cache_hits", "Directory cache hits since start",
+                                    lambda: self.directory_cache.hits)
+        self.metrics.register_gauge("directory_cache_misses", "Directory cache misses since start",
+                                    lambda: self.directory_cache.misses)
+        self.metrics.register_gauge("seed_phrases_available", "Pre-generated seed phrases for new accounts",
+                                    lambda: self.seed_phrases.available)
+        self.metrics.register_gauge("seed_phrase_pool_misses",
+                                    "New accounts since start, that had to generate their seed phrase",
+                                    lambda: self.seed_phrases.misses)
+        self.metrics.register_gauge("admitted_connections", "Open client connections, counted against the caps",
+                                    lambda: self.lifecycle.admitted)
+        self.metrics.register_gauge("connection_addresses", "Distinct remote addresses with open connections",
+                                    lambda: self.lifecycle.addresses)
+        if open_file_descriptors() is not None:
+            self.metrics.register_gauge("open_file_descriptors", "Open file descriptors of the process",
+                                        open_file_descriptors)
+        if file_descriptor_limit() is not None:
+            self.metrics.register_gauge("file_descriptor_limit", "Soft limit of open file descriptors",
+                                        file_descriptor_limit)
 
     def __accept_connections(self):
         """Listen for new clients to connect to socket
         """
         while self.keep_running:
-            client, client_address = self.__server.accept()
+            try:
+                client, client_address = self.__server.accept()
+            except OSError as e:
+                # E.g. out of file descriptors. The connection stays in the backlog until one is free
+                self.__logger.error(f"Accepting a connection failed: {e}")
+                time.sleep(ACCEPT_RETRY_DELAY)
+                continue
+            cap = self.lifecycle.admit(client_address[0])
+            if cap is not None:
+                self.__logger.warning(f"Connection from {client_address[0]} rejected, {cap} connection cap reached")
+                client.close()
+                continue
             self.__logger.info(f"Client with address \"{client_address[0]}:{client_address[1]}\" has "
                                f"connected")
-            Thread(target=self.__handle_client, args=(client,)).start()
+            Thread(target=self.__handle_client, args=(client, client_address[0])).start()
+
+    def __tls_handshake(self, client):
+        """TLS handshake of a new connection. Runs on the client thread, so a slow or
+        failing handshake never blocks the accept loop.
 
-    def __handle_client(self, client):
+        Returns
+        -------
+        ssl.SSLSocket
+            Socket of the client, or None if the handshake failed
+        """
+        start = time.perf_counter()
+        # A client, that never finishes the handshake, must not keep its thread forever
+        client.settimeout(HANDSHAKE_TIMEOUT)
+        try:
+            tls_client = self._context.wrap_socket(client, server_side=True)
+            tls_client.settimeout(None)
+        except (ssl.SSLError, OSError) as e:
+            self.metrics.observe_handshake(time.perf_counter() - start, failed=True)
+            self.__logger.info(f"TLS handshake failed: {e}")
+            client.close()
+            return None
+        self.metrics.observe_handshake(time.perf_counter() - start, resumed=tls_client.session_reused)
+        return tls_client
+
+    def __handle_client(self, client, address: str):
         """Main loop for every client connected. Listens for all requests
 
         Parameters
         ----------
         client : socket
-            socket of newly connected client
+            socket of newly connected client, before the TLS handshake
+        address : str
+            Remote IP address, the connection was admitted for
         """
+        client = self.__tls_handshake(client)
+        if client is None:
+            self.lifecycle.release(address)
+            return
         client_key_pair = None
-        while self.keep_running:
-            msg = client.recv(self.__bufsize)
+        connection = ClientConnection(client, self.outbound_queue_size)
+        decoder = FrameDecoder(self.__bufsize, UNAUTHENTICATED_FRAME_SIZE)
+        self.metrics.connection_opened()
+        self.lifecycle.track(connection)
+        try:
+            while self.keep_running:
+                try:
+                    frames = decoder.recv_frames(client)
+                except (ConnectionClosedError, OSError):
+                    self.__logger.info("Client disconnected")
+                    break
+                connection.last_activity = time.monotonic()
+
+                # A single read may contain several pipelined requests
+                try:
+                    while frames:
+                        for frame in frames:
+                            client_key_pair = self._handle_frame(frame, connection, client_key_pair)
+                        decoder.max_frame_size = self._max_frame_size(connection, client_key_pair)
+                        # Frames, that exceeded the limit before the login
+                        frames = decoder.feed(b"")
+                except ConnectionError as e:
+                    # E.g. the client does not read its replies
+                    self.__logger.info(f"Client connection lost: {e}")
+                    break
+        except FrameTooLargeError as e:
+            self.__logger.warning(f"Protocol violation by {address}, connection closed: {e}")
+        finally:
+            self.lifecycle.untrack(connection)
+            self.metrics.connection_closed()
+            self._client_disconnected(client_key_pair)
+            connection.close()
+            self.lifecycle.release(address)
+
+    def _max_frame_size(self, client, client_key_pair) -> int:
+        """Frame limit of a connection. Used by every server engine. Connections, that did not log in,
+        or authenticate as node, are limited to UNAUTHENTICATED_FRAME_SIZE
+        """
+        if client_key_pair is None and client.peer_node is None:
+            return UNAUTHENTICATED_FRAME_SIZE
+        return MAX_FRAME_SIZE
+
+    def _handle_frame(self, frame: bytes, client, client_key_pair):
+        """Dispatch a single frame, either binary or JSON. Used by every server engine.
+
+        Parameters
+        ----------
+        frame : bytes
+            Frame payload
+        client : ClientConnection
+            Connection the frame came from
+        client_key_pair : ClientKeyPair
+            Key pair of the logged in client, or None
+
+        Returns
+        -------
+        ClientKeyPair
+            Key pair of the client after the request
+        """
+        size = len(frame) + FRAME_HEADER.size
+        if is_binary_frame(frame):
+            start = time.perf_counter()
+            kind = frame_kind(frame)
+            if kind not in self.__binary_handlers:
+                self.__logger.warning(f"Unexpected binary frame of kind {kind}")
+                return client_key_pair
+            name, handler = self.__binary_handlers[kind]
+            try:
+                handler(frame, client_key_pair)
+            except MALFORMED_FRAME_ERRORS as e:
+                # Only the frame is dropped, the connection stays usable
+                self.__logger.warning(f"Malformed binary frame of kind {kind} dropped: {e}")
+            finally:
+                self.metrics.observe_request(name, time.perf_counter() - start, size)
+            return client_key_pair
+
+        request_json = json.loads(frame.decode())
+        return self._handle_request(request_json, client, client_key_pair, size)
+
+    def _handle_request(self, request_json, client, client_key_pair, size: int = 0):
+        """Dispatch a single decoded request. Used by every server engine.
+
+        Parameters
+        ----------
+        request_json : dict
+            Decoded request
+        client : ClientConnection
+            Connection the request came from. Only needs `sendall` and `wire_format`
+        client_key_pair : ClientKeyPair
+            Key pair of the logged in client, or None
+        size : int, optional
+            Size of the received frame, for the metrics, by default 0
+
+        Returns
+        -------
+        ClientKeyPair
+            Key pair of the client after the request
+        """
+        request_type_str = request_json['requestType']
+        request_type = RequestType[request_type_str]
+        start = time.perf_counter()
+        try:
+            return self.__dispatch_request(request_type, request_json, client, client_key_pair)
+        finally:
+            self.metrics.observe_request(request_type_str, time.perf_counter() - start, size)
+
+    def __dispatch_request(self, request_type, request_json, client, client_key_pair):
+        if request_type.startswith('PEER_'):
+            self.__handle_peer_request(request_type, request_json, client)
+
+        elif request_type == RequestType.HELLO_REQUEST:
+            self.__negotiate_wire_format(request_json, client)
+
+        elif request_type == RequestType.HEARTBEAT_REQUEST:
+            self.__answer_heartbeat(client)
+
+        elif request_type == RequestType.NEW_ACCOUNT_REQUEST:
+            client_key_pair = self.__handle_new_account(request_json, client)
+
+        elif request_type == RequestType.LOGIN_REQUEST:
+            client_key_pair = self.__login_client(request_json, client, client_key_pair)
+
+        elif request_type == RequestType.CONNECT_WITH_CONTACT_REQUEST:
+            self.__connect_with_contact(request_json['contactUUID'], client)
+
+        elif request_type == RequestType.CONNECT_WITH_CONTACTS_REQUEST:
+            self.__connect_with_contacts(request_json['contactUUIDs'], client)
+
+        elif request_type in (RequestType.SEND_MESSAGE_REQUEST,
+                              RequestType.SESSION_INIT_REQUEST,
+                              RequestType.SESSION_ACK_REQUEST,
+                              RequestType.ATTACHMENT_OFFER):
+            self.__send_message_to_contact(request_json, client_key_pair)
+
+        elif request_type == RequestType.OFFLINE_BATCH_ACK:
+            self.__acknowledge_offline_batch(request_json, client_key_pair)
+
+        elif request_type == RequestType.STATS_REQUEST:
+            self.__send_stats(request_json, client)
+        return client_key_pair
+
+    def __send_stats(self, request_json, client):
+        """Send the metrics of this server process. Only answered on connections from the same host.
+        The sampling profiler can be started and stopped with the optional `profiler` field,
+        the response to `stop` contains the collected stacks.
+        """
+        try:
+            is_local = ipaddress.ip_address(client.getpeername()[0]).is_loopback
+        except (AttributeError, OSError, ValueError):
+            is_local = False
+        if not is_local:
+            self.__logger.warning("STATS_REQUEST from a remote address dropped")
+            return
+
+        payload = {}
+        payload['requestType'] = RequestType.STATS_RESPONSE
+        if request_json.get('profiler') == 'start':
+            try:
+                self.profiler.start(parse_interval(request_json.get('interval', 0.005)))
+            except ValueError as e:
+                self.__logger.warning(f"Profiler not started: {e}")
+                payload['error'] = str(e)
+        elif request_json.get('profiler') == 'stop':
+            self.profiler.stop()
+            payload['profile'] = self.profiler.collapsed_stacks()
+        payload['profilerRunning'] = self.profiler.running
+        payload['stats'] = self.metrics.snapshot()
+        self.__broadcast_raw(client, json.dumps(payload).encode())
+
+    def __negotiate_wire_format(self, request_json, client):
+        """Pick the wire format for messages on this connection. Binary is used,
+        if the client supports it. Requests other than messages stay JSON.
+        """
+        supported = request_json.get('wireFormats', [])
+        client.wire_format = WIRE_FORMAT_BINARY if WIRE_FORMAT_BINARY in supported else WIRE_FORMAT_JSON
+        # Stored in the directory on login, so contacts know which message format the client reads
+        client.sessions = CAPABILITY_SESSIONS in request_json.get('capabilities', [])
 
-            request_json = json.loads(msg.decode())
-            request_type_str = request_json['requestType']
-            request_type = RequestType[request_type_str]
+        payload = {}
+        payload['requestType'] = RequestType.HELLO_RESPONSE
+        payload['wireFormat'] = client.wire_format
+        # Clients, that send nothing for longer than the idle timeout, are disconnected
+        payload['heartbeatInterval'] = self.__heartbeat_interval
+        client.heartbeats = True
+        json_data = json.dumps(payload)
+        self.__broadcast_raw(client, json_data.encode())
 
-            if request_type == RequestType.NEW_ACCOUNT_REQUEST:
-                client_key_pair = self.__handle_new_account(request_json, client)
+    def __answer_heartbeat(self, client):
+        """Answer a heartbeat, so the client knows the connection is still alive.
+        Receiving it already reset the idle timeout of the connection
+        """
+        payload = {}
+        payload['requestType'] = RequestType.HEARTBEAT_RESPONSE
+        self.__broadcast_raw(client, json.dumps(payload).encode())
 
-            elif request_type == RequestType.LOGIN_REQUEST:
-                client_key_pair = self.__login_client(request_json, client)
+    def _client_disconnected(self, client_key_pair):
+        """Remove the connection from the routing table. Called by the engines, once a connection is gone
 
-            elif request_type == RequestType.CONNECT_WITH_CONTACT_REQUEST:
-                self.__connect_with_contact(request_json['contactUUID'], client)
+        Parameters
+        ----------
+        client_key_pair : ClientKeyPair
+            Key pair of the logged in client, or None if it never logged in
+        """
+        if client_key_pair is not None:
+            self.__unregister(client_key_pair)
 
-            elif request_type == RequestType.SEND_MESSAGE_REQUEST:
-                self.__send_message_to_contact(request_json, client_key_pair)
+    def __register(self, client_key_pair):
+        """Add a connection to the routing table and announce the client to the other workers,
+        and to its home node
+        """
+        with self.__presence_lock:
+            if self.__clients.register(client_key_pair):
+                if self._router is not None:
+                    self._router.announce_online(client_key_pair.client_id)
+                self.__announce_presence(client_key_pair.client_id, True, client_key_pair.client.sessions)
 
-    def __login_client(self, request_json, client):
+    def __unregister(self, client_key_pair):
+        """Remove a connection from the routing table. Once the last connection of the client is gone,
+        the other workers and its home node are told, that it is not online here anymore
+        """
+        with self.__presence_lock:
+            if self.__clients.unregister(client_key_pair):
+                if self._router is not None:
+                    self._router.announce_offline(client_key_pair.client_id)
+                self.__announce_presence(client_key_pair.client_id, False)
+
+    def __announce_presence(self, client_uuid, online: bool, sessions: bool = False):
+        if self._cluster is None or self._cluster.is_home(client_uuid):
+            return
+        payload = {}
+        payload['requestType'] = RequestType.PEER_PRESENCE
+        payload['UUID'] = str(client_uuid)
+        payload['node'] = self._cluster.node_name
+        payload['online'] = online
+        # The home node keeps the capabilities of the client
+        payload['sessions'] = sessions
+        # Queued for the sender thread of the home node, so the presence lock is never held while connecting
+        self._cluster.post(self._cluster.home_of(client_uuid), payload, key=str(client_uuid))
+
+    def __login_client(self, request_json, client, previous_client_key_pair):
         """Login previously connected client
         """
-        db_client = self.__db_client_with_uuid(request_json['UUID'])
+        # A re-login on the same connection replaces the old routing entry
+        if previous_client_key_pair is not None:
+            self.__unregister(previous_client_key_pair)
+        db_client = self.__directory_record(request_json['UUID'])
+        if db_client is None:
+            self.__logger.warning(f"Login of unknown client {request_json['UUID']}")
+            return None
 
         client_key_pair = ClientKeyPair(
             client=client,
-            client_public_key=db_client['public_key'],
-            client_name=db_client['name'],
-            client_id=db_client['uuid']
+            client_public_key=db_client.public_key,
+            client_name=db_client.name,
+            client_id=db_client.uuid
         )
-        self.__clients.append(client_key_pair)
+        self.__register(client_key_pair)
+        if db_client.sessions != client.sessions:
+            self.__update_capabilities(db_client.uuid, client.sessions)
+        self.__send_offline_batch(client_key_pair)
         return client_key_pair
 
-    def __db_client_with_uuid(self, uuid: str):
-        """Search for a client in the database with specified UUID
+    def __update_capabilities(self, client_uuid: str, sessions: bool):
+        """Store the capabilities, a client announced on login. In cluster mode, they are stored by its home
+        node, other nodes pass them on with the presence of the client and only drop their cached record
         """
-        return self.__cursor.execute("""
-            SELECT c.* FROM clients c WHERE uuid = :uuid
-                              """, {"uuid": uuid}).fetchone()
-        
-    def __client_key_pair_with_uuid(self, uuid:str):
-        """Seach for the client_key_pair with specified UUID
+        self.directory_cache.invalidate(client_uuid)
+        if self._cluster is not None and not self._cluster.is_home(client_uuid):
+            return
+        self.__logger.debug(f"Client {client_uuid} establishes sessions: {sessions}")
+        # Otherwise the old record could be cached again, before the update is committed
+        self.__storage.set_sessions(client_uuid, sessions).add_done_callback(
+            lambda _: self.directory_cache.invalidate(client_uuid))
+
+    def __send_offline_batch(self, client_key_pair, after_id: int = 0):
+        """Deliver the next batch of messages, that were queued while the client was offline.
+        The whole batch is written at once, followed by an OFFLINE_BATCH_END frame.
+        The next batch is only sent, once the client acknowledged the previous one.
+
+        Parameters
+        ----------
+        client_key_pair : ClientKeyPair
+            Logged in client
+        after_id : int, optional
+            Id of the last acknowledged envelope, by default 0
         """
-        return next((contact for contact in self.__clients if str(contact.client_id) == uuid), None)
+        if self._cluster is not None and not self._cluster.is_home(client_key_pair.client_id):
+            # The home node sends the batches, once it received the presence of the client
+            client_key_pair.client.spilling = False
+            return
+        batch = self.__offline_store.pending_batch(client_key_pair.client_id, after_id, self.__offline_batch_size,
+                                                   self.__offline_batch_max_bytes)
+        if not batch:
+            # Every spilled envelope is delivered, the connection gets envelopes directly again
+            client_key_pair.client.offline_batch_pending = False
+            client_key_pair.client.spilling = False
+            return
+        self.__logger.info(f"Delivering {len(batch)} offline messages to {client_key_pair.client_id}")
+        self.__write_offline_batch(client_key_pair, [envelope for _, envelope in batch], batch[-1][0])
+
+    def __write_offline_batch(self, client_key_pair, envelopes: list, last_id: int):
+        """Write a batch of offline messages at once, followed by an OFFLINE_BATCH_END frame.
+        If it does not fit in the outbound queue, it is written once the queue drained. Until then,
+        envelopes for the client go to the offline store, like while it spills
+        """
+        client = client_key_pair.client
+        payload = {}
+        payload['requestType'] = RequestType.OFFLINE_BATCH_END
+        payload['lastId'] = last_id
+        envelopes = [self.__envelope_for(client, envelope) for envelope in envelopes]
+        frames = [encode_frame(envelope) for envelope in envelopes if envelope is not None]
+        frames.append(encode_frame(json.dumps(payload).encode()))
+        data = b"".join(frames)
+        try:
+            client.sendall(data)
+        except OutboundQueueFull as e:
+            self.__logger.info(f"Offline batch for {client_key_pair.client_id} waits for the outbound queue: {e}")
+            client.on_drained = lambda: self.__write_offline_batch(client_key_pair, envelopes, last_id)
+            client.offline_batch_pending = True
+            client.spilling = True
+            return
+        except OSError as e:
+            # The connection is closing. The batch is sent again after the next login
+            self.__logger.warning(f"Sending offline messages to {client_key_pair.client_id} failed: {e}")
+            return
+        self.metrics.add_bytes_out(len(data))
+        client.offline_batch_pending = True
+        client.on_drained = lambda: self.__resume_after_spill(client_key_pair)
+
+    def __acknowledge_offline_batch(self, request_json, client_key_pair):
+        """Client confirmed a batch of offline messages. Delete it and continue with the next one
+        """
+        if client_key_pair is None:
+            return
+        last_id = int(request_json['lastId'])
+        if self._cluster is not None and not self._cluster.is_home(client_key_pair.client_id):
+            # Offline messages are kept by the home node
+            client_key_pair.client.offline_batch_pending = False
+            payload = {}
+            payload['requestType'] = RequestType.PEER_OFFLINE_ACK
+            payload['UUID'] = str(client_key_pair.client_id)
+            payload['node'] = self._cluster.node_name
+            payload['lastId'] = last_id
+            self._cluster.send(self._cluster.home_of(client_key_pair.client_id), payload,
+                               key=str(client_key_pair.client_id))
+            # Envelopes, the home node queued while the batch waited for the outbound queue, follow in its next batch
+            client_key_pair.client.spilling = False
+            return
+        self.__offline_store.delete_delivered(client_key_pair.client_id, last_id)
+        # The batch stays pending, until the next one is written, so a drained queue doesn't send it as well
+        self.__send_offline_batch(client_key_pair, after_id=last_id)
+
+    def __directory_record(self, uuid: str):
+        """Search for a client with specified UUID. Served from the directory cache,
+        the database is only read on a miss.
+
+        Returns
+        -------
+        DirectoryRecord
+            Record of the client, or None if it does not exist
+        """
+        return self.__directory_records([uuid]).get(str(uuid))
+
+    def __directory_records(self, uuids) -> dict:
+        """Search for all clients with the specified UUIDs. Cached clients are served from the
+        directory cache, the others with one query. In cluster mode, clients homed on other nodes
+        are looked up with one request per node.
+
+        Returns
+        -------
+        dict
+            UUID -> DirectoryRecord of every found client
+        """
+        records = {}
+        uncached = []
+        for uuid in uuids:
+            uuid = str(uuid)
+            record = self.directory_cache.get(uuid)
+            if record is None:
+                uncached.append(uuid)
+            else:
+                records[uuid] = record
+
+        remote = []
+        if self._cluster is not None:
+            remote = [uuid for uuid in uncached if not self._cluster.is_home(uuid)]
+            uncached = [uuid for uuid in uncached if self._cluster.is_home(uuid)]
+
+        found = [DirectoryRecord.from_row(row) for row in self.__storage.clients_with_uuids(uncached)]
+        if remote:
+            found.extend(DirectoryRecord(
+                uuid=client['uuid'],
+                name=client['name'],
+                public_key=base64.b64decode(client['publicKey']),
+                public_key_b64=client['publicKey'],
+                sessions=client.get('sessions', False)
+            ) for client in self._cluster.lookup(remote))
+        for record in found:
+            self.directory_cache.put(record)
+            records[record.uuid] = record
+        return records
 
 
     def __handle_new_account(self, request_json, client):
         """When a new client connects, create a unique UUID and Seed phrase for it.
         """
-        self.__logger.info("RECEIVED NEW ACCOUNT")
-        # Generate random UUID for client
+        self.__logger.debug("RECEIVED NEW ACCOUNT")
+        # Generate random UUID for client. In cluster mode, accounts are homed on the node they were created on
         client_uuid = uuid.uuid4()
+        while self._cluster is not None and not self._cluster.is_home(client_uuid):
+            client_uuid = uuid.uuid4()
 
         client_key_pair = ClientKeyPair(
             client=client,
@@ -145,60 +638,505 @@ class OQSServer():
             client_name=request_json['name'],
             client_id=client_uuid
         )
-        self.__clients.append(client_key_pair)
+        self.__register(client_key_pair)
 
         # Generate Seed Phrase
-        seed_phrase, seed_phrase_hash = generate_random_seed_phrase()
+        seed_phrase, seed_phrase_hash = self.seed_phrases.take()
 
-        # Safe in DB
-        self.__cursor.execute("""
-            INSERT INTO clients 
-            VALUES (
-                :uuid, 
-                :name, 
-                :publicKey
-            ) 
-        """, {
-            "uuid": str(client_uuid),
-            "name": request_json['name'],
-            "publicKey": base64.b64decode(request_json['publicKey']),
-        })
-        self.__connection.commit()
-
-        self.__logger.info("---SENDING UUID AND SEED---")
         payload = {}
         payload['requestType'] = RequestType.ASSIGN_UUID_AND_SEED
         payload['UUID'] = str(client_uuid)
         payload['seedPhrase'] = seed_phrase
         payload['seedHash'] = base64.b64encode(seed_phrase_hash).decode('ascii')
-        self.__logger.info(f"PAYLOAD: {payload}")
         json_data = json.dumps(payload)
-        client.send(json_data.encode())
+
+        def send_uuid_and_seed(future):
+            # Only hand out the UUID, once the account is committed
+            if future.exception() is not None:
+                self.__logger.error(f"Could not create account {client_uuid}: {future.exception()}")
+                return
+            self.directory_cache.invalidate(client_uuid)
+            self.__logger.debug("---SENDING UUID AND SEED---")
+            self.__logger.debug("PAYLOAD: %s", payload)
+            self.__broadcast_raw(client, json_data.encode())
+
+        # Safe in DB
+        self.__storage.insert_client(
+            client_uuid,
+            request_json['name'],
+            base64.b64decode(request_json['publicKey'])
+        ).add_done_callback(send_uuid_and_seed)
+        if client.sessions:
+            self.__update_capabilities(client_uuid, True)
         return client_key_pair
     
     def __send_message_to_contact(self, request_json, sender_client_key_pair):
-        """Sends message to specified contact
+        """Relays a message, or a session request, to specified contact
 
         Parameters
         ----------
         request_json : dict
-            JSON already containing ciphertext. Some parameters are added
+            JSON containing the message or the session request. Some parameters are added
         sender_client_key_pair : ClientKeyPair
             Used for important meta parameters
         """
-        contact_client_key_pair = self.__client_key_pair_with_uuid(request_json['contactUUID'])
-        
+        if sender_client_key_pair is None:
+            self.__logger.warning("Client is not logged in. Request dropped")
+            return
+        contact_uuid = request_json['contactUUID']
         request_json['senderUUID'] = str(sender_client_key_pair.client_id)
-        request_json['senderName'] = sender_client_key_pair.client_name
-        request_json['senderPublicKey'] = base64.b64encode(sender_client_key_pair.client_public_key).decode('ascii')
+        # Name and public key are only needed to set up the contact. Legacy
+        # clients send the KEM ciphertext with every message
+        if request_json['requestType'] == RequestType.SESSION_INIT_REQUEST or 'ciphertext' in request_json:
+            request_json['senderName'] = sender_client_key_pair.client_name
+            request_json['senderPublicKey'] = base64.b64encode(sender_client_key_pair.client_public_key).decode('ascii')
 
-        json_data = json.dumps(request_json)
-        self.__broadcast_raw(contact_client_key_pair.client, json_data.encode())
+        json_data = json.dumps(request_json).encode()
+        self.__deliver(contact_uuid, json_data)
+
+    def __send_binary_message_to_contact(self, frame: bytes, sender_client_key_pair):
+        """Sends a binary message to specified contact. The message is
+        relayed as slice of the received frame, without being decoded.
+
+        Parameters
+        ----------
+        frame : bytes
+            Binary SEND_MESSAGE frame
+        sender_client_key_pair : ClientKeyPair
+            Used for important meta parameters
+        """
+        if sender_client_key_pair is None:
+            self.__logger.warning("Client is not logged in. Message dropped")
+            return
+        send_message = unpack_send_message(frame)
+        envelope = pack_deliver_message(
+            sender_uuid=sender_client_key_pair.client_id,
+            session_id=send_message.session_id,
+            message=send_message.message
+        )
+        self.__deliver(send_message.contact_uuid, envelope)
+
+    def __send_group_message(self, frame: bytes, sender_client_key_pair):
+        """Fan a group message out to its members. Every member gets the body and only its own
+        wrapped message key. The body is relayed as slice of the received frame, without being decoded.
+        Offline members get it queued like any other message.
+        The first message of a group records its sender and receivers as the members. Later messages
+        are only fanned out, if the sender is a member, and only to members. In cluster mode, every
+        node records the members with the first message of the group, it fans out.
+
+        Parameters
+        ----------
+        frame : bytes
+            Binary GROUP_SEND frame
+        sender_client_key_pair : ClientKeyPair
+            Used for important meta parameters
+        """
+        if sender_client_key_pair is None:
+            self.__logger.warning("Client is not logged in. Group message dropped")
+            return
+        group_send = unpack_group_send(frame)
+        sender_uuid = str(sender_client_key_pair.client_id)
+        group_members = self.__storage.group_members(group_send.group_id)
+        if not group_members:
+            group_members = {sender_uuid} | {member.contact_uuid for member in group_send.members}
+            # Committed before the fan-out, so the next message of the group finds the members
+            self.__storage.insert_group_members(group_send.group_id, group_members).result()
+        elif sender_uuid not in group_members:
+            self.__logger.warning(f"{sender_uuid} is no member of group {group_send.group_id}. Group message dropped")
+            return
+
+        for member in group_send.members:
+            if member.contact_uuid not in group_members:
+                self.__logger.warning(f"{member.contact_uuid} is no member of group {group_send.group_id}. Skipped")
+                continue
+            envelope = pack_group_deliver(
+                sender_uuid=sender_client_key_pair.client_id,
+                group_id=group_send.group_id,
+                session_id=member.session_id,
+                wrapped_key=member.wrapped_key,
+                body=group_send.body
+            )
+            self.__deliver(member.contact_uuid, envelope)
+
+    def __relay_attachment_chunk(self, frame: bytes, sender_client_key_pair):
+        """Relays a chunk of an attachment to the receiver, with the sender as peer.
+        Chunks are never stored, so the server holds at most one chunk per transfer.
+
+        Parameters
+        ----------
+        frame : bytes
+            Binary ATTACHMENT_CHUNK frame
+        sender_client_key_pair : ClientKeyPair
+            Used for important meta parameters
+        """
+        if sender_client_key_pair is None:
+            self.__logger.warning("Client is not logged in. Attachment chunk dropped")
+            return
+        chunk = unpack_attachment_chunk(frame)
+        envelope = pack_attachment_chunk(
+            peer_uuid=sender_client_key_pair.client_id,
+            transfer_id=chunk.transfer_id,
+            session_id=chunk.session_id,
+            offset=chunk.offset,
+            data=chunk.data
+        )
+        self.__relay(chunk.peer_uuid, envelope)
+
+    def __relay_attachment_ack(self, frame: bytes, sender_client_key_pair):
+        """Relays the acknowledgement of attachment chunks back to the sender of the attachment
+        """
+        if sender_client_key_pair is None:
+            self.__logger.warning("Client is not logged in. Attachment acknowledgement dropped")
+            return
+        ack = unpack_attachment_ack(frame)
+        self.__relay(ack.peer_uuid, pack_attachment_ack(sender_client_key_pair.client_id, ack.transfer_id, ack.offset))
+
+    def __relay(self, contact_uuid: str, envelope: bytes):
+        """Deliver an envelope only to the live connections of the contact. Used for attachment
+        transfers, which resume from the acknowledged offset instead of being queued. In cluster mode,
+        the home node drops it, instead of queueing it, if the contact is nowhere online.
+        """
+        self.__deliver(contact_uuid, envelope, relay=True)
+
+    def __deliver(self, contact_uuid: str, envelope: bytes, relay: bool = False):
+        """Deliver an envelope to every live connection of the contact,
+        or queue it, if the contact is offline. In cluster mode, envelopes for
+        contacts homed on another node are passed on to the home node.
+        """
+        if self._cluster is not None and not self._cluster.is_home(contact_uuid):
+            delivered = self.__deliver_local(contact_uuid, envelope)
+            if not self.__send_peer_delivery(self._cluster.home_of(contact_uuid), contact_uuid, envelope,
+                                             final=False, delivered=delivered, relay=relay) \
+                    and not delivered and not relay:
+                self.__hold_for_home(contact_uuid, envelope)
+            return
+        self.__deliver_home(contact_uuid, envelope, relay=relay)
+
+    def __deliver_home(self, contact_uuid: str, envelope: bytes, origin_node: str = None, delivered: bool = False,
+                       relay: bool = False):
+        """Deliver an envelope on the home node of the contact: to its local connections and to every
+        other node, it is online on. If it is nowhere online, the envelope is queued, unless it is only relayed.
+
+        Parameters
+        ----------
+        contact_uuid : str
+            UUID of the contact
+        envelope : bytes
+            Frame payload to deliver
+        origin_node : str, optional
+            Node the envelope came from. It already delivered to its own connections
+        delivered : bool, optional
+            True, if the origin node delivered the envelope
+        relay : bool, optional
+            Drop the envelope, if the contact is nowhere online, by default False
+        """
+        delivered = self.__deliver_local(contact_uuid, envelope) or delivered
+        if self._cluster is not None:
+            for node in self._cluster.nodes_for(contact_uuid):
+                if node != origin_node:
+                    delivered = self.__send_peer_delivery(node, contact_uuid, envelope, final=True,
+                                                          relay=relay) or delivered
+        if delivered:
+            return
+        if relay:
+            self.__logger.debug(f"Contact {contact_uuid} is offline. Attachment frame dropped")
+            return
+
+        if self.__directory_record(contact_uuid) is None:
+            self.__logger.warning(f"Contact {contact_uuid} does not exist. Message dropped")
+            return
+        self.__logger.debug(f"Contact {contact_uuid} is offline. Queueing message")
+        self.__offline_store.enqueue(contact_uuid, envelope)
+
+    def __deliver_local(self, contact_uuid: str, envelope: bytes) -> bool:
+        """Deliver an envelope to the connections of the contact on this server.
+        Connections on other workers are reached through the router.
+
+        Returns
+        -------
+        bool
+            True, if the envelope was sent to a connection on this server, or forwarded to another worker
+        """
+        contact_connections = self.__clients.connections_for(contact_uuid)
+        forwarded = False
+        if self._router is not None:
+            for worker_id in self._router.workers_for(contact_uuid):
+                forwarded = self._router.forward(worker_id, contact_uuid, envelope) or forwarded
+
+        delivered = False
+        for contact_client_key_pair in contact_connections:
+            delivered = self.__deliver_to(contact_client_key_pair, envelope) or delivered
+        return delivered or forwarded
+
+    def __deliver_to(self, client_key_pair, envelope: bytes) -> bool:
+        """Deliver an envelope to one connection, applying the overflow policy, if its outbound
+        queue is full. Errors of the connection are handled here and never reach the caller
+
+        Returns
+        -------
+        bool
+            True, if the envelope was sent or dropped. Otherwise it has to be queued in the offline store
+        """
+        client = client_key_pair.client
+        if client.spilling:
+            # Queued behind the envelopes, that were spilled before
+            return False
+        client_envelope = self.__envelope_for(client, envelope)
+        if client_envelope is None:
+            return False
+        try:
+            self.__broadcast_raw(client, client_envelope)
+            return True
+        except OutboundQueueFull as e:
+            return self.__handle_overflow(client_key_pair, e)
+        except OSError as e:
+            # The connection is closing. Its own thread unregisters it
+            self.__logger.warning(f"Sending to {client_key_pair.client_id} failed: {e}")
+            return False
+
+    def __handle_overflow(self, client_key_pair, error: OutboundQueueFull) -> bool:
+        """Apply the overflow policy to an envelope, that did not fit in the outbound queue of a connection
+
+        Returns
+        -------
+        bool
+            True, if the envelope is dropped. Otherwise it has to be queued in the offline store
+        """
+        client = client_key_pair.client
+        self.metrics.count_overflow(self.__overflow_policy)
+        self.__logger.warning(f"Outbound queue of {client_key_pair.client_id} is full: {error}. "
+                              f"Applying policy {self.__overflow_policy}")
+        if self.__overflow_policy == OVERFLOW_DROP:
+            return True
+        if self.__overflow_policy == OVERFLOW_DISCONNECT:
+            # The client gets the envelope with the offline messages, once it reconnected
+            client.close()
+            return False
+        client.on_drained = lambda: self.__resume_after_spill(client_key_pair)
+        client.spilling = True
+        return False
+
+    def __resume_after_spill(self, client_key_pair):
+        """Called by the writer of a spilling connection, once its queue drained.
+        The spilled envelopes follow as offline batches
+        """
+        if client_key_pair.client.offline_batch_pending:
+            # The acknowledgement of the batch sends the next one
+            return
+        self.__send_offline_batch(client_key_pair)
+
+    def __send_peer_delivery(self, node: str, contact_uuid: str, envelope: bytes, final: bool,
+                             delivered: bool = False, relay: bool = False) -> bool:
+        """Pass an envelope on to another node. Final deliveries are only delivered locally
+        by the receiving node, all others are handled like on the home node. Relayed envelopes
+        are never queued.
+        """
+        payload = {}
+        payload['requestType'] = RequestType.PEER_DELIVER
+        payload['contactUUID'] = str(contact_uuid)
+        payload['node'] = self._cluster.node_name
+        payload['final'] = final
+        payload['delivered'] = delivered
+        payload['relay'] = relay
+        payload['envelope'] = base64.b64encode(envelope).decode('ascii')
+        return self._cluster.send(node, payload, key=str(contact_uuid))
+
+    def __handle_peer_request(self, request_type, request_json, client):
+        """Requests between the nodes of a cluster. Only accepted on links, that authenticated with PEER_HELLO
+        """
+        if self._cluster is None:
+            self.__logger.warning(f"Not in cluster mode. {request_type} dropped")
+            return
+        if request_type == RequestType.PEER_HELLO:
+            if self._cluster.authenticate(request_json):
+                client.peer_node = request_json['node']
+                self.__logger.info(f"Node {client.peer_node} connected")
+            else:
+                self.__logger.warning("Peer authentication failed")
+            return
+        if client.peer_node is None:
+            self.__logger.warning(f"{request_type} from an unauthenticated connection dropped")
+            return
+
+        if request_type == RequestType.PEER_LOOKUP_REQUEST:
+            payload = {}
+            payload['requestType'] = RequestType.PEER_LOOKUP_RESPONSE
+            payload['requestId'] = request_json['requestId']
+            payload['clients'] = [{
+                'uuid': row['uuid'],
+                'name': row['name'],
+                'publicKey': base64.b64encode(row['public_key']).decode('ascii'),
+                'sessions': bool(row['sessions'])
+            } for row in self.__storage.clients_with_uuids(request_json['uuids'])]
+            self.__broadcast_raw(client, json.dumps(payload).encode())
+
+        elif request_type == RequestType.PEER_PRESENCE:
+            self._cluster.set_presence(request_json['UUID'], request_json['node'], request_json['online'])
+            if request_json['online']:
+                record = self.__directory_record(request_json['UUID'])
+                if record is not None and record.sessions != request_json.get('sessions', False):
+                    self.__update_capabilities(record.uuid, request_json.get('sessions', False))
+                self.__send_remote_offline_batch(request_json['UUID'], request_json['node'])
+
+        elif request_type == RequestType.PEER_DELIVER:
+            contact_uuid = request_json['contactUUID']
+            envelope = base64.b64decode(request_json['envelope'])
+            relay = request_json.get('relay', False)
+            if not request_json['final']:
+                self.__deliver_home(contact_uuid, envelope, request_json['node'], request_json['delivered'], relay)
+            elif not self.__deliver_local(contact_uuid, envelope) and not relay:
+                # Contact went offline in the meantime. The home node queues it
+                if not self.__send_peer_delivery(request_json['node'], contact_uuid, envelope, final=False):
+                    self.__hold_for_home(contact_uuid, envelope)
+
+        elif request_type == RequestType.PEER_OFFLINE_BATCH:
+            contact_connections = self.__clients.connections_for(request_json['UUID'])
+            if contact_connections:
+                envelopes = [base64.b64decode(envelope) for envelope in request_json['envelopes']]
+                self.__write_offline_batch(contact_connections[-1], envelopes, request_json['lastId'])
+
+        elif request_type == RequestType.PEER_OFFLINE_ACK:
+            last_id = int(request_json['lastId'])
+            self.__offline_store.delete_delivered(request_json['UUID'], last_id)
+            self.__send_remote_offline_batch(request_json['UUID'], request_json['node'], after_id=last_id)
+
+    def __send_remote_offline_batch(self, client_uuid: str, node: str, after_id: int = 0):
+        """Send the next batch of offline messages of a client homed here, to the node it logged in on.
+        Like local batches, the next one is only sent, once the client acknowledged it.
+        """
+        batch = self.__offline_store.pending_batch(client_uuid, after_id, self.__offline_batch_size,
+                                                   self.__offline_batch_max_bytes)
+        if not batch:
+            return
+        self.__logger.info(f"Sending {len(batch)} offline messages of {client_uuid} to node {node}")
+        payload = {}
+        payload['requestType'] = RequestType.PEER_OFFLINE_BATCH
+        payload['UUID'] = str(client_uuid)
+        payload['lastId'] = batch[-1][0]
+        payload['envelopes'] = [base64.b64encode(envelope).decode('ascii') for _, envelope in batch]
+        self._cluster.send(node, payload, key=str(client_uuid))
+
+    def __hold_for_home(self, contact_uuid: str, envelope: bytes):
+        """Queue an envelope for a contact homed on another node, that is not reachable.
+        The handoff thread passes it on, once the home node is back
+        """
+        self.__logger.warning(f"Home node of {contact_uuid} is not reachable. Holding the message for it")
+        self.__offline_store.enqueue(contact_uuid, envelope)
+        self.__handoff_pending.set()
+
+    def __hand_off_offline_messages(self):
+        """Pass offline messages of clients homed on other nodes on to their home node. They are queued here,
+        while the home node is not reachable, or if the node list changed since they were queued.
+        Runs in its own thread in cluster mode
+        """
+        while self.keep_running:
+            self.__handoff_pending.wait()
+            self.__handoff_pending.clear()
+            if not self.keep_running:
+                return
+            failed = False
+            for recipient in self.__offline_store.recipients():
+                if not self._cluster.is_home(recipient) and not self.__hand_off(recipient):
+                    failed = True
+            if failed:
+                time.sleep(HANDOFF_RETRY_DELAY)
+                self.__handoff_pending.set()
+
+    def __hand_off(self, recipient: str) -> bool:
+        """Pass the offline messages of one client on to its home node, oldest first. Messages are deleted
+        once they are sent, the home node delivers or queues them like every other message
+
+        Returns
+        -------
+        bool
+            False, if the home node is not reachable. The remaining messages stay queued
+        """
+        home = self._cluster.home_of(recipient)
+        last_id = 0
+        try:
+            while True:
+                batch = self.__offline_store.pending_batch(recipient, last_id, self.__offline_batch_size)
+                if not batch:
+                    self.__logger.info(f"Handed offline messages of {recipient} off to node {home}")
+                    return True
+                for message_id, envelope in batch:
+                    if not self.__send_peer_delivery(home, recipient, envelope, final=False):
+                        return False
+                    last_id = message_id
+        finally:
+            if last_id:
+                self.__offline_store.delete_delivered(recipient, last_id)
+
+    def __deliver_forwarded(self, contact_uuid: str, envelope: bytes):
+        """Deliver an envelope, another worker forwarded, like `__deliver_local`. If the contact went
+        offline in the meantime, or none of its connections took it, it is queued. Attachment frames
+        are only relayed, they are dropped instead.
+        """
+        delivered = False
+        for contact_client_key_pair in self.__clients.connections_for(contact_uuid):
+            delivered = self.__deliver_to(contact_client_key_pair, envelope) or delivered
+        if delivered:
+            return
+        if is_binary_frame(envelope) and frame_kind(envelope) in (FrameKind.ATTACHMENT_CHUNK, FrameKind.ATTACHMENT_ACK):
+            self.__logger.debug(f"Contact {contact_uuid} is offline. Attachment frame dropped")
+            return
+        self.__offline_store.enqueue(contact_uuid, envelope)
+
+    def _start_links(self):
+        """Link this worker with the other workers, and this node with the other nodes.
+        Called by the engines, before clients are accepted
+        """
+        if self._router is not None:
+            self._router.start(self.__deliver_forwarded)
+        if self._cluster is not None:
+            self._cluster.start(lambda request_json, link: self._handle_request(request_json, link, None))
+            # Messages, that are held here from an earlier run, are handed off right away
+            self.__handoff_pending.set()
+            Thread(target=self.__hand_off_offline_messages, daemon=True).start()
+
+    def _start_lifecycle(self):
+        """Fix the connection caps, start closing idle connections and start generating seed phrases.
+        Called by the engines, before clients are accepted
+        """
+        self.lifecycle.start()
+        self.seed_phrases.start()
+
+    def _start_metrics_endpoint(self):
+        """Serve the metrics on localhost, if a metrics port is set. Called by the engines, before clients are accepted
+        """
+        if self.__metrics_port is None:
+            return
+        self.__metrics_endpoint = start_metrics_endpoint(self.metrics, self.profiler, 'localhost', self.__metrics_port)
+        self.__logger.info(f"Metrics on http://localhost:{self.__metrics_port}/metrics")
+
+    def __envelope_for(self, client, envelope: bytes) -> bytes:
+        """Convert binary envelopes to JSON for clients, that did not negotiate the binary format.
+        Clients without sessions only read messages with the KEM ciphertext, so envelopes,
+        that reference a session, are dropped for them.
+
+        Returns
+        -------
+        bytes
+            Envelope in the format of the connection, or None if the client can not read it
+        """
+        if not client.sessions and requires_session(envelope):
+            self.__logger.warning("Client without sessions can not read the envelope. Dropped")
+            return None
+        if client.wire_format == WIRE_FORMAT_BINARY or not is_binary_frame(envelope):
+            return envelope
+        kind = frame_kind(envelope)
+        if kind == FrameKind.GROUP_DELIVER:
+            return json.dumps(group_deliver_to_json(unpack_group_deliver(envelope))).encode()
+        if kind == FrameKind.DELIVER_MESSAGE:
+            return json.dumps(deliver_message_to_json(unpack_deliver_message(envelope))).encode()
+        # Attachment frames have no JSON form. Clients without the binary format never accept an offer
+        return envelope
 
     def __broadcast_raw(self, client, msg):
-        """Broadcast a raw message over specified client socket
+        """Broadcast a raw message over specified client socket, as a single frame
         """
-        client.send(msg)
+        self.metrics.add_bytes_out(len(msg) + FRAME_HEADER.size)
+        send_frame(client, msg)
         
     def __connect_with_contact(self, contact_uuid: str, client):
         """Checks if the client can connect with contact
@@ -210,21 +1148,51 @@ class OQSServer():
         client : socket
             client socket, that executed the request. Used for the response JSON
         """
-        contact = self.__db_client_with_uuid(contact_uuid)
+        contact = self.__directory_record(contact_uuid)
         contact_exists = contact is not None
-        self.__logger.info(f"Contact with UUID {contact_uuid} exists: {contact_exists}")
+        self.__logger.debug(f"Contact with UUID {contact_uuid} exists: {contact_exists}")
 
         payload = {}
         payload['requestType'] = RequestType.CONNECT_WITH_CONTACT_RESPONSE
         payload['contactExists'] = contact_exists
         if contact_exists:
-            self.__logger.info(f"CONTACT: {contact}")
+            self.__logger.debug("CONTACT: %s", contact)
             payload['contactUUID'] = contact_uuid
-            payload['contactName'] = contact['name']
-            # To send pub key, encode Bytes to ascii via Base64
-            payload['contactPublicKey'] = base64.b64encode(contact['public_key']).decode('ascii')
-        self.__logger.info(f"Payload: {payload}")
+            payload['contactName'] = contact.name
+            # Public key is cached in its Base64 form
+            payload['contactPublicKey'] = contact.public_key_b64
+            # Without sessions, the client sends the KEM ciphertext with every message to the contact
+            payload['contactSessions'] = contact.sessions
+        self.__logger.debug("Payload: %s", payload)
+
+        json_data = json.dumps(payload)
+
+        self.__broadcast_raw(client, json_data.encode())
 
+    def __connect_with_contacts(self, contact_uuids: list, client):
+        """Resolve a list of contacts at once, e.g. for an address book import.
+        Cached contacts are served from the directory cache, all others with a single query.
+
+        Parameters
+        ----------
+        contact_uuids : list
+            UUIDs of contacts to connect with
+        client : ClientConnection
+            Connection, that executed the request. Used for the response JSON
+        """
+        contact_uuids = list(dict.fromkeys(str(contact_uuid) for contact_uuid in contact_uuids))
+        records = self.__directory_records(contact_uuids)
+        self.__logger.debug(f"Resolved {len(records)} of {len(contact_uuids)} contacts")
+
+        payload = {}
+        payload['requestType'] = RequestType.CONNECT_WITH_CONTACTS_RESPONSE
+        payload['contacts'] = [{
+            'contactUUID': record.uuid,
+            'contactName': record.name,
+            'contactPublicKey': record.public_key_b64,
+            'contactSessions': record.sessions
+        } for record in records.values()]
+        payload['missingUUIDs'] = [contact_uuid for contact_uuid in contact_uuids if contact_uuid not in records]
         json_data = json.dumps(payload)
 
         self.__broadcast_raw(client, json_data.encode())
@@ -239,7 +1207,15 @@ class OQSServer():
         """
 
         self.__logger.info(f"Starting server. Listening to max {num_connections} connections")
+        self.__server = socket(AF_INET, SOCK_STREAM, 0)
+        if self._reuse_port:
+            self.__server.setsockopt(SOL_SOCKET, SO_REUSEPORT, 1)
+        self.__server.bind(self.__address)
+        # The TLS handshake is done by the client thread, see __tls_handshake
         self.__server.listen(num_connections)
+        self._start_links()
+        self._start_lifecycle()
+        self._start_metrics_endpoint()
 
         self.__logger.info("Waiting for connection...")
         thread = Thread(target=self.__accept_connections)
@@ -251,3 +1227,14 @@ class OQSServer():
         """
         self.__logger.info("STOP SERVER")
         self.keep_running = False
+        self.__handoff_pending.set()
+        if self._router is not None:
+            self._router.close()
+        if self._cluster is not None:
+            self._cluster.close()
+        if self.__metrics_endpoint is not None:
+            self.__metrics_endpoint.shutdown()
+        self.profiler.stop()
+        self.lifecycle.stop()
+        self.seed_phrases.stop()
+        self.__storage.close()
@@ -0,0 +1,141 @@
+from collections import deque
+from threading import Condition
+import time
+
+from util.wire_format import WIRE_FORMAT_JSON
+
+# What happens to an envelope for a connection, whose outbound queue is full
+OVERFLOW_DROP = 'drop'  # The envelope is lost
+# The connection is closed, the envelope queued for the next login. Frames, that were
+# already queued, are lost like with every broken connection
+OVERFLOW_DISCONNECT = 'disconnect'
+OVERFLOW_SPILL = 'spill'  # The envelope and all after it are queued, until the connection caught up
+OVERFLOW_POLICIES = (OVERFLOW_DROP, OVERFLOW_DISCONNECT, OVERFLOW_SPILL)
+
+# Bytes of frames, that may wait for a slow receiver. A single bigger frame is accepted into an empty queue
+OUTBOUND_QUEUE_SIZE = 4 * 1024 * 1024
+# Frames, that are queued back to back, are joined into writes of up to this size
+COALESCE_SIZE = 64 * 1024
+
+
+class OutboundQueueFull(ConnectionError):
+    """Raised when a frame does not fit in the outbound queue of a connection
+    """
+
+
+class OutboundQueue():
+    """Bounded queue of encoded frames of one connection, drained by a single writer.
+    Thread safe, frames can be put from every handler thread.
+    """
+
+    def __init__(self, max_bytes: int = OUTBOUND_QUEUE_SIZE, coalesce_size: int = COALESCE_SIZE):
+        self.__max_bytes = max_bytes
+        self.__coalesce_size = coalesce_size
+        self.__condition = Condition()
+        self.__frames = deque()
+        self.__queued_bytes = 0
+        self.closed = False
+
+    @property
+    def queued_bytes(self) -> int:
+        return self.__queued_bytes
+
+    def put(self, data: bytes) -> bool:
+        """Queue an encoded frame
+
+        Returns
+        -------
+        bool
+            True, if the queue was empty, so the writer may have to be woken up
+
+        Raises
+        ------
+        OutboundQueueFull
+            If the frame does not fit
+        ConnectionResetError
+            If the queue is closed
+        """
+        with self.__condition:
+            if self.closed:
+                raise ConnectionResetError("Connection is closed")
+            if self.__queued_bytes and self.__queued_bytes + len(data) > self.__max_bytes:
+                raise OutboundQueueFull(f"{self.__queued_bytes} bytes are waiting for the connection")
+            was_empty = not self.__frames
+            self.__frames.append(data)
+            self.__queued_bytes += len(data)
+            self.__condition.notify()
+            return was_empty
+
+    def take(self, block: bool = True):
+        """Remove the next frames, joined into a single write. Frames are joined while they
+        fit in the coalesce size, a bigger frame is written on its own.
+
+        Parameters
+        ----------
+        block : bool, optional
+            Wait for a frame, by default True
+
+        Returns
+        -------
+        bytes
+            Data to write, or None if the queue is empty and not blocking, or closed
+        """
+        with self.__condition:
+            while block and not self.__frames and not self.closed:
+                self.__condition.wait()
+            if not self.__frames or self.closed:
+                return None
+            batch = [self.__frames.popleft()]
+            size = len(batch[0])
+            while self.__frames and size + len(self.__frames[0]) <= self.__coalesce_size:
+                size += len(self.__frames[0])
+                batch.append(self.__frames.popleft())
+            self.__queued_bytes -= size
+        return batch[0] if len(batch) == 1 else b"".join(batch)
+
+    def close(self):
+        with self.__condition:
+            self.closed = True
+            self.__frames.clear()
+            self.__queued_bytes = 0
+            self.__condition.notify_all()
+
+
+class QueuedConnection():
+    """Base of the client connections of the engines. Request handlers only write through
+    `sendall`, which queues the frame and never blocks on the socket. Every engine drains
+    the queue with its own writer.
+    """
+
+    def __init__(self, max_queued_bytes: int = OUTBOUND_QUEUE_SIZE):
+        # Negotiated with HELLO_REQUEST. Clients, that never send one, only understand JSON
+        self.wire_format = WIRE_FORMAT_JSON
+        # Announced with HELLO_REQUEST. Clients without it never get envelopes, that reference a session
+        self.sessions = False
+        # Name of the node, if this is a link from another cluster node
+        self.peer_node = None
+        # Set by the server with the spill policy: envelopes go to the offline store, until the queue
+        # drained. Then `on_drained` is called, to send them as offline batches
+        self.spilling = False
+        self.on_drained = None
+        # An offline batch was sent, that is not acknowledged yet
+        self.offline_batch_pending = False
+        # Told the heartbeat interval in the HELLO_RESPONSE. Only these connections are closed when idle
+        self.heartbeats = False
+        # Monotonic time of the last read from the connection, for the idle timeout
+        self.last_activity = time.monotonic()
+        self._outbound = OutboundQueue(max_queued_bytes)
+
+    def sendall(self, data: bytes):
+        if self._outbound.put(data):
+            self._wake_writer()
+
+    def _wake_writer(self):
+        """Called when a frame is put into the empty queue
+        """
+
+    def _written(self):
+        """Called by the writer after every write
+        """
+        if self.spilling and not self._outbound.queued_bytes and self.on_drained is not None:
+            self.on_drained()
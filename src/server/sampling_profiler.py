@@ -0,0 +1,103 @@
+from collections import Counter
+from threading import Thread, Event, Lock, get_ident
+import os
+import sys
+
+# Bounds of the seconds between two samples. Shorter intervals keep the sampler thread busy
+# holding the GIL, so it slows down the requests it measures
+MIN_INTERVAL = 0.001
+MAX_INTERVAL = 60.0
+
+
+def parse_interval(value) -> float:
+    """Sampling interval from a request
+
+    Raises
+    ------
+    ValueError
+        If the value is not a number of seconds between MIN_INTERVAL and MAX_INTERVAL
+    """
+    try:
+        interval = float(value)
+    except (TypeError, ValueError):
+        raise ValueError(f"Interval {value!r} is not a number")
+    # Also false for NaN
+    if not MIN_INTERVAL <= interval <= MAX_INTERVAL:
+        raise ValueError(f"Interval has to be between {MIN_INTERVAL} and {MAX_INTERVAL} seconds")
+    return interval
+
+
+class SamplingProfiler():
+    """Statistical profiler for a running server. A background thread takes the stacks
+    of all other threads every `interval` seconds, so the overhead stays constant no matter
+    how many requests are handled. It can be started and stopped at runtime.
+    Stacks are reported in the collapsed format of flame graph tools.
+    """
+
+    def __init__(self, max_depth: int = 64):
+        self.__max_depth = max_depth
+        self.__lock = Lock()
+        self.__stacks = Counter()
+        self.__samples = 0
+        self.__thread = None
+        self.__stop = Event()
+
+    @property
+    def running(self) -> bool:
+        return self.__thread is not None and self.__thread.is_alive()
+
+    def start(self, interval: float = 0.005):
+        """Start sampling. Previously collected stacks are discarded
+
+        Parameters
+        ----------
+        interval : float, optional
+            Seconds between two samples, by default 0.005
+
+        Raises
+        ------
+        ValueError
+            If the interval is outside of MIN_INTERVAL and MAX_INTERVAL
+        """
+        interval = parse_interval(interval)
+        self.stop()
+        with self.__lock:
+            self.__stacks = Counter()
+            self.__samples = 0
+        self.__stop = Event()
+        self.__thread = Thread(target=self.__sample_loop, args=(interval, self.__stop),
+                               name="SamplingProfiler", daemon=True)
+        self.__thread.start()
+
+    def stop(self):
+        """Stop sampling. The collected stacks stay available
+        """
+        if self.__thread is not None:
+            self.__stop.set()
+            self.__thread.join()
+            self.__thread = None
+
+    def __stack_of(self, frame) -> str:
+        names = []
+        while frame is not None and len(names) < self.__max_depth:
+            code = frame.f_code
+            names.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+            frame = frame.f_back
+        return ";".join(reversed(names))
+
+    def __sample_loop(self, interval: float, stop: Event):
+        own_ident = get_ident()
+        while not stop.wait(interval):
+            stacks = [self.__stack_of(frame) for ident, frame in sys._current_frames().items() if ident != own_ident]
+            with self.__lock:
+                self.__stacks.update(stacks)
+                self.__samples += 1
+
+    def collapsed_stacks(self) -> str:
+        """Collected stacks, one `frame;frame;frame count` line per distinct stack, most frequent first
+        """
+        with self.__lock:
+            lines = [f"{stack} {count}" for stack, count in self.__stacks.most_common()]
+            samples = self.__samples
+        state = "running" if self.running else "stopped"
+        return f"# {samples} samples, profiler {state}\n" + "\n".join(lines) + "\n"
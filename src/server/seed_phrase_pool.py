@@ -0,0 +1,66 @@
+from queue import Queue, Empty, Full
+from threading import Thread, Event
+import logging
+
+from util.security_util import generate_random_seed_phrase
+
+# Seed phrases generated ahead. Every phrase is handed out once, so this bounds the
+# secrets, that are kept in memory before they belong to an account
+SEED_PHRASE_POOL_SIZE = 64
+
+
+class SeedPhrasePool():
+    """Seed phrases with their hashes, generated ahead by a background thread. A new account only
+    takes one from the queue, so bursts of NEW_ACCOUNT_REQUEST don't wait for the generator.
+    Once the pool is empty, phrases are generated on the request thread, as without the pool.
+    """
+
+    def __init__(self, size: int = SEED_PHRASE_POOL_SIZE):
+        self.__logger = logging.getLogger(__name__)
+        self.__size = size
+        self.__phrases = Queue(maxsize=max(size, 1))
+        self.__stopped = Event()
+        # Phrases, that had to be generated on the request thread
+        self.misses = 0
+
+    @property
+    def available(self) -> int:
+        return self.__phrases.qsize()
+
+    def start(self):
+        """Start filling the pool. Does nothing for a pool of size 0
+        """
+        if self.__size > 0:
+            Thread(target=self.__fill_loop, name="SeedPhrasePool", daemon=True).start()
+
+    def stop(self):
+        self.__stopped.set()
+
+    def take(self) -> (str, bytes):
+        """Remove a seed phrase from the pool, or generate one, if the pool is empty
+
+        Returns
+        -------
+        (str, bytes)
+            Seed phrase and its SHA-512 hash, like `generate_random_seed_phrase`
+        """
+        try:
+            return self.__phrases.get_nowait()
+        except Empty:
+            self.misses += 1
+            return generate_random_seed_phrase()
+
+    def __fill_loop(self):
+        while not self.__stopped.is_set():
+            try:
+                seed_phrase = generate_random_seed_phrase()
+            except Exception as e:  # E.g. bip_utils is missing. Requests then fail with the same error
+                self.__logger.error(f"Generating seed phrases failed: {e}")
+                return
+            # Blocks while the pool is full. The timeout lets the thread notice `stop`
+            while not self.__stopped.is_set():
+                try:
+                    self.__phrases.put(seed_phrase, timeout=1.0)
+                    break
+                except Full:
+                    continue
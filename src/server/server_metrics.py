@@ -0,0 +1,317 @@
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread, Lock
+from urllib.parse import urlparse, parse_qs
+import logging
+
+from server.sampling_profiler import parse_interval
+
+# Upper bounds of the latency buckets in seconds, from 100µs to 5s
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+class Histogram():
+    """Latency histogram with fixed buckets, like a Prometheus histogram.
+    Not thread safe by itself, ServerMetrics guards all updates.
+    """
+
+    def __init__(self, buckets: tuple = LATENCY_BUCKETS):
+        self.buckets = buckets
+        # One count per bucket, plus the +Inf bucket
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q: float) -> float:
+        """Upper bound of the bucket, that contains the q-quantile. None if nothing was observed
+        """
+        if not self.count:
+            return None
+        rank = q * self.count
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            if cumulative >= rank:
+                return bound
+        return float('inf')
+
+    def summary(self) -> dict:
+        return {
+            "count": self.count,
+            "sum": round(self.sum, 6),
+            "p50": self.quantile(0.50),
+            "p95": self.quantile(0.95),
+            "p99": self.quantile(0.99)
+        }
+
+    def prometheus_lines(self, name: str, labels: str = "") -> list:
+        lines = []
+        cumulative = 0
+        separator = "," if labels else ""
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{{{labels}{separator}le="{bound}"}} {cumulative}')
+        lines.append(f'{name}_bucket{{{labels}{separator}le="+Inf"}} {self.count}')
+        label_block = f"{{{labels}}}" if labels else ""
+        lines.append(f"{name}_sum{label_block} {self.sum}")
+        lines.append(f"{name}_count{label_block} {self.count}")
+        return lines
+
+
+class ServerMetrics():
+    """Counters, latency histograms and gauges of a server process.
+    Updated on the hot path of every request, so an update is a single lock acquisition
+    and a few additions. Exposed as Prometheus text and as dict for STATS_REQUEST.
+    """
+
+    def __init__(self):
+        self.__lock = Lock()
+        # Request type -> Histogram of the handling time. The histogram count is the request counter
+        self.__requests = {}
+        # Operation, e.g. `read` or `commit` -> Histogram
+        self.__db = {}
+        self.__handshakes = Histogram()
+        self.__handshake_failures = 0
+        self.__handshakes_resumed = 0
+        self.__bytes_in = 0
+        self.__bytes_out = 0
+        self.__connections_active = 0
+        self.__connections_total = 0
+        # Overflow policy -> outbound queue overflows
+        self.__overflows = {}
+        # Connection cap -> rejected connections
+        self.__rejected_connections = {}
+        self.__idle_closes = 0
+        # Gauge name -> (help text, callable returning the current value)
+        self.__gauges = {}
+
+    def observe_request(self, request_type: str, seconds: float, size: int = 0):
+        """Count a handled request
+
+        Parameters
+        ----------
+        request_type : str
+            Name of the RequestType, or the kind of a binary frame
+        seconds : float
+            Time spent handling the request
+        size : int, optional
+            Received bytes, including the frame header, by default 0
+        """
+        with self.__lock:
+            histogram = self.__requests.get(request_type)
+            if histogram is None:
+                histogram = self.__requests[request_type] = Histogram()
+            histogram.observe(seconds)
+            self.__bytes_in += size
+
+    def observe_db(self, operation: str, seconds: float):
+        with self.__lock:
+            histogram = self.__db.get(operation)
+            if histogram is None:
+                histogram = self.__db[operation] = Histogram()
+            histogram.observe(seconds)
+
+    def observe_handshake(self, seconds: float, failed: bool = False, resumed: bool = False):
+        with self.__lock:
+            if failed:
+                self.__handshake_failures += 1
+            else:
+                self.__handshakes.observe(seconds)
+                if resumed:
+                    self.__handshakes_resumed += 1
+
+    def count_resumed_handshake(self):
+        """Count a handshake, that resumed a TLS session, for engines, that can not time their handshakes
+        """
+        with self.__lock:
+            self.__handshakes_resumed += 1
+
+    def add_bytes_out(self, size: int):
+        with self.__lock:
+            self.__bytes_out += size
+
+    def count_overflow(self, policy: str):
+        with self.__lock:
+            self.__overflows[policy] = self.__overflows.get(policy, 0) + 1
+
+    def count_rejected_connection(self, cap: str):
+        with self.__lock:
+            self.__rejected_connections[cap] = self.__rejected_connections.get(cap, 0) + 1
+
+    def count_idle_close(self):
+        with self.__lock:
+            self.__idle_closes += 1
+
+    def connection_opened(self):
+        with self.__lock:
+            self.__connections_active += 1
+            self.__connections_total += 1
+
+    def connection_closed(self):
+        with self.__lock:
+            self.__connections_active -= 1
+
+    def register_gauge(self, name: str, help_text: str, function):
+        """Add a gauge, that is read when the metrics are exported
+
+        Parameters
+        ----------
+        name : str
+            Metric name, without the `oqs_` prefix
+        help_text : str
+            Description of the gauge
+        function : callable
+            Returns the current value
+        """
+        self.__gauges[name] = (help_text, function)
+
+    def __gauge_values(self) -> dict:
+        values = {}
+        for name, (_, function) in self.__gauges.items():
+            try:
+                values[name] = function()
+            except Exception as e:  # A broken gauge must not break the export
+                logging.getLogger(__name__).warning(f"Gauge {name} failed: {e}")
+        return values
+
+    def snapshot(self) -> dict:
+        """All metrics as JSON serializable dict, with latency summaries instead of buckets
+        """
+        gauges = self.__gauge_values()
+        with self.__lock:
+            return {
+                "requests": {request_type: histogram.summary() for request_type, histogram in self.__requests.items()},
+                "db": {operation: histogram.summary() for operation, histogram in self.__db.items()},
+                "tlsHandshakes": dict(self.__handshakes.summary(), failures=self.__handshake_failures,
+                                      resumed=self.__handshakes_resumed),
+                "bytesIn": self.__bytes_in,
+                "bytesOut": self.__bytes_out,
+                "connectionsActive": self.__connections_active,
+                "connectionsTotal": self.__connections_total,
+                "outboundOverflows": dict(self.__overflows),
+                "connectionsRejected": dict(self.__rejected_connections),
+                "idleConnectionsClosed": self.__idle_closes,
+                "gauges": gauges
+            }
+
+    def render_prometheus(self) -> str:
+        """All metrics in the Prometheus text exposition format
+        """
+        gauges = self.__gauge_values()
+        lines = []
+        with self.__lock:
+            lines.append("# HELP oqs_request_seconds Time spent handling requests, by request type")
+            lines.append("# TYPE oqs_request_seconds histogram")
+            for request_type, histogram in sorted(self.__requests.items()):
+                lines.extend(histogram.prometheus_lines("oqs_request_seconds", f'type="{request_type}"'))
+            lines.append("# HELP oqs_db_seconds Time spent in database reads and group commits")
+            lines.append("# TYPE oqs_db_seconds histogram")
+            for operation, histogram in sorted(self.__db.items()):
+                lines.extend(histogram.prometheus_lines("oqs_db_seconds", f'operation="{operation}"'))
+            lines.append("# HELP oqs_tls_handshake_seconds Duration of completed TLS handshakes")
+            lines.append("# TYPE oqs_tls_handshake_seconds histogram")
+            lines.extend(self.__handshakes.prometheus_lines("oqs_tls_handshake_seconds"))
+            counters = (
+                ("oqs_tls_handshake_failures_total", "Failed TLS handshakes", self.__handshake_failures),
+                ("oqs_tls_handshake_resumed_total", "TLS handshakes, that resumed a session", self.__handshakes_resumed),
+                ("oqs_received_bytes_total", "Bytes received from clients", self.__bytes_in),
+                ("oqs_sent_bytes_total", "Bytes sent to clients", self.__bytes_out),
+                ("oqs_connections_total", "Accepted client connections", self.__connections_total),
+                ("oqs_idle_connections_closed_total", "Connections closed after the idle timeout", self.__idle_closes)
+            )
+            for name, help_text, value in counters:
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} counter")
+                lines.append(f"{name} {value}")
+            lines.append("# HELP oqs_outbound_overflows_total Envelopes, that did not fit in an outbound queue, by policy")
+            lines.append("# TYPE oqs_outbound_overflows_total counter")
+            for policy, count in sorted(self.__overflows.items()):
+                lines.append(f'oqs_outbound_overflows_total{{policy="{policy}"}} {count}')
+            lines.append("# HELP oqs_connections_rejected_total Connections rejected at a connection cap, by cap")
+            lines.append("# TYPE oqs_connections_rejected_total counter")
+            for cap, count in sorted(self.__rejected_connections.items()):
+                lines.append(f'oqs_connections_rejected_total{{cap="{cap}"}} {count}')
+            lines.append("# HELP oqs_connections_active Open client connections")
+            lines.append("# TYPE oqs_connections_active gauge")
+            lines.append(f"oqs_connections_active {self.__connections_active}")
+        for name, value in gauges.items():
+            lines.append(f"# HELP oqs_{name} {self.__gauges[name][0]}")
+            lines.append(f"# TYPE oqs_{name} gauge")
+            lines.append(f"oqs_{name} {value}")
+        return "\n".join(lines) + "\n"
+
+
+class _MetricsRequestHandler(BaseHTTPRequestHandler):
+    """GET /metrics for Prometheus. The sampling profiler is toggled with
+    POST /profiler/start?interval=0.005 and POST /profiler/stop, GET /profiler returns its stacks.
+    """
+
+    def __respond(self, status: int, body: str):
+        data = body.encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        path = urlparse(self.path).path
+        if path == "/metrics":
+            self.__respond(200, self.server.metrics.render_prometheus())
+        elif path == "/profiler":
+            self.__respond(200, self.server.profiler.collapsed_stacks())
+        else:
+            self.__respond(404, "Not found\n")
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path == "/profiler/start":
+            try:
+                interval = parse_interval(parse_qs(url.query).get('interval', ['0.005'])[0])
+            except ValueError as e:
+                self.__respond(400, f"{e}\n")
+                return
+            self.server.profiler.start(interval)
+            self.__respond(200, f"Profiler started, sampling every {interval}s\n")
+        elif url.path == "/profiler/stop":
+            self.server.profiler.stop()
+            self.__respond(200, "Profiler stopped\n")
+        else:
+            self.__respond(404, "Not found\n")
+
+    def log_message(self, format, *args):
+        # Scrapes are too frequent for the server log
+        pass
+
+
+def start_metrics_endpoint(metrics: ServerMetrics, profiler, host: str, port: int) -> ThreadingHTTPServer:
+    """Serve the metrics and the profiler over HTTP, on a daemon thread.
+    Only meant to be reachable locally, e.g. by a Prometheus agent on the same host.
+
+    Parameters
+    ----------
+    metrics : ServerMetrics
+        Metrics of the server
+    profiler : SamplingProfiler
+        Profiler of the server process
+    host : str
+        Address to bind to
+    port : int
+        Port to bind to
+
+    Returns
+    -------
+    ThreadingHTTPServer
+        Running HTTP server. Stop it with `shutdown()`
+    """
+    http_server = ThreadingHTTPServer((host, port), _MetricsRequestHandler)
+    http_server.daemon_threads = True
+    http_server.metrics = metrics
+    http_server.profiler = profiler
+    Thread(target=http_server.serve_forever, name="MetricsEndpoint", daemon=True).start()
+    return http_server
@@ -0,0 +1,277 @@
+from concurrent.futures import Future
+from queue import Queue, Empty
+from contextlib import contextmanager
+from threading import Thread
+import logging
+import sqlite3
+import time
+import zlib
+
+_STOP = object()
+# Bound parameters per statement, the default limit of older SQLite versions
+MAX_QUERY_PARAMS = 999
+# Seconds a statement waits for the lock of the database. The workers of the supervisor
+# share the database, each with its own writer, so a group commit can wait for another one
+BUSY_TIMEOUT = 30.0
+# Attempts of a group commit, that still found the database locked after the busy timeout
+COMMIT_ATTEMPTS = 3
+# Clients with their capabilities. Clients, that never announced one, have none
+_SELECT_CLIENTS = """
+    SELECT c.*, coalesce(cc.sessions, 0) AS sessions FROM clients c
+    LEFT JOIN client_capabilities cc ON cc.uuid = c.uuid
+"""
+
+
+def _is_locked(error: sqlite3.Error) -> bool:
+    """Check if a statement failed, because another connection holds the lock of the database
+    """
+    return str(error).startswith(("database is locked", "database is busy"))
+
+
+class ServerStorage():
+    """Storage layer of the server. All writes go through a queue to a single writer thread,
+    which commits them in groups: every write, that arrives within `group_commit_window` seconds
+    of the first one, shares its transaction and fsync. Reads use a pool of read-only connections,
+    which WAL mode allows to run next to the writer.
+    """
+
+    def __init__(self, db_path: str, setup_script_path: str, group_commit_window: float = 0.002,
+                 max_group_size: int = 512, num_readers: int = 8, metrics=None, busy_timeout: float = BUSY_TIMEOUT):
+        self.__logger = logging.getLogger(__name__)
+        # ServerMetrics, that records the duration of reads and group commits
+        self.__metrics = metrics
+        self.__group_commit_window = group_commit_window
+        self.__max_group_size = max_group_size
+        self.__queue = Queue()
+        self.__readers = Queue()
+        self.__num_readers = num_readers
+
+        self.__writer_connection = sqlite3.connect(db_path, timeout=busy_timeout, check_same_thread=False)
+        self.__writer_connection.execute("PRAGMA journal_mode=WAL")
+        self.__setup_schema(setup_script_path)
+
+        self.__writer_thread = Thread(target=self.__write_loop, name="ServerStorageWriter", daemon=True)
+        self.__writer_thread.start()
+
+        for _ in range(num_readers):
+            connection = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True, timeout=busy_timeout,
+                                         check_same_thread=False)
+            connection.row_factory = sqlite3.Row
+            self.__readers.put(connection)
+
+    def __setup_schema(self, setup_script_path: str):
+        """Run the setup script, unless the database was set up with the same script before.
+        The schema version is a checksum of the script, kept in `PRAGMA user_version`, so every
+        change of the script runs it once more. The script only creates what does not exist yet
+        """
+        with open(setup_script_path) as setup_file:
+            setup_script = setup_file.read()
+        # user_version is a signed 32 bit integer, 0 means never set up
+        schema_version = zlib.crc32(setup_script.encode()) & 0x7fffffff or 1
+        if self.__writer_connection.execute("PRAGMA user_version").fetchone()[0] == schema_version:
+            self.__logger.info(f"Schema version {schema_version} is up to date")
+            return
+        self.__writer_connection.executescript(setup_script)
+        self.__writer_connection.execute(f"PRAGMA user_version = {schema_version}")
+        self.__writer_connection.commit()
+
+    def __write_loop(self):
+        """Collect writes for one group commit, execute them in a single transaction and resolve their futures
+        """
+        while True:
+            item = self.__queue.get()
+            if item is _STOP:
+                return
+            group = [item]
+            stop = False
+            deadline = time.monotonic() + self.__group_commit_window
+            while len(group) < self.__max_group_size:
+                timeout = deadline - time.monotonic()
+                try:
+                    item = self.__queue.get(timeout=timeout) if timeout > 0 else self.__queue.get_nowait()
+                except Empty:
+                    break
+                if item is _STOP:
+                    stop = True
+                    break
+                group.append(item)
+
+            self.__commit_group(group)
+            if stop:
+                return
+
+    def __commit_group(self, group: list):
+        """Commit a group, and retry it as a whole, if the database stayed locked for the busy timeout
+        """
+        start = time.perf_counter()
+        for attempt in range(1, COMMIT_ATTEMPTS + 1):
+            try:
+                results = self.__execute_group(group)
+                break
+            except sqlite3.Error as e:
+                self.__writer_connection.rollback()
+                if not _is_locked(e) or attempt == COMMIT_ATTEMPTS:
+                    self.__logger.error(f"Group commit of {len(group)} writes failed: {e}")
+                    results = [(future, None, e) for _, _, future in group]
+                    break
+                self.__logger.warning(f"Database locked, attempt {attempt} of {COMMIT_ATTEMPTS} "
+                                      f"to commit {len(group)} writes")
+        if self.__metrics is not None:
+            self.__metrics.observe_db('commit', time.perf_counter() - start)
+
+        for future, lastrowid, error in results:
+            if error is None:
+                future.set_result(lastrowid)
+            else:
+                future.set_exception(error)
+
+    def __execute_group(self, group: list) -> list:
+        """Execute a group in one transaction. A failing statement only fails its own future,
+        unless the database is locked. Then the whole transaction is given up.
+
+        Returns
+        -------
+        list
+            Tuples of future, `lastrowid` and error
+        """
+        results = []
+        for sql, params, future in group:
+            try:
+                cursor = self.__writer_connection.execute(sql, params)
+                results.append((future, cursor.lastrowid, None))
+            except sqlite3.Error as e:
+                if _is_locked(e):
+                    raise
+                results.append((future, None, e))
+        self.__writer_connection.commit()
+        return results
+
+    def write(self, sql: str, params=()) -> Future:
+        """Queue a write for the next group commit
+
+        Parameters
+        ----------
+        sql : str
+            Single SQL statement
+        params : dict or tuple, optional
+            Parameters of the statement
+
+        Returns
+        -------
+        Future
+            Resolves to the `lastrowid` of the statement, once it is committed
+        """
+        future = Future()
+        self.__queue.put((sql, params, future))
+        return future
+
+    @contextmanager
+    def __reader(self):
+        """Borrow a read-only connection. Only one thread uses a connection at a time.
+        The recorded read time includes waiting for a free connection
+        """
+        start = time.perf_counter()
+        connection = self.__readers.get()
+        try:
+            yield connection
+        finally:
+            self.__readers.put(connection)
+            if self.__metrics is not None:
+                self.__metrics.observe_db('read', time.perf_counter() - start)
+
+    def read_one(self, sql: str, params=()):
+        with self.__reader() as connection:
+            return connection.execute(sql, params).fetchone()
+
+    def read_all(self, sql: str, params=()) -> list:
+        with self.__reader() as connection:
+            return connection.execute(sql, params).fetchall()
+
+    def pending_writes(self) -> int:
+        """Amount of writes waiting for the writer thread
+        """
+        return self.__queue.qsize()
+
+    def client_with_uuid(self, uuid: str):
+        """Search for a client in the database with specified UUID
+        """
+        return self.read_one(f"""
+            {_SELECT_CLIENTS} WHERE c.uuid = :uuid
+        """, {"uuid": str(uuid)})
+
+    def clients_with_uuids(self, uuids) -> list:
+        """Search for all clients with the specified UUIDs, with one `IN (...)` query
+        per MAX_QUERY_PARAMS UUIDs. Unknown UUIDs are left out.
+        """
+        uuids = [str(uuid) for uuid in uuids]
+        rows = []
+        for start in range(0, len(uuids), MAX_QUERY_PARAMS):
+            chunk = uuids[start:start + MAX_QUERY_PARAMS]
+            placeholders = ", ".join("?" * len(chunk))
+            rows.extend(self.read_all(f"""
+                {_SELECT_CLIENTS} WHERE c.uuid IN ({placeholders})
+            """, chunk))
+        return rows
+
+    def insert_client(self, uuid: str, name: str, public_key: bytes) -> Future:
+        """Add a new client account
+
+        Returns
+        -------
+        Future
+            Resolves once the account is committed
+        """
+        return self.write("""
+            INSERT INTO clients
+            VALUES (
+                :uuid,
+                :name,
+                :publicKey
+            )
+        """, {
+            "uuid": str(uuid),
+            "name": name,
+            "publicKey": public_key
+        })
+
+    def set_sessions(self, uuid: str, sessions: bool) -> Future:
+        """Store, if the client establishes sessions. Updated, when a client logs in with another version
+
+        Returns
+        -------
+        Future
+            Resolves once the capability is committed
+        """
+        return self.write("""
+            INSERT OR REPLACE INTO client_capabilities VALUES (:uuid, :sessions)
+        """, {"uuid": str(uuid), "sessions": int(sessions)})
+
+    def group_members(self, group_id: str) -> set:
+        """UUIDs of the members of a group. Empty, if the group is not known yet
+        """
+        return {row[0] for row in self.read_all("""
+            SELECT member FROM group_members WHERE group_id = :groupId
+        """, {"groupId": str(group_id)})}
+
+    def insert_group_members(self, group_id: str, members) -> Future:
+        """Record the members of a group. Members, that are already recorded, are ignored
+
+        Returns
+        -------
+        Future
+            Resolves once the members are committed
+        """
+        members = [str(member) for member in members]
+        placeholders = ", ".join(["(?, ?)"] * len(members))
+        return self.write(f"""
+            INSERT OR IGNORE INTO group_members VALUES {placeholders}
+        """, [value for member in members for value in (str(group_id), member)])
+
+    def close(self):
+        """Commit all pending writes and stop the writer thread
+        """
+        self.__queue.put(_STOP)
+        self.__writer_thread.join()
+        self.__writer_connection.close()
+        for _ in range(self.__num_readers):
+            self.__readers.get().close()
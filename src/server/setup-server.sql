@@ -9,3 +9,31 @@ CREATE TABLE IF NOT EXISTS clients
 
 CREATE UNIQUE INDEX IF NOT EXISTS clients_uuid_uindex
             ON clients (uuid);
+
+CREATE TABLE IF NOT EXISTS client_capabilities
+(
+    uuid TEXT NOT NULL -- Clients without a row never announced a capability
+        constraint client_capabilities_pk
+            primary key,
+    sessions INTEGER NOT NULL, -- 1, if the client establishes sessions instead of sending the KEM ciphertext
+    FOREIGN KEY(uuid) REFERENCES clients(uuid)
+);
+
+CREATE TABLE IF NOT EXISTS offline_messages
+(
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    recipient TEXT NOT NULL,
+    envelope BLOB NOT NULL, -- Frame payload, exactly as it would have been relayed
+    created INTEGER NOT NULL, -- Represented as unix timestamp
+    FOREIGN KEY(recipient) REFERENCES clients(uuid)
+);
+
+CREATE INDEX IF NOT EXISTS offline_messages_recipient_id_index
+            ON offline_messages (recipient, id);
+
+CREATE TABLE IF NOT EXISTS group_members
+(
+    group_id TEXT NOT NULL, -- Groups are only known by their members, recorded with the first group message
+    member TEXT NOT NULL,
+    PRIMARY KEY (group_id, member)
+);
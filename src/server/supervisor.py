@@ -0,0 +1,87 @@
+import logging
+import multiprocessing
+import shutil
+import signal
+import tempfile
+import time
+
+from server.worker_router import WorkerRouter
+
+
+def _run_worker(server_class, server_kwargs: dict, start_kwargs: dict, worker_id: int, num_workers: int,
+                socket_dir: str):
+    """Entry point of a worker process
+    """
+    # The SIGTERM handler of the supervisor is inherited by the fork
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    router = WorkerRouter(worker_id, num_workers, socket_dir)
+    if server_kwargs.get('metrics_port') is not None:
+        # Every worker serves its own metrics, on consecutive ports
+        server_kwargs = dict(server_kwargs, metrics_port=server_kwargs['metrics_port'] + worker_id)
+    server = server_class(reuse_port=True, router=router, **server_kwargs)
+    server.start(**start_kwargs)
+
+
+class Supervisor():
+    """Runs the server in several worker processes, so TLS and request handling use every core.
+    All workers listen on the same port with SO_REUSEPORT, the kernel spreads new connections
+    over them. Workers are linked through a WorkerRouter and restarted, if they die.
+    Needs Linux, for SO_REUSEPORT load balancing and the fork start method.
+    """
+
+    def __init__(self, server_class, num_workers: int, server_kwargs: dict = None, start_kwargs: dict = None,
+                 check_interval: float = 1.0):
+        self.__logger = logging.getLogger(__name__)
+        self.__server_class = server_class
+        self.__num_workers = num_workers
+        self.__server_kwargs = server_kwargs or {}
+        self.__start_kwargs = start_kwargs or {}
+        self.__check_interval = check_interval
+        self.__context = multiprocessing.get_context('fork')
+        self.__socket_dir = None
+        self.__workers = {}
+        self.keep_running = True
+
+    def __spawn(self, worker_id: int):
+        process = self.__context.Process(
+            target=_run_worker,
+            args=(self.__server_class, self.__server_kwargs, self.__start_kwargs, worker_id,
+                  self.__num_workers, self.__socket_dir),
+            name=f"oqs-worker-{worker_id}",
+            daemon=True
+        )
+        process.start()
+        self.__workers[worker_id] = process
+        self.__logger.info(f"Started worker {worker_id} with pid {process.pid}")
+
+    def start(self):
+        """Start all workers and restart them, if they die. Blocks until interrupted
+        """
+        self.__socket_dir = tempfile.mkdtemp(prefix="oqs-workers-")
+        # Stop the workers as well, when the supervisor is terminated
+        signal.signal(signal.SIGTERM, lambda signum, frame: setattr(self, 'keep_running', False))
+        self.__logger.info(f"Starting {self.__num_workers} workers")
+        try:
+            for worker_id in range(self.__num_workers):
+                self.__spawn(worker_id)
+            while self.keep_running:
+                time.sleep(self.__check_interval)
+                for worker_id, process in list(self.__workers.items()):
+                    if self.keep_running and not process.is_alive():
+                        self.__logger.warning(f"Worker {worker_id} exited with code {process.exitcode}. Restarting")
+                        self.__spawn(worker_id)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop()
+
+    def stop(self):
+        """Stop all workers
+        """
+        self.keep_running = False
+        for process in self.__workers.values():
+            process.terminate()
+        for process in self.__workers.values():
+            process.join()
+        if self.__socket_dir is not None:
+            shutil.rmtree(self.__socket_dir, ignore_errors=True)
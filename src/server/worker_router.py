@@ -0,0 +1,232 @@
+from socket import AF_UNIX, socket, SOCK_STREAM
+from threading import Thread, Lock, RLock
+import logging
+import os
+import struct
+import time
+import uuid
+
+from util.frame_codec import FrameDecoder, ConnectionClosedError, encode_frame
+
+
+class LinkKind():
+    """Kind of a frame between two workers, first byte of every frame
+    """
+    HELLO = 0x01  # Worker id of the sending worker, first frame of every link
+    ONLINE = 0x02  # A client logged in on the sending worker
+    OFFLINE = 0x03  # The last connection of a client on the sending worker is gone
+    DELIVER = 0x04  # Envelope for a client, that is online on the receiving worker
+
+
+# kind, worker id
+_HELLO = struct.Struct("!BH")
+# kind, client UUID. DELIVER frames are followed by the envelope
+_CLIENT = struct.Struct("!B16s")
+
+
+class WorkerRouter():
+    """Routing fabric between the worker processes of one server.
+    Every worker listens on a Unix domain socket in `socket_dir` and keeps one link to every
+    other worker. Workers announce, which clients are online on them, so each worker keeps a
+    presence map of the whole server. Messages for a client on another worker are forwarded
+    over the link to that worker.
+    """
+
+    def __init__(self, worker_id: int, num_workers: int, socket_dir: str, retry_interval: float = 0.2):
+        self.__logger = logging.getLogger(__name__)
+        self.__worker_id = worker_id
+        self.__num_workers = num_workers
+        self.__socket_dir = socket_dir
+        self.__retry_interval = retry_interval
+        self.__deliver_local = None
+        self.__listener = None
+        self.__keep_running = True
+
+        # Guards presence announcements, so every link sees them in the same order
+        self.__lock = RLock()
+        # Clients online on this worker, sent to every newly connected worker
+        self.__local_online = set()
+        # Worker id -> (socket, lock) of the outgoing link
+        self.__links = {}
+        # UUID string -> frozenset of worker ids. Replaced, never mutated, so readers don't need a lock
+        self.__presence = {}
+        self.__presence_lock = Lock()
+
+    def __socket_path(self, worker_id: int) -> str:
+        return os.path.join(self.__socket_dir, f"worker-{worker_id}.sock")
+
+    def start(self, deliver_local):
+        """Listen for the other workers and connect to them
+
+        Parameters
+        ----------
+        deliver_local : callable
+            Called with the contact UUID and the envelope for every forwarded message
+        """
+        self.__deliver_local = deliver_local
+        path = self.__socket_path(self.__worker_id)
+        if os.path.exists(path):
+            os.remove(path)
+        self.__listener = socket(AF_UNIX, SOCK_STREAM)
+        self.__listener.bind(path)
+        self.__listener.listen(self.__num_workers)
+        Thread(target=self.__accept_links, daemon=True).start()
+
+        for worker_id in range(self.__num_workers):
+            if worker_id != self.__worker_id:
+                Thread(target=self.__connect_link, args=(worker_id,), daemon=True).start()
+
+    def __accept_links(self):
+        while self.__keep_running:
+            try:
+                link, _ = self.__listener.accept()
+            except OSError:
+                return
+            Thread(target=self.__read_link, args=(link,), daemon=True).start()
+
+    def __connect_link(self, worker_id: int):
+        """Connect to another worker. Retried until the worker is up, e.g. after it was restarted
+        """
+        while self.__keep_running:
+            link = socket(AF_UNIX, SOCK_STREAM)
+            try:
+                link.connect(self.__socket_path(worker_id))
+            except OSError:
+                link.close()
+                time.sleep(self.__retry_interval)
+                continue
+
+            frames = [encode_frame(_HELLO.pack(LinkKind.HELLO, self.__worker_id))]
+            with self.__lock:
+                frames.extend(encode_frame(_CLIENT.pack(LinkKind.ONLINE, uuid.UUID(client_uuid).bytes))
+                              for client_uuid in self.__local_online)
+                try:
+                    link.sendall(b"".join(frames))
+                except OSError:
+                    link.close()
+                    continue
+                self.__links[worker_id] = (link, Lock())
+            self.__logger.info(f"Worker {self.__worker_id} linked to worker {worker_id}")
+            return
+
+    def __drop_link(self, worker_id: int, link):
+        """Forget a broken outgoing link and connect again
+        """
+        with self.__lock:
+            if self.__links.get(worker_id, (None,))[0] is not link:
+                return
+            del self.__links[worker_id]
+        link.close()
+        self.__logger.warning(f"Link from worker {self.__worker_id} to worker {worker_id} lost")
+        if self.__keep_running:
+            Thread(target=self.__connect_link, args=(worker_id,), daemon=True).start()
+
+    def __send(self, worker_id: int, frame: bytes) -> bool:
+        entry = self.__links.get(worker_id)
+        if entry is None:
+            return False
+        link, link_lock = entry
+        try:
+            with link_lock:
+                link.sendall(frame)
+            return True
+        except OSError:
+            self.__drop_link(worker_id, link)
+            return False
+
+    def __read_link(self, link):
+        """Read presence updates and forwarded messages of another worker
+        """
+        decoder = FrameDecoder()
+        peer_id = None
+        try:
+            while self.__keep_running:
+                for frame in decoder.recv_frames(link):
+                    kind = frame[0]
+                    if kind == LinkKind.HELLO:
+                        _, peer_id = _HELLO.unpack_from(frame)
+                        continue
+                    _, client_uuid = _CLIENT.unpack_from(frame)
+                    client_uuid = str(uuid.UUID(bytes=client_uuid))
+                    if kind == LinkKind.ONLINE:
+                        self.__set_presence(client_uuid, peer_id, True)
+                    elif kind == LinkKind.OFFLINE:
+                        self.__set_presence(client_uuid, peer_id, False)
+                    elif kind == LinkKind.DELIVER:
+                        try:
+                            self.__deliver_local(client_uuid, frame[_CLIENT.size:])
+                        except Exception as e:  # Only this envelope is lost, the link serves every client
+                            self.__logger.error(f"Delivering a forwarded envelope to {client_uuid} failed: {e}")
+        except (ConnectionClosedError, OSError):
+            pass
+        finally:
+            link.close()
+            if peer_id is not None:
+                self.__forget_worker(peer_id)
+
+    def __set_presence(self, client_uuid: str, worker_id: int, online: bool):
+        with self.__presence_lock:
+            workers = self.__presence.get(client_uuid, frozenset())
+            workers = workers | {worker_id} if online else workers - {worker_id}
+            if workers:
+                self.__presence[client_uuid] = workers
+            else:
+                self.__presence.pop(client_uuid, None)
+
+    def __forget_worker(self, worker_id: int):
+        """A worker is gone. None of its clients are online anymore
+        """
+        with self.__presence_lock:
+            for client_uuid, workers in list(self.__presence.items()):
+                if worker_id in workers:
+                    workers = workers - {worker_id}
+                    if workers:
+                        self.__presence[client_uuid] = workers
+                    else:
+                        del self.__presence[client_uuid]
+
+    def __announce(self, kind: int, client_uuid: str):
+        frame = encode_frame(_CLIENT.pack(kind, uuid.UUID(client_uuid).bytes))
+        for worker_id in list(self.__links):
+            self.__send(worker_id, frame)
+
+    def announce_online(self, client_uuid: str):
+        """The first connection of a client logged in on this worker
+        """
+        client_uuid = str(client_uuid)
+        with self.__lock:
+            self.__local_online.add(client_uuid)
+            self.__announce(LinkKind.ONLINE, client_uuid)
+
+    def announce_offline(self, client_uuid: str):
+        """The last connection of a client on this worker is gone
+        """
+        client_uuid = str(client_uuid)
+        with self.__lock:
+            self.__local_online.discard(client_uuid)
+            self.__announce(LinkKind.OFFLINE, client_uuid)
+
+    def workers_for(self, client_uuid: str) -> frozenset:
+        """Other workers, the client is online on
+        """
+        return self.__presence.get(str(client_uuid), frozenset())
+
+    def forward(self, worker_id: int, client_uuid: str, envelope: bytes) -> bool:
+        """Forward an envelope to the worker of the client
+
+        Returns
+        -------
+        bool
+            False, if there is no link to the worker
+        """
+        header = _CLIENT.pack(LinkKind.DELIVER, uuid.UUID(str(client_uuid)).bytes)
+        return self.__send(worker_id, encode_frame(b"".join((header, envelope))))
+
+    def close(self):
+        self.__keep_running = False
+        if self.__listener is not None:
+            self.__listener.close()
+        with self.__lock:
+            for link, _ in self.__links.values():
+                link.close()
+            self.__links.clear()
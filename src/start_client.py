@@ -1,5 +1,5 @@
 import eel
-from client.oqs_client import OQSClient
+from client.oqs_client import OQSClient, HISTORY_PAGE_SIZE
 import sys
 
 print(sys.path)
@@ -12,6 +12,10 @@ def contact_connection_request(uuid):
     result = oqs_client.contact_connection_request(uuid)
     return result
 
+@eel.expose
+def contacts_connection_request(uuids):
+    oqs_client.contacts_connection_request(uuids)
+
 @eel.expose
 def get_uuid():
     uuid = oqs_client.get_uuid()
@@ -28,13 +32,37 @@ def load_chat_overview():
     return chat_overview
 
 @eel.expose
-def load_chat_history():
-    chat_history = oqs_client.load_chat_history()
+def load_chat_history(contact: str, before: str = None, limit: int = HISTORY_PAGE_SIZE):
+    chat_history = oqs_client.load_chat_history(contact, before, limit)
     return chat_history
 
+@eel.expose
+def load_history_since(since=None):
+    return oqs_client.load_history_since(since)
+
 @eel.expose
 def send_message(uuid: str, message: str):
-    oqs_client.send_msg(contact_uuid=uuid, msg=message)
+    return oqs_client.send_msg(contact_uuid=uuid, msg=message)
+
+@eel.expose
+def load_group_history(group_id: str, before: str = None, limit: int = HISTORY_PAGE_SIZE):
+    return oqs_client.load_group_history(group_id, before, limit)
+
+@eel.expose
+def create_group(name: str, uuids):
+    return oqs_client.create_group(name, uuids)
+
+@eel.expose
+def send_group_message(group_id: str, message: str):
+    return oqs_client.send_group_msg(group_id=group_id, msg=message)
+
+@eel.expose
+def send_attachment(uuid: str, path: str):
+    return oqs_client.send_attachment(contact_uuid=uuid, path=path)
+
+@eel.expose
+def attachment_progress(transfer_id: str):
+    return oqs_client.attachment_progress(transfer_id)
 
 oqs_client = OQSClient(name=sys.argv[1], eel=eel)
 oqs_client.connect()
@@ -1,4 +1,76 @@
+import argparse
+import logging
+import os
 from server.oqs_server import OQSServer
+from server.async_oqs_server import AsyncOQSServer
+from server.supervisor import Supervisor
+from server.outbound_queue import OUTBOUND_QUEUE_SIZE, OVERFLOW_POLICIES, OVERFLOW_SPILL
+from server.connection_lifecycle import HEARTBEAT_INTERVAL, IDLE_TIMEOUT
+from server.seed_phrase_pool import SEED_PHRASE_POOL_SIZE
+from server.cluster import Cluster, parse_nodes
 
-server = OQSServer()
-server.start()
+
+def main():
+    parser = argparse.ArgumentParser(description="Start the PQ chat server")
+    parser.add_argument('--engine', choices=['threaded', 'async'], default='threaded',
+                        help="threaded: one thread per client. async: all clients on one asyncio event loop")
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=33000)
+    parser.add_argument('--db', default="server/pq-chat-server.db", help="Path of the SQLite database")
+    parser.add_argument('--backlog', type=int, default=None, help="Max pending connections")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="Worker processes sharing the port with SO_REUSEPORT. More than 1 needs Linux")
+    parser.add_argument('--cluster', default=None,
+                        help="Run as node of a cluster, e.g. a=localhost:33000,b=localhost:33001")
+    parser.add_argument('--node', default=None, help="Name of this node in --cluster")
+    parser.add_argument('--cluster-secret', default=os.environ.get('OQS_CLUSTER_SECRET'),
+                        help="Shared secret of the cluster nodes, by default $OQS_CLUSTER_SECRET")
+    parser.add_argument('--metrics-port', type=int, default=None,
+                        help="Serve Prometheus metrics on localhost. Workers use consecutive ports")
+    parser.add_argument('--outbound-queue-size', type=int, default=OUTBOUND_QUEUE_SIZE,
+                        help="Bytes, that may wait per connection for a slow client")
+    parser.add_argument('--overflow-policy', choices=OVERFLOW_POLICIES, default=OVERFLOW_SPILL,
+                        help="For envelopes to a full outbound queue. spill: queue them in the offline store, "
+                             "until the client caught up. disconnect: close the connection. drop: discard them")
+    parser.add_argument('--heartbeat-interval', type=float, default=HEARTBEAT_INTERVAL,
+                        help="Seconds between heartbeats of idle clients, announced to the clients")
+    parser.add_argument('--idle-timeout', type=float, default=IDLE_TIMEOUT,
+                        help="Close connections of clients, that were told the heartbeat interval and sent "
+                             "nothing for this many seconds. 0 disables it")
+    parser.add_argument('--max-connections', type=int, default=None,
+                        help="Connections per worker, by default derived from the file descriptor limit")
+    parser.add_argument('--max-connections-per-ip', type=int, default=None,
+                        help="Connections per worker from a single address, by default unlimited")
+    parser.add_argument('--seed-phrase-pool', type=int, default=SEED_PHRASE_POOL_SIZE,
+                        help="Seed phrases generated ahead for new accounts. 0 generates them per request")
+    parser.add_argument('--log-level', choices=['DEBUG', 'INFO', 'WARNING'], default='INFO',
+                        help="DEBUG also logs request payloads")
+    args = parser.parse_args()
+    if args.cluster is not None:
+        if args.node is None or args.cluster_secret is None:
+            parser.error("--cluster needs --node and a cluster secret")
+        if args.workers > 1:
+            parser.error("--cluster can not be combined with --workers")
+
+    # Only for this process. Importers of the server modules keep their own levels
+    logging.getLogger('server').setLevel(args.log_level)
+
+    server_class = AsyncOQSServer if args.engine == 'async' else OQSServer
+    server_kwargs = {'host': args.host, 'port': args.port, 'db_path': args.db, 'metrics_port': args.metrics_port,
+                     'outbound_queue_size': args.outbound_queue_size, 'overflow_policy': args.overflow_policy,
+                     'heartbeat_interval': args.heartbeat_interval, 'idle_timeout': args.idle_timeout or None,
+                     'max_connections': args.max_connections, 'max_connections_per_ip': args.max_connections_per_ip,
+                     'seed_phrase_pool_size': args.seed_phrase_pool, 'log_level': args.log_level}
+    start_kwargs = {} if args.backlog is None else {'num_connections': args.backlog}
+
+    if args.workers > 1:
+        Supervisor(server_class, args.workers, server_kwargs, start_kwargs).start()
+    else:
+        if args.cluster is not None:
+            server_kwargs['cluster'] = Cluster(args.node, parse_nodes(args.cluster), args.cluster_secret)
+        server = server_class(**server_kwargs)
+        server.start(**start_kwargs)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,128 @@
+import struct
+
+# Every frame on the wire is a 4 byte big endian length, followed by the payload
+FRAME_HEADER = struct.Struct("!I")
+MAX_FRAME_SIZE = 64 * 1024 * 1024
+# Frames of a peer, that did not log in yet, e.g. HELLO and LOGIN requests. Bounds the memory
+# an unauthenticated connection can make the server buffer
+UNAUTHENTICATED_FRAME_SIZE = 64 * 1024
+
+
+class FrameTooLargeError(ValueError):
+    """Raised when a peer announces a frame bigger than the limit of the decoder
+    """
+
+
+class ConnectionClosedError(ConnectionError):
+    """Raised when the peer closed the connection
+    """
+
+
+def encode_frame(payload: bytes) -> bytes:
+    """Prefix payload with its length
+
+    Parameters
+    ----------
+    payload : bytes
+        Raw payload, usually a JSON document
+
+    Returns
+    -------
+    bytes
+        Length prefixed frame
+    """
+    if len(payload) > MAX_FRAME_SIZE:
+        raise FrameTooLargeError(f"Frame of {len(payload)} bytes exceeds {MAX_FRAME_SIZE} bytes")
+    return FRAME_HEADER.pack(len(payload)) + payload
+
+
+def send_frame(sock, payload: bytes):
+    """Send a single frame over the socket. `sendall` makes sure the frame
+    is fully written, even if the TLS layer splits it up.
+
+    Parameters
+    ----------
+    sock : socket
+        Connected (TLS) socket
+    payload : bytes
+        Raw payload to send
+    """
+    sock.sendall(encode_frame(payload))
+
+
+class FrameDecoder():
+    """Incremental decoder for length prefixed frames.
+    Bytes are read into a reusable receive buffer, so a single read can
+    contain many pipelined frames, or only a part of a large one.
+    """
+
+    def __init__(self, bufsize: int = 65536, max_frame_size: int = MAX_FRAME_SIZE):
+        self._recv_buffer = bytearray(bufsize)
+        self._recv_view = memoryview(self._recv_buffer)
+        self._pending = bytearray()
+        # May be raised between two calls, e.g. once the peer logged in
+        self.max_frame_size = max_frame_size
+
+    def feed(self, data) -> list:
+        """Add received bytes and return all frames, that are complete. Frames before one, that
+        exceeds `max_frame_size`, are returned first. They may raise the limit, before `feed(b"")`
+        checks the held back frame again
+
+        Parameters
+        ----------
+        data : bytes-like
+            Bytes received from the peer
+
+        Returns
+        -------
+        list
+            List of complete frame payloads as bytes
+
+        Raises
+        ------
+        FrameTooLargeError
+            If the next frame exceeds `max_frame_size`
+        """
+        self._pending += data
+        frames = []
+        offset = 0
+        pending_len = len(self._pending)
+        while pending_len - offset >= FRAME_HEADER.size:
+            (frame_size,) = FRAME_HEADER.unpack_from(self._pending, offset)
+            if frame_size > self.max_frame_size:
+                if frames:
+                    break
+                raise FrameTooLargeError(f"Peer announced frame of {frame_size} bytes, "
+                                         f"the limit is {self.max_frame_size} bytes")
+            frame_end = offset + FRAME_HEADER.size + frame_size
+            if frame_end > pending_len:
+                break
+            frames.append(bytes(self._pending[offset + FRAME_HEADER.size:frame_end]))
+            offset = frame_end
+        if offset:
+            del self._pending[:offset]
+        return frames
+
+    def recv_frames(self, sock) -> list:
+        """Read once from the socket and return all complete frames.
+        May return an empty list, if only part of a frame arrived.
+
+        Parameters
+        ----------
+        sock : socket
+            Connected (TLS) socket
+
+        Returns
+        -------
+        list
+            List of complete frame payloads as bytes
+
+        Raises
+        ------
+        ConnectionClosedError
+            If the peer closed the connection
+        """
+        received = sock.recv_into(self._recv_buffer)
+        if received == 0:
+            raise ConnectionClosedError("Connection closed by peer")
+        return self.feed(self._recv_view[:received])
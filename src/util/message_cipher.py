@@ -0,0 +1,129 @@
+from abc import ABC, abstractmethod
+
+try:
+    import numpy
+except ImportError:  # NumPy is optional, the big-int backend is used instead
+    numpy = None
+
+# Keystreams are cached up to this size. Bigger inputs are processed in blocks of this size
+MAX_KEYSTREAM_CACHE = 1024 * 1024
+
+
+class MessageCipher(ABC):
+    """Base class for message ciphers. `apply` en- and decrypts whole buffers,
+    `stream` does the same for an iterable of chunks, e.g. for large payloads.
+    """
+    name = None
+
+    @abstractmethod
+    def apply(self, data, offset: int = 0) -> bytes:
+        """Encrypt or decrypt a buffer
+
+        Parameters
+        ----------
+        data : bytes-like
+            Plaintext or ciphertext
+        offset : int, optional
+            Position of data in the whole stream, by default 0
+
+        Returns
+        -------
+        bytes
+            Processed data
+        """
+
+    def stream(self, chunks, offset: int = 0):
+        """Encrypt or decrypt consecutive chunks of one stream
+
+        Parameters
+        ----------
+        chunks : iterable
+            Iterable of bytes-like chunks
+        offset : int, optional
+            Position of the first chunk in the whole stream, by default 0
+
+        Yields
+        ------
+        bytes
+            Processed chunk
+        """
+        for chunk in chunks:
+            yield self.apply(chunk, offset)
+            offset += len(chunk)
+
+
+class XorMessageCipher(MessageCipher):
+    """XOR with the repeated shared secret. The whole buffer is processed in one
+    operation, either as NumPy array or as big integer. The repeated keystream is
+    cached, so every contact pays for building it only once.
+    """
+    name = 'xor'
+
+    def __init__(self, secret: bytes, use_numpy: bool = True):
+        if not secret:
+            raise ValueError("Secret must not be empty")
+        self._secret = bytes(secret)
+        self._use_numpy = use_numpy and numpy is not None
+        # Keystream always starts at offset 0 and is a multiple of the secret length
+        self._keystream = self._secret
+        # Blocks of big inputs have to start at the same position in the secret
+        self._block_size = max(len(self._secret), MAX_KEYSTREAM_CACHE - MAX_KEYSTREAM_CACHE % len(self._secret))
+
+    def _keystream_slice(self, length: int, offset: int) -> memoryview:
+        """Keystream of given length, starting at the offset of the stream. Crypto workers share
+        the cipher, so the cache is read once and only replaced by a longer keystream
+        """
+        start = offset % len(self._secret)
+        needed = start + length
+        keystream = self._keystream
+        if needed > len(keystream):
+            repeats = -(-needed // len(self._secret))
+            keystream = self._secret * repeats
+            if len(keystream) > len(self._keystream):
+                self._keystream = keystream
+        return memoryview(keystream)[start:needed]
+
+    def _xor(self, data, keystream) -> bytes:
+        if self._use_numpy:
+            return numpy.bitwise_xor(
+                numpy.frombuffer(data, dtype=numpy.uint8),
+                numpy.frombuffer(keystream, dtype=numpy.uint8)
+            ).tobytes()
+        length = len(data)
+        result = int.from_bytes(data, 'little') ^ int.from_bytes(keystream, 'little')
+        return result.to_bytes(length, 'little')
+
+    def apply(self, data, offset: int = 0) -> bytes:
+        length = len(data)
+        if length <= self._block_size:
+            return self._xor(data, self._keystream_slice(length, offset))
+
+        view = memoryview(data)
+        blocks = []
+        for start in range(0, length, self._block_size):
+            block = view[start:start + self._block_size]
+            blocks.append(self._xor(block, self._keystream_slice(len(block), offset + start)))
+        return b"".join(blocks)
+
+
+MESSAGE_CIPHERS = {
+    XorMessageCipher.name: XorMessageCipher
+}
+
+
+def create_cipher(secret: bytes, name: str = XorMessageCipher.name) -> MessageCipher:
+    """Create a message cipher for a shared secret
+
+    Parameters
+    ----------
+    secret : bytes
+        Shared secret with the contact
+    name : str, optional
+        Name of a registered cipher, by default 'xor'
+
+    Returns
+    -------
+    MessageCipher
+        Cipher instance, that should be reused for the contact
+    """
+    return MESSAGE_CIPHERS[name](secret)
@@ -0,0 +1,85 @@
+import zlib
+
+# Name of the compression, advertised in SESSION_INIT_REQUEST and SESSION_ACK_REQUEST.
+# A new dictionary needs a new name, as both sides have to use the same one
+COMPRESSION_CHAT_V1 = 'zlib-chat-v1'
+SUPPORTED_COMPRESSIONS = [COMPRESSION_CHAT_V1]
+
+# First byte of a compressed message. It never starts valid UTF-8, so compressed
+# and plain messages can be told apart without a flag in the envelope
+COMPRESSED_MARKER = b"\xff"
+# Shorter messages are never compressed, the deflate block alone costs a few bytes
+MIN_COMPRESS_SIZE = 24
+# 4 KiB window and small hash tables. The dictionary fits in the window, and a (de)compressor is
+# created per message, where the allocation of the default 256 KiB of state dominates the time
+WINDOW_BITS = 12
+MEMORY_LEVEL = 5
+# Upper bound of a decompressed message, against decompression bombs
+MAX_DECOMPRESSED_SIZE = 1024 * 1024
+
+# Preset dictionary with strings, that are frequent in chat messages. Deflate can reference
+# them from the first byte on, which is what makes short messages compress at all.
+# The most frequent strings come last, as they are reached with the shortest distances
+CHAT_DICTIONARY = " ".join([
+    "https://www. http:// .com .org .de .pdf .jpg attachment link file photo video meeting call",
+    "Monday Tuesday Wednesday Thursday Friday Saturday Sunday tomorrow morning afternoon evening tonight",
+    "yesterday weekend next week last week minutes hours o'clock later soon today",
+    "Congratulations! Happy birthday! Good luck! Have a nice day! Good morning! Good night!",
+    "I don't know I'm not sure I think so Let me know Let me check Sounds good to me",
+    "Can you send me Could you please Would you like to Do you want to Are you coming",
+    "What do you think? How are you doing? Where are you? When are you? What time?",
+    "I will be there in I'm on my way I'm running late See you soon See you later",
+    "Sorry for the late reply No problem Don't worry about it Thank you so much Thanks a lot",
+    "because about again always already actually anyway maybe probably really just still also",
+    "something anything nothing everything someone everyone there their they them then than",
+    "would could should have has had been being with without from into about your you're",
+    "yes yeah okay ok sure great nice cool awesome perfect good thanks thank you please",
+    "haha lol :) :D ;) :( ... !! ?? the and that this what for are not but you I'm it's",
+]).encode()
+
+
+def compress_message(data: bytes) -> bytes:
+    """Compress a message with the chat dictionary, if that makes it smaller
+
+    Parameters
+    ----------
+    data : bytes
+        UTF-8 encoded message
+
+    Returns
+    -------
+    bytes
+        COMPRESSED_MARKER followed by the raw deflate stream, or data unchanged,
+        if it is too short or does not get smaller
+    """
+    if len(data) < MIN_COMPRESS_SIZE:
+        return data
+    compressor = zlib.compressobj(zlib.Z_BEST_COMPRESSION, zlib.DEFLATED, -WINDOW_BITS, MEMORY_LEVEL,
+                                  zdict=CHAT_DICTIONARY)
+    compressed = COMPRESSED_MARKER + compressor.compress(data) + compressor.flush()
+    if len(compressed) >= len(data):
+        return data
+    return compressed
+
+
+def decompress_message(data: bytes) -> bytes:
+    """Reverse `compress_message`. Messages without the marker are returned unchanged
+
+    Raises
+    ------
+    ValueError
+        If the message is corrupt, truncated, or bigger than MAX_DECOMPRESSED_SIZE
+    """
+    if not data.startswith(COMPRESSED_MARKER):
+        return data
+    decompressor = zlib.decompressobj(-WINDOW_BITS, zdict=CHAT_DICTIONARY)
+    try:
+        decompressed = decompressor.decompress(memoryview(data)[len(COMPRESSED_MARKER):], MAX_DECOMPRESSED_SIZE)
+    except zlib.error as e:
+        raise ValueError(f"Corrupt compressed message: {e}")
+    if not decompressor.eof:
+        # The output limit can be reached with all input consumed, if the rest is still in the decompressor
+        if decompressor.unconsumed_tail or len(decompressed) >= MAX_DECOMPRESSED_SIZE:
+            raise ValueError(f"Compressed message exceeds {MAX_DECOMPRESSED_SIZE} bytes")
+        raise ValueError("Compressed message is truncated")
+    return decompressed
@@ -12,3 +12,25 @@ class RequestType(str, Enum):
     CONNECT_WITH_CONTACT_RESPONSE = 'CONNECT_WITH_CONTACT_RESPONSE'
     NEW_ACCOUNT_REQUEST = 'NEW_ACCOUNT_REQUEST'
     LOGIN_REQUEST = 'LOGIN_REQUEST'
+    OFFLINE_BATCH_END = 'OFFLINE_BATCH_END'
+    OFFLINE_BATCH_ACK = 'OFFLINE_BATCH_ACK'
+    HELLO_REQUEST = 'HELLO_REQUEST'
+    HELLO_RESPONSE = 'HELLO_RESPONSE'
+    SESSION_INIT_REQUEST = 'SESSION_INIT_REQUEST'
+    SESSION_ACK_REQUEST = 'SESSION_ACK_REQUEST'
+    CONNECT_WITH_CONTACTS_REQUEST = 'CONNECT_WITH_CONTACTS_REQUEST'
+    CONNECT_WITH_CONTACTS_RESPONSE = 'CONNECT_WITH_CONTACTS_RESPONSE'
+    STATS_REQUEST = 'STATS_REQUEST'
+    STATS_RESPONSE = 'STATS_RESPONSE'
+    GROUP_MESSAGE_REQUEST = 'GROUP_MESSAGE_REQUEST'
+    ATTACHMENT_OFFER = 'ATTACHMENT_OFFER'
+    HEARTBEAT_REQUEST = 'HEARTBEAT_REQUEST'
+    HEARTBEAT_RESPONSE = 'HEARTBEAT_RESPONSE'
+    # Between the nodes of a cluster
+    PEER_HELLO = 'PEER_HELLO'
+    PEER_LOOKUP_REQUEST = 'PEER_LOOKUP_REQUEST'
+    PEER_LOOKUP_RESPONSE = 'PEER_LOOKUP_RESPONSE'
+    PEER_PRESENCE = 'PEER_PRESENCE'
+    PEER_DELIVER = 'PEER_DELIVER'
+    PEER_OFFLINE_BATCH = 'PEER_OFFLINE_BATCH'
+    PEER_OFFLINE_ACK = 'PEER_OFFLINE_ACK'
@@ -1,9 +1,25 @@
-from bip_utils import Bip39MnemonicGenerator, Bip39WordsNum
+from threading import Lock
 import hashlib
 
+# bip_utils is imported on first use, it pulls in every curve it supports and dominates the import time
+# of the server. The generator loads its wordlist when it is created, so it is created once and reused
+_mnemonic_generator = None
+_mnemonic_generator_lock = Lock()
+
+
+def _get_mnemonic_generator():
+    global _mnemonic_generator
+    if _mnemonic_generator is None:
+        with _mnemonic_generator_lock:
+            if _mnemonic_generator is None:
+                from bip_utils import Bip39MnemonicGenerator
+                _mnemonic_generator = Bip39MnemonicGenerator()
+    return _mnemonic_generator
+
 
 def generate_random_seed_phrase() -> (str, bytes):
+    from bip_utils import Bip39WordsNum
     # Generate a random mnemonic string of 12 words with default language (English)
-    mnemonic = Bip39MnemonicGenerator().FromWordsNumber(Bip39WordsNum.WORDS_NUM_12)
-    sha512_hash = hashlib.sha512(str(mnemonic).encode("utf-8")).digest()
+    mnemonic = str(_get_mnemonic_generator().FromWordsNumber(Bip39WordsNum.WORDS_NUM_12))
+    sha512_hash = hashlib.sha512(mnemonic.encode("utf-8")).digest()
     return mnemonic, sha512_hash
@@ -0,0 +1,327 @@
+from collections import namedtuple
+import base64
+import json
+import struct
+import uuid
+
+from util.oqs_utils import RequestType
+
+# Wire formats a connection can negotiate with HELLO_REQUEST
+WIRE_FORMAT_JSON = 'json'
+WIRE_FORMAT_BINARY = 'binary-v2'
+# Capability a client announces with HELLO_REQUEST, if it establishes sessions with SESSION_INIT_REQUEST.
+# Clients without it send, and expect, the KEM ciphertext with every message
+CAPABILITY_SESSIONS = 'sessions'
+# JSON requests, that only clients with sessions understand
+_SESSION_REQUEST_TYPES = (RequestType.SESSION_INIT_REQUEST, RequestType.SESSION_ACK_REQUEST,
+                          RequestType.ATTACHMENT_OFFER)
+
+# JSON frames always start with '{', binary frames with this byte
+BINARY_MAGIC = 0xB1
+# Raised by the unpack functions for truncated or malformed binary frames
+MALFORMED_FRAME_ERRORS = (ValueError, struct.error)
+# Messages reference the KEM session, established once per contact with SESSION_INIT_REQUEST
+SESSION_ID_SIZE = 8
+# Members of a single group message. Bounds the fan-out, a single frame can cause on the server
+MAX_GROUP_MEMBERS = 256
+
+
+class FrameKind():
+    """Kind of a binary frame, second byte of every binary frame
+    """
+    SEND_MESSAGE = 0x01  # Client -> Server
+    DELIVER_MESSAGE = 0x02  # Server -> Client
+    GROUP_SEND = 0x03  # Client -> Server
+    GROUP_DELIVER = 0x04  # Server -> Client
+    ATTACHMENT_CHUNK = 0x05  # Both directions
+    ATTACHMENT_ACK = 0x06  # Both directions
+
+
+# magic, kind, contact UUID, session id, message length
+_SEND_MESSAGE_HEADER = struct.Struct(f"!BB16s{SESSION_ID_SIZE}sI")
+# magic, kind, sender UUID, session id, message length
+_DELIVER_MESSAGE_HEADER = struct.Struct(f"!BB16s{SESSION_ID_SIZE}sI")
+
+# magic, kind, group id, member count, body length. Followed by the members and the body
+_GROUP_SEND_HEADER = struct.Struct("!BB16sHI")
+# member UUID, session id, wrapped key length. Followed by the wrapped key
+_GROUP_MEMBER_HEADER = struct.Struct(f"!16s{SESSION_ID_SIZE}sH")
+# magic, kind, sender UUID, group id, session id, wrapped key length, body length
+_GROUP_DELIVER_HEADER = struct.Struct(f"!BB16s16s{SESSION_ID_SIZE}sHI")
+
+# magic, kind, peer UUID, transfer id, session id, offset, chunk length
+_ATTACHMENT_CHUNK_HEADER = struct.Struct(f"!BB16s16s{SESSION_ID_SIZE}sQI")
+# magic, kind, peer UUID, transfer id, offset
+_ATTACHMENT_ACK_HEADER = struct.Struct("!BB16s16sQ")
+
+SendMessage = namedtuple('SendMessage', ['contact_uuid', 'session_id', 'message'])
+DeliverMessage = namedtuple('DeliverMessage', ['sender_uuid', 'session_id', 'message'])
+GroupMember = namedtuple('GroupMember', ['contact_uuid', 'session_id', 'wrapped_key'])
+GroupSend = namedtuple('GroupSend', ['group_id', 'members', 'body'])
+AttachmentChunk = namedtuple('AttachmentChunk', ['peer_uuid', 'transfer_id', 'session_id', 'offset', 'data'])
+AttachmentAck = namedtuple('AttachmentAck', ['peer_uuid', 'transfer_id', 'offset'])
+GroupDeliver = namedtuple('GroupDeliver', ['sender_uuid', 'group_id', 'session_id', 'wrapped_key', 'body'])
+
+
+def is_binary_frame(frame) -> bool:
+    """Check if the frame payload is a binary frame, or a JSON document
+    """
+    return len(frame) > 1 and frame[0] == BINARY_MAGIC
+
+
+def frame_kind(frame) -> int:
+    """Kind of a binary frame, see `FrameKind`
+    """
+    return frame[1]
+
+
+def requires_session(envelope) -> bool:
+    """Check if an envelope can only be read by a client with sessions. Every binary frame references
+    a session, JSON envelopes do, if they are session requests or messages with a session id
+    """
+    if is_binary_frame(envelope):
+        return True
+    request_json = json.loads(envelope)
+    return request_json['requestType'] in _SESSION_REQUEST_TYPES or 'sessionId' in request_json
+
+
+def _slices(view: memoryview, offset: int, lengths) -> list:
+    """Cut consecutive fields out of the view, without copying
+    """
+    fields = []
+    for length in lengths:
+        end = offset + length
+        if end > len(view):
+            raise ValueError("Binary frame is truncated")
+        fields.append(view[offset:end])
+        offset = end
+    return fields
+
+
+def pack_send_message(contact_uuid: str, session_id: str, message: bytes) -> bytes:
+    """Binary SEND_MESSAGE frame from a client to the server
+
+    Parameters
+    ----------
+    contact_uuid : str
+        UUID of the recipient
+    session_id : str
+        Hex encoded id of the session with the recipient
+    message : bytes
+        Encrypted message
+
+    Returns
+    -------
+    bytes
+        Frame payload
+    """
+    header = _SEND_MESSAGE_HEADER.pack(
+        BINARY_MAGIC,
+        FrameKind.SEND_MESSAGE,
+        uuid.UUID(str(contact_uuid)).bytes,
+        bytes.fromhex(session_id),
+        len(message)
+    )
+    return b"".join((header, message))
+
+
+def unpack_send_message(frame) -> SendMessage:
+    """Parse a binary SEND_MESSAGE frame. The message is a memoryview slice of the frame
+    """
+    view = memoryview(frame)
+    _, _, contact_uuid, session_id, message_len = _SEND_MESSAGE_HEADER.unpack_from(view)
+    (message,) = _slices(view, _SEND_MESSAGE_HEADER.size, (message_len,))
+    return SendMessage(str(uuid.UUID(bytes=contact_uuid)), session_id.hex(), message)
+
+
+def pack_deliver_message(sender_uuid: str, session_id: str, message) -> bytes:
+    """Binary DELIVER_MESSAGE frame from the server to the recipient.
+    The message can be a memoryview slice of the received SEND_MESSAGE frame.
+
+    Parameters
+    ----------
+    sender_uuid : str
+        UUID of the sender
+    session_id : str
+        Hex encoded id of the session between sender and recipient
+    message : bytes
+        Encrypted message
+
+    Returns
+    -------
+    bytes
+        Frame payload
+    """
+    header = _DELIVER_MESSAGE_HEADER.pack(
+        BINARY_MAGIC,
+        FrameKind.DELIVER_MESSAGE,
+        uuid.UUID(str(sender_uuid)).bytes,
+        bytes.fromhex(session_id),
+        len(message)
+    )
+    return b"".join((header, message))
+
+
+def unpack_deliver_message(frame) -> DeliverMessage:
+    """Parse a binary DELIVER_MESSAGE frame. The message is a memoryview slice of the frame
+    """
+    view = memoryview(frame)
+    _, _, sender_uuid, session_id, message_len = _DELIVER_MESSAGE_HEADER.unpack_from(view)
+    (message,) = _slices(view, _DELIVER_MESSAGE_HEADER.size, (message_len,))
+    return DeliverMessage(str(uuid.UUID(bytes=sender_uuid)), session_id.hex(), message)
+
+
+def deliver_message_to_json(deliver_message: DeliverMessage) -> dict:
+    """Convert a binary delivery to the JSON SEND_MESSAGE_REQUEST, clients with sessions,
+    but without binary support, expect. It only carries the session id, not the KEM ciphertext
+    """
+    payload = {}
+    payload['requestType'] = RequestType.SEND_MESSAGE_REQUEST
+    payload['senderUUID'] = deliver_message.sender_uuid
+    payload['sessionId'] = deliver_message.session_id
+    payload['message'] = base64.b64encode(deliver_message.message).decode('ascii')
+    return payload
+
+
+def pack_group_send(group_id: str, members: list, body: bytes) -> bytes:
+    """Binary GROUP_SEND frame from a client to the server. The body is encrypted once
+    with a message key, every member gets the message key wrapped with its own session.
+
+    Parameters
+    ----------
+    group_id : str
+        UUID of the group
+    members : list
+        GroupMember of every recipient, with the hex encoded session id and the wrapped key
+    body : bytes
+        Encrypted body
+
+    Returns
+    -------
+    bytes
+        Frame payload
+    """
+    if len(members) > MAX_GROUP_MEMBERS:
+        raise ValueError(f"Group messages have at most {MAX_GROUP_MEMBERS} members")
+    parts = [_GROUP_SEND_HEADER.pack(
+        BINARY_MAGIC,
+        FrameKind.GROUP_SEND,
+        uuid.UUID(str(group_id)).bytes,
+        len(members),
+        len(body)
+    )]
+    for member in members:
+        parts.append(_GROUP_MEMBER_HEADER.pack(
+            uuid.UUID(str(member.contact_uuid)).bytes,
+            bytes.fromhex(member.session_id),
+            len(member.wrapped_key)
+        ))
+        parts.append(member.wrapped_key)
+    parts.append(body)
+    return b"".join(parts)
+
+
+def unpack_group_send(frame) -> GroupSend:
+    """Parse a binary GROUP_SEND frame. Wrapped keys and body are memoryview slices of the frame
+    """
+    view = memoryview(frame)
+    _, _, group_id, member_count, body_len = _GROUP_SEND_HEADER.unpack_from(view)
+    if member_count > MAX_GROUP_MEMBERS:
+        raise ValueError(f"Group message with {member_count} members")
+    offset = _GROUP_SEND_HEADER.size
+    members = []
+    for _ in range(member_count):
+        if offset + _GROUP_MEMBER_HEADER.size > len(view):
+            raise ValueError("Binary frame is truncated")
+        contact_uuid, session_id, key_len = _GROUP_MEMBER_HEADER.unpack_from(view, offset)
+        offset += _GROUP_MEMBER_HEADER.size
+        (wrapped_key,) = _slices(view, offset, (key_len,))
+        offset += key_len
+        members.append(GroupMember(str(uuid.UUID(bytes=contact_uuid)), session_id.hex(), wrapped_key))
+    (body,) = _slices(view, offset, (body_len,))
+    return GroupSend(str(uuid.UUID(bytes=group_id)), members, body)
+
+
+def pack_group_deliver(sender_uuid: str, group_id: str, session_id: str, wrapped_key, body) -> bytes:
+    """Binary GROUP_DELIVER frame from the server to one member of a group message.
+    Wrapped key and body can be memoryview slices of the received GROUP_SEND frame.
+    """
+    header = _GROUP_DELIVER_HEADER.pack(
+        BINARY_MAGIC,
+        FrameKind.GROUP_DELIVER,
+        uuid.UUID(str(sender_uuid)).bytes,
+        uuid.UUID(str(group_id)).bytes,
+        bytes.fromhex(session_id),
+        len(wrapped_key),
+        len(body)
+    )
+    return b"".join((header, wrapped_key, body))
+
+
+def unpack_group_deliver(frame) -> GroupDeliver:
+    """Parse a binary GROUP_DELIVER frame. Wrapped key and body are memoryview slices of the frame
+    """
+    view = memoryview(frame)
+    _, _, sender_uuid, group_id, session_id, key_len, body_len = _GROUP_DELIVER_HEADER.unpack_from(view)
+    wrapped_key, body = _slices(view, _GROUP_DELIVER_HEADER.size, (key_len, body_len))
+    return GroupDeliver(str(uuid.UUID(bytes=sender_uuid)), str(uuid.UUID(bytes=group_id)), session_id.hex(),
+                        wrapped_key, body)
+
+
+def group_deliver_to_json(group_deliver: GroupDeliver) -> dict:
+    """Convert a binary group delivery to the JSON GROUP_MESSAGE_REQUEST, for clients without binary support
+    """
+    payload = {}
+    payload['requestType'] = RequestType.GROUP_MESSAGE_REQUEST
+    payload['senderUUID'] = group_deliver.sender_uuid
+    payload['groupId'] = group_deliver.group_id
+    payload['sessionId'] = group_deliver.session_id
+    payload['wrappedKey'] = base64.b64encode(group_deliver.wrapped_key).decode('ascii')
+    payload['body'] = base64.b64encode(group_deliver.body).decode('ascii')
+    return payload
+
+
+def pack_attachment_chunk(peer_uuid: str, transfer_id: str, session_id: str, offset: int, data) -> bytes:
+    """Binary ATTACHMENT_CHUNK frame. From a client, the peer is the receiver of the attachment.
+    The server relays it with the sender as peer instead.
+    """
+    header = _ATTACHMENT_CHUNK_HEADER.pack(
+        BINARY_MAGIC,
+        FrameKind.ATTACHMENT_CHUNK,
+        uuid.UUID(str(peer_uuid)).bytes,
+        uuid.UUID(str(transfer_id)).bytes,
+        bytes.fromhex(session_id),
+        offset,
+        len(data)
+    )
+    return b"".join((header, data))
+
+
+def unpack_attachment_chunk(frame) -> AttachmentChunk:
+    """Parse a binary ATTACHMENT_CHUNK frame. The data is a memoryview slice of the frame
+    """
+    view = memoryview(frame)
+    _, _, peer_uuid, transfer_id, session_id, offset, data_len = _ATTACHMENT_CHUNK_HEADER.unpack_from(view)
+    (data,) = _slices(view, _ATTACHMENT_CHUNK_HEADER.size, (data_len,))
+    return AttachmentChunk(str(uuid.UUID(bytes=peer_uuid)), str(uuid.UUID(bytes=transfer_id)), session_id.hex(),
+                           offset, data)
+
+
+def pack_attachment_ack(peer_uuid: str, transfer_id: str, offset: int) -> bytes:
+    """Binary ATTACHMENT_ACK frame, with the bytes the receiver of an attachment has written.
+    Like chunks, the server relays it with the sender as peer.
+    """
+    return _ATTACHMENT_ACK_HEADER.pack(
+        BINARY_MAGIC,
+        FrameKind.ATTACHMENT_ACK,
+        uuid.UUID(str(peer_uuid)).bytes,
+        uuid.UUID(str(transfer_id)).bytes,
+        offset
+    )
+
+
+def unpack_attachment_ack(frame) -> AttachmentAck:
+    """Parse a binary ATTACHMENT_ACK frame
+    """
+    _, _, peer_uuid, transfer_id, offset = _ATTACHMENT_ACK_HEADER.unpack_from(frame)
+    return AttachmentAck(str(uuid.UUID(bytes=peer_uuid)), str(uuid.UUID(bytes=transfer_id)), offset)
@@ -1,11 +1,49 @@
 // Startup functions
-$( document ).ready(function() {
+$( document ).ready(async function() {
     setUUID();
     setName();
+    // Everything older than the cursor is loaded with the history pages
+    syncCursor = JSON.parse(await eel.load_history_since(null)()).cursor
     loadChatOverview();
-    loadChatHistory();
 });
 
+// Cursor of the newest message, that is shown. Messages after it are fetched with `load_history_since`
+let syncCursor = null
+// Ids of messages, that were pushed or synced, so a message is never shown twice
+let shownMessageIds = new Set()
+
+// Fetch the messages, that were saved while the frontend was hidden or disconnected
+async function syncHistory() {
+    if (syncCursor === null) return;
+    let hasMore = true
+    while (hasMore) {
+        let delta = JSON.parse(await eel.load_history_since(syncCursor)())
+        showMessages(delta.messages.map(message => ({
+            id: message.id,
+            contactUUID: message.contact,
+            contactName: message.contactName,
+            sentBy: message.sentBy,
+            message: message.message
+        })))
+        syncCursor = delta.cursor
+        hasMore = delta.hasMore
+    }
+}
+
+document.addEventListener('visibilitychange', function () {
+    if (document.visibilityState === 'visible') syncHistory()
+});
+window.addEventListener('focus', syncHistory);
+
+// Advance the sync cursor, if the message is newer
+function advanceSyncCursor(date, id) {
+    if (syncCursor === null) return;
+    let [cursorDate, cursorId] = syncCursor.split(":").map(Number)
+    if (date > cursorDate || (date === cursorDate && id > cursorId)) {
+        syncCursor = date + ":" + id
+    }
+}
+
 async function setUUID() {
     let uuid = await eel.get_uuid()();
     console.log("SET UUID: " + uuid)
@@ -24,46 +62,51 @@ async function loadChatOverview() {
     let chatOverviewJSON = JSON.parse(chatOverview)
 
     chatOverviewJSON.forEach(contact => {
-        addChat(contact.name, contact.uuid)
+        let imessage = addChat(contact.name, contact.uuid, contact.isGroup)
+        loadChatHistory(contact.uuid, imessage)
     });
 }
 
-async function loadChatHistory() {
-    let chatHistory = await eel.load_chat_history()();
-    console.log("Chat history: " + chatHistory)
-    let chatHistoryJSON = JSON.parse(chatHistory)
-    chatHistoryJSON.sort(compareHistory)
-    console.log(chatHistoryJSON)
-
-    chatHistoryJSON.forEach(history => {
-        console.log("IN HISTORY!")
-        // Get imessage with correct id
-        let idStr = "msg-" + history.contact
-        let imessage = $("#"+idStr)
-        console.log(imessage)
-
-        // If message doesn't exsist, create one
-        if (!imessage) {
-            imessage = document.createElement("div");
-            imessage.classList.add('imessage')
-            imessage.id = idStr
-            fullChat.prepend(imessage)
-        }
+// Ids of the shown group chats. Their history and messages are loaded separately
+let groupIds = new Set()
+
+async function createGroup(name, memberUUIDs) {
+    let groupId = await eel.create_group(name, memberUUIDs)();
+    addChat(name, groupId, true)
+    return groupId
+}
+
+// Cursor of the next older page per contact. null once the whole history is loaded
+let historyCursors = {}
+// Contacts with a page request in flight. The scroll handler fires again, before the page arrives
+let loadingHistory = new Set()
+
+// Load the next older page of the chat history and put it in front of the shown messages.
+// Pages come sorted from old to new, so no sorting is needed here
+async function loadChatHistory(contactUUID, imessage) {
+    if (historyCursors[contactUUID] === null || loadingHistory.has(contactUUID)) return;
+    loadingHistory.add(contactUUID)
+    let chatHistoryJSON
+    try {
+        let loadHistory = groupIds.has(contactUUID) ? eel.load_group_history : eel.load_chat_history
+        let chatHistory = await loadHistory(contactUUID, historyCursors[contactUUID] || null)();
+        chatHistoryJSON = JSON.parse(chatHistory)
+        historyCursors[contactUUID] = chatHistoryJSON.nextCursor
+    } finally {
+        loadingHistory.delete(contactUUID)
+    }
+
+    let page = document.createDocumentFragment();
+    chatHistoryJSON.messages.forEach(history => {
         let senderClass = history.sentBy == "ME" ? "from-me" : "from-them";
 
         let chatMessage = document.createElement("p");
         chatMessage.classList.add(senderClass, 'no-tail')
-        chatMessage.id = idStr
         chatMessage.innerHTML = history.message
 
-        imessage.append(chatMessage)
+        page.appendChild(chatMessage)
     });
-}
-
-// Sort by date
-function compareHistory(messageOne, messageTwo) {
-    if (messageOne.date > messageTwo.date) return 1;
-    return -1;
+    imessage.prepend(page)
 }
 
 // Add Contact Modal Button
@@ -94,10 +137,11 @@ function copyToClipboard(element) {
 }
 
 // Add a new chat
-function addChat(contactName, contactUUID) {
+function addChat(contactName, contactUUID, isGroup = false) {
     console.log("ADDING NEW CHAT")
     console.log("Contact name: " + contactName)
     console.log("Contact UUID: " + contactUUID)
+    if (isGroup) groupIds.add(contactUUID)
 
     let profileImage = document.createElement("img");
     profileImage.classList.add('ui', 'avatar', 'image');
@@ -141,6 +185,10 @@ function addChat(contactName, contactUUID) {
     let imessage = document.createElement("div");
     imessage.classList.add('imessage')
     imessage.id = "msg-" + contactUUID
+    // Fetch older messages, once the user scrolls to the top
+    imessage.addEventListener('scroll', function () {
+        if (imessage.scrollTop === 0) loadChatHistory(contactUUID, imessage)
+    });
 
     fullChat.prepend(imessage)
 
@@ -173,6 +221,20 @@ function handleAddContactResponse(response_json_str) {
     }
 }
 
+// Handle batched add contacts, e.g. from an address book import
+eel.expose(handleAddContactsResponse);
+function handleAddContactsResponse(response_json_str) {
+    let response_json = JSON.parse(response_json_str)
+    response_json.contacts.forEach(contact => {
+        if (!document.getElementById(contact.contactUUID)) {
+            addChat(contact.contactName, contact.contactUUID)
+        }
+    });
+    if (response_json.missingUUIDs.length > 0) {
+        $('#add-contact-failure').removeClass('hidden')
+    }
+}
+
 console.log("START")
 
 list = $('.ui.list')
@@ -221,35 +283,55 @@ chatInput.on('keyup', function (e) {
         messageEl.innerHTML = message;
         activeChat.appendChild(messageEl)
 
-        eel.send_message(activePreview.id, message);
+        if (groupIds.has(activePreview.id)) {
+            eel.send_group_message(activePreview.id, message)().then(id => shownMessageIds.add("group-" + id));
+        } else {
+            eel.send_message(activePreview.id, message)().then(id => shownMessageIds.add(id));
+        }
 
     }
 });
 
-eel.expose(handleIncomingMessage);
-function handleIncomingMessage(messageJsonStr) {
-    fullChats = document.querySelectorAll('.imessage')
-    messageJSON = JSON.parse(messageJsonStr)
-
-    console.log(messageJSON)
-
-    let fullChatId = "msg-" + messageJSON.senderUUID
-    senderChat = Array.from(fullChats).find((node) => node.id === fullChatId)
-
-    console.log(senderChat)
-
-    if (!senderChat) {
-        console.log("New contact!")
-        // Add chat
-        senderChat = addChat(messageJSON.senderName, messageJSON.senderUUID)
-        console.log("After Add chat!")
-        console.log(senderChat)
-    }
-
+// Messages are shown with one DOM update per chat
+function showMessages(messages) {
+    let fragments = new Map()
+    messages.forEach(messageJSON => {
+        if (shownMessageIds.has(messageJSON.id)) return;
+        shownMessageIds.add(messageJSON.id)
+
+        let senderChat = document.getElementById("msg-" + messageJSON.contactUUID)
+        if (!senderChat) {
+            console.log("New contact!")
+            senderChat = addChat(messageJSON.contactName, messageJSON.contactUUID, messageJSON.isGroup)
+        }
+        if (!fragments.has(senderChat)) fragments.set(senderChat, document.createDocumentFragment())
 
-    let messageEl = document.createElement("p");
-    messageEl.classList.add('from-them', 'no-tail');
-    messageEl.innerHTML = messageJSON.message;
+        let messageEl = document.createElement("p");
+        messageEl.classList.add(messageJSON.sentBy == "ME" ? 'from-me' : 'from-them', 'no-tail');
+        messageEl.innerHTML = messageJSON.message;
+        fragments.get(senderChat).appendChild(messageEl)
+    });
+    fragments.forEach((fragment, senderChat) => senderChat.appendChild(fragment))
+}
 
-    senderChat.appendChild(messageEl)
+// Incoming messages are pushed in batches, at most one call per frame
+eel.expose(handleIncomingMessages);
+function handleIncomingMessages(messagesJsonStr) {
+    let messages = JSON.parse(messagesJsonStr)
+    // Group messages have their own ids and are not part of the delta sync
+    showMessages(messages.map(message => message.groupId ? {
+        id: "group-" + message.id,
+        contactUUID: message.groupId,
+        contactName: message.groupName,
+        isGroup: true,
+        sentBy: "CONTACT",
+        message: message.senderName + ": " + message.message
+    } : {
+        id: message.id,
+        contactUUID: message.senderUUID,
+        contactName: message.senderName,
+        sentBy: "CONTACT",
+        message: message.message
+    }))
+    messages.filter(message => !message.groupId).forEach(message => advanceSyncCursor(message.date, message.id))
 }